@@ -1,11 +1,15 @@
+from collections import deque
+import threading
+import time
+
 from gi.repository import GObject, GtkClutter, Clutter, GLib, Gtk
 from pygtk3_helpers.delegates import SlaveView
-from webcam_recorder.caps import get_device_configs
-from webcam_recorder.video_view import RecordControl
+from .device_cache import DeviceConfigCache, filter_device_configs
 from .pipeline import PipelineActor
 from .warp import WarpActor
 from .warp_control import WarpControl
 from .pipeline_manager import PipelineManager
+from .timeline import WarpTimelineRecorder
 
 
 class ClutterView(SlaveView):
@@ -25,21 +29,50 @@ class ClutterView(SlaveView):
 
 
 class RecordView(SlaveView):
-    def __init__(self, device_configs=None):
+    '''
+    Arguments
+    ---------
+
+     - `device_configs`: Device configurations (default: cached or probed
+       configurations of connected devices).
+     - `rectify`: If `True`, rectify recorded frames according to the
+       current warp (see `rectify.RectifyBranch`).
+     - `policies`: Queue policies of the display and recording branches
+       (see `PipelineManager`).
+    '''
+    def __init__(self, device_configs=None, rectify=False, policies=None):
         super(RecordView, self).__init__()
+        self.record_control = None
         if device_configs is None:
-            self.device_configs = get_device_configs()
-            self.device_configs = self.device_configs[(self.device_configs
-                                                       .format == 'I420')
-                                                      & (self.device_configs
-                                                         .framerate > 10)]
+            # Serve cached device configurations (if available) and probe
+            # devices in the background.
+            self.device_cache = DeviceConfigCache()
+            device_configs = \
+                self.device_cache.get(on_changed=self.on_devices_changed)
+            self.device_configs = filter_device_configs(device_configs)
         else:
+            self.device_cache = None
             self.device_configs = device_configs
-        self.pipeline_manager = PipelineManager()
+        self.pipeline_manager = PipelineManager(policies=policies)
+        if rectify:
+            from .rectify import Rectifier
+
+            self.pipeline_manager.rectifier = Rectifier()
         self.config_requested = None
         self.record_path = None
         self.pipeline_actor = None
         self.video_view = None
+        self._config_lock = threading.Lock()
+        self._config_request_time = None
+        self._refresh_scheduled = False
+        # Most recent config change latencies, as `dict` records with the
+        # wall-clock time of each stage (see `on_config_first_frame`).
+        self.config_latencies = deque(maxlen=100)
+        # Records warp timeline of active recording.
+        self.warp_timeline = None
+        # Called as `on_first_frame(latency)` once the first frame of a
+        # config change is shown (see `on_config_first_frame`).
+        self.on_first_frame = None
 
     def add_pipeline_actor(self):
         actor = PipelineActor()
@@ -50,10 +83,21 @@ class RecordView(SlaveView):
         self.warp_actor.add_constraint(Clutter.BindConstraint
                                        .new(self.video_view.stage,
                                             Clutter.BindCoordinate.SIZE, 0))
+        self.warp_timeline = \
+            WarpTimelineRecorder(self.warp_actor,
+                                 self.pipeline_manager.recording_time)
+        self.warp_actor.on_transform_changed = self.on_transform_changed
         self.pipeline_actor = actor
 
+    def on_transform_changed(self, state):
+        self.warp_timeline.on_transform_changed(state)
+        if self.pipeline_manager.rectifier is not None:
+            self.pipeline_manager.rectifier.on_transform_changed(state)
+
     def create_ui(self):
-        self.record_control = RecordControl()
+        from webcam_recorder.video_view import RecordControl
+
+        self.record_control = RecordControl(self.device_configs)
         self.video_view = ClutterView()
         self.video_view.show()
         self.add_pipeline_actor()
@@ -68,52 +112,90 @@ class RecordView(SlaveView):
             self.widget.set_child_packing(slave.widget, False, False, 0,
                                           Gtk.PackType.START)
 
-        Clutter.threads_add_timeout(GLib.PRIORITY_DEFAULT, 1000,
-                                    self.refresh_config)
+    def on_devices_changed(self, device_configs):
+        '''
+        Called (from a background thread) if probed device configurations
+        differ from the cached configurations.
+        '''
+        GObject.idle_add(self.set_device_configs,
+                         filter_device_configs(device_configs))
+
+    def set_device_configs(self, device_configs):
+        self.device_configs = device_configs
+        if self.record_control is not None:
+            self.record_control.device_configs = device_configs
+            self.record_control.mode_selector.set_configs(device_configs)
+        return False
 
     def on_options_changed(self, config, record_path):
-        self.config_requested = config
-        self.record_path = record_path
+        '''
+        Queue config request to be applied as soon as possible.
+
+        Successive requests made before the queued request is processed are
+        collapsed, such that only the latest request is applied.
+        '''
+        with self._config_lock:
+            self.config_requested = config
+            self.record_path = record_path
+            self._config_request_time = time.time()
+            if self._refresh_scheduled:
+                return
+            self._refresh_scheduled = True
+        Clutter.threads_add_idle(GLib.PRIORITY_DEFAULT,
+                                 self._process_config_request)
+
+    def _process_config_request(self):
+        with self._config_lock:
+            self._refresh_scheduled = False
+        self.refresh_config()
+        # Remove idle source.
+        return False
+
+    def on_config_first_frame(self, latency, timestamp):
+        '''
+        Record latency between a config change in the UI and the first frame
+        of the resulting pipeline.
+        '''
+        latency['first_frame'] = timestamp
+        latency['latency'] = timestamp - latency['requested']
+        self.config_latencies.append(latency)
+        if self.on_first_frame is not None:
+            self.on_first_frame(latency)
 
     def refresh_config(self):
         '''
-        __NB__ This *must* be called from a *different* thread than the GUI/Gtk thread.
+        Apply the latest config request (if any).
+
+        Called from the Clutter main loop (see `on_options_changed`).
         '''
-        from gi.repository import Clutter, Gst, GstVideo, ClutterGst
-        from path_helpers import path
-        from .warp import bounding_box_from_allocation
-
-        if self.config_requested is not None:
-            sink = ClutterGst.VideoSink.new(self.pipeline_actor.texture)
-            sink.set_property('sync', True)
-            sink.set_property('qos', True)
-
-            if self.record_path is not None:
-                record_path = path(self.record_path)
-                warp_path = record_path.parent.joinpath(record_path.namebase +
-                                                        '.h5')
-                # Parent allocation
-                parent_bbox = \
-                    bounding_box_from_allocation(self.warp_actor
-                                                 .get_allocation_geometry())
-                # Child allocation
-                child_bbox = \
-                    bounding_box_from_allocation(self.warp_actor.actor
-                                                 .get_allocation_geometry())
-                common_settings = dict(format='table', data_columns=True,
-                                       complib='zlib', complevel=6)
-                parent_bbox.to_hdf(str(warp_path), '/shape/parent',
-                                   **common_settings)
-                child_bbox.to_hdf(str(warp_path), '/shape/child',
-                                  **common_settings)
-                self.warp_actor.parent_corners.to_hdf(str(warp_path),
-                                                      '/corners/parent',
-                                                      **common_settings)
-                self.warp_actor.child_corners.to_hdf(str(warp_path),
-                                                     '/corners/child',
-                                                     **common_settings)
-            self.pipeline_manager.set_config(self.config_requested,
-                                             record_path=self.record_path,
-                                             sink=sink)
+        from gi.repository import Clutter, Gst, GstVideo
+        from .calibration import sidecar_path
+
+        with self._config_lock:
+            config_requested = self.config_requested
+            record_path = self.record_path
+            request_time = self._config_request_time
             self.config_requested = None
-        return True
+
+        if config_requested is not None:
+            latency = {'requested': request_time, 'applied': time.time()}
+            # Only called if a new pipeline is started.
+            create_sink = self.pipeline_actor.create_sink
+            if record_path is not None:
+                # Written on background writer thread (does not delay
+                # pipeline startup).
+                # Remap tables are only needed to rectify the recording.
+                self.warp_actor.save(sidecar_path(record_path),
+                                     tables=self.pipeline_manager.rectifier
+                                     is not None)
+            self.warp_timeline.set_record_path(record_path)
+            if self.pipeline_manager.rectifier is not None:
+                # Warp in effect at the start of the recording.
+                self.pipeline_manager.rectifier\
+                    .on_transform_changed(self.warp_actor.state)
+            self.pipeline_manager.set_config(config_requested,
+                                             record_path=record_path,
+                                             sink=create_sink,
+                                             on_first_frame=lambda t:
+                                             self.on_config_first_frame(latency,
+                                                                        t))
@@ -1,8 +1,17 @@
 from threading import Thread
+import json
+import time
 
-from gi.repository import Clutter, GLib, Gst
-from .svg import SvgGroup
+from gi.repository import Clutter, GLib, Gst, Gtk
 from . import RecordView
+from .encoders import DEFAULT_PROFILE, PROFILES
+from .queues import DEFAULT_PRESET, PRESETS
+from .segments import SegmentPolicy
+from .startup import startup_report
+
+
+# Wall-clock time each startup phase completed.
+STARTUP_TIMES = {'imported': time.time()}
 
 
 def parse_args(args=None):
@@ -18,6 +27,36 @@ def parse_args(args=None):
     parser.add_argument('-i', '--interactive', action='store_true',
                         help='Run UI in background thread (useful for '
                         'running, e.g., from IPython).')
+    parser.add_argument('-r', '--rectify', action='store_true',
+                        help='Rectify recorded video according to the '
+                        'current warp.')
+    parser.add_argument('-q', '--queue-policy', default=None,
+                        choices=PRESETS.keys(),
+                        help='Queue policy preset (default: %s).' %
+                        DEFAULT_PRESET)
+    parser.add_argument('-e', '--encoder', default=None,
+                        choices=PROFILES.keys(),
+                        help='Encoder profile of recordings (default: %s).' %
+                        DEFAULT_PROFILE)
+    parser.add_argument('--segment-time', type=float, default=None,
+                        help='Split recordings into segment files of this '
+                        'duration (in seconds).')
+    parser.add_argument('--segment-size', type=int, default=None,
+                        help='Split recordings into segment files of this '
+                        'size (in MiB).')
+    parser.add_argument('--segment-files', type=int, default=0,
+                        help='Maximum number of segment files to keep (older '
+                        'segments are overwritten, default: keep all).')
+    parser.add_argument('-m', '--multi-camera', action='store_true',
+                        help='Display all connected cameras side by side '
+                        '(instead of the single camera viewer).')
+    parser.add_argument('--record-dir', default=None,
+                        help='With `--multi-camera`, record every camera to '
+                        'this directory.')
+    parser.add_argument('--time-to-first-frame', action='store_true',
+                        help='Show first available device configuration, '
+                        'print startup times (as JSON) once the first frame '
+                        'is displayed, and exit.')
 
     args = parser.parse_args()
     return args
@@ -25,7 +64,26 @@ def parse_args(args=None):
 
 def main(args):
     Gst.init()
-    record_view = RecordView()
+    if args.segment_time or args.segment_size:
+        segment_policy = SegmentPolicy(
+            max_time=args.segment_time or 0,
+            max_bytes=(args.segment_size or 0) << 20,
+            max_files=args.segment_files)
+    else:
+        segment_policy = None
+
+    if args.multi_camera:
+        from .multi_camera import show_cameras
+
+        return show_cameras(policies=args.queue_policy,
+                            segment_policy=segment_policy,
+                            encoder=args.encoder,
+                            record_dir=args.record_dir)
+
+    record_view = RecordView(rectify=args.rectify,
+                             policies=args.queue_policy)
+    record_view.pipeline_manager.segment_policy = segment_policy
+    record_view.pipeline_manager.encoder = args.encoder
 
     if args.interactive:
         gui_thread = Thread(target=record_view.show_and_run)
@@ -41,6 +99,9 @@ def main(args):
     view = record_view.video_view
 
     def add_svg(view, svg_path):
+        # Only load `svg_model` (and `pandas`) when an SVG is displayed.
+        from .svg import SvgGroup
+
         actor = SvgGroup.from_path(svg_path)
         view.stage.add_actor(actor)
         actor.add_constraint(Clutter.BindConstraint
@@ -50,6 +111,20 @@ def main(args):
         Clutter.threads_add_idle(GLib.PRIORITY_DEFAULT, add_svg, view,
                                  args.svg_path)
 
+    if args.time_to_first_frame:
+        STARTUP_TIMES['ui'] = time.time()
+
+        def on_first_frame(latency):
+            STARTUP_TIMES['first_frame'] = latency['first_frame']
+            print json.dumps(startup_report(STARTUP_TIMES), sort_keys=True)
+            GLib.idle_add(Gtk.main_quit)
+
+        record_view.on_first_frame = on_first_frame
+        Clutter.threads_add_idle(GLib.PRIORITY_DEFAULT, lambda *args:
+                                 record_view.on_options_changed(
+                                     record_view.device_configs.iloc[0],
+                                     None) and False)
+
     if args.interactive:
         raw_input()
     else:
@@ -62,7 +137,5 @@ if __name__ == '__main__':
     '''
     Demonstrate drag'n'drop webcam feed using Clutter stage.
     '''
-    import time
-
     args = parse_args()
     result = main(args)
@@ -0,0 +1,448 @@
+'''
+Rectify recorded videos offline, according to their stored warps.
+
+For each video, the warp calibration stored next to it (see
+`calibration.find_sidecar`, i.e., `<name>.warp.json` or `<name>.h5`) is
+applied to every frame, and the result is re-encoded to
+`<output_dir>/<name><suffix><ext>`.  If a warp timeline was recorded (see
+`timeline`), the warp in effect at each frame is applied instead.
+
+Segments of a segmented recording (see `segments`) have no sidecar or
+timeline of their own.  Each segment is instead rectified according to the
+sidecar and timeline of its recording, offset by the start time of the
+segment in the recording (see `recording_of`).
+
+Frames are streamed one at a time (decode -> remap -> encode), and files are
+processed in parallel across a process pool, e.g.:
+
+    python -m clutter_webcam_viewer.batch_rectify -j 4 -o rectified videos/
+
+Each output is written to a temporary file, which is renamed once complete,
+followed by a `.done` marker.  Re-running the same command after an
+interruption skips completed files (use `--force` to redo them).
+'''
+from multiprocessing import Pool, TimeoutError, Value, cpu_count
+import json
+import os
+import sys
+import time
+import traceback
+
+import cv2
+from path_helpers import path
+
+from .calibration import WarpCalibration, find_sidecar, load_calibration
+from .remap_cache import RemapCache, frame_homography, remap_path
+from .segments import find_segment
+from .timeline import WarpTimeline, timeline_path
+
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mkv', '.mov')
+DONE_EXTENSION = '.done'
+DEFAULT_SUFFIX = '-rectified'
+# Frames processed by all workers (see `run_batch`).
+_frame_counter = None
+
+
+def output_path_for(video_path, output_dir=None, suffix=DEFAULT_SUFFIX):
+    '''
+    Return rectified output path for a video (in the directory of the video,
+    unless `output_dir` is provided).
+    '''
+    video_path = path(video_path)
+    output_dir = video_path.parent if output_dir is None else path(output_dir)
+    return output_dir.joinpath(video_path.namebase + suffix + video_path.ext)
+
+
+def done_path(output_path):
+    '''
+    Return path of marker written once `output_path` is complete.
+    '''
+    output_path = path(output_path)
+    return output_path.parent.joinpath(output_path.name + DONE_EXTENSION)
+
+
+def partial_path(output_path):
+    '''
+    Return path `output_path` is written to until complete.
+
+    The path is fixed (rather than unique), such that the partial output of
+    an interrupted run is overwritten when resuming.
+    '''
+    output_path = path(output_path)
+    return output_path.parent.joinpath('.' + output_path.namebase +
+                                       '.partial' + output_path.ext)
+
+
+def is_done(output_path):
+    return path(output_path).isfile() and done_path(output_path).isfile()
+
+
+def find_videos(paths, extensions=VIDEO_EXTENSIONS, suffix=DEFAULT_SUFFIX):
+    '''
+    Return sorted list of videos in `paths` (files or directories).
+
+    Outputs (i.e., names ending in `suffix`) and partial outputs (hidden
+    files) of previous runs are skipped.
+    '''
+    videos = set()
+    for path_i in map(path, paths):
+        if path_i.isdir():
+            candidates = path_i.files()
+        else:
+            candidates = [path_i]
+        videos.update(p for p in candidates
+                      if p.ext.lower() in extensions and
+                      not p.namebase.endswith(suffix) and
+                      not p.name.startswith('.'))
+    return sorted(videos)
+
+
+def recording_of(video_path):
+    '''
+    Return `(recording_path, offset)`, where `recording_path` is the path the
+    warp sidecar and timeline of `video_path` are stored next to, and
+    `offset` is the start time (in nanoseconds) of the video in that
+    recording.
+
+    For a segment of a segmented recording (see `segments.find_segment`),
+    this is the path of the recording and the start time of the segment.
+    Otherwise, it is `video_path` and `0`.
+    '''
+    video_path = path(video_path)
+    segment = find_segment(video_path)
+    if segment is None:
+        return video_path, 0
+    recording_path, segment = segment
+    return recording_path, int(round(segment['start'] * 1e9))
+
+
+def find_jobs(paths, output_dir=None, suffix=DEFAULT_SUFFIX, force=False):
+    '''
+    Return `(jobs, skipped)`, where `jobs` is a list of `(video_path,
+    warp_path, output_path)` tuples and `skipped` is a list of `(video_path,
+    reason)` tuples (e.g., no calibration, or already done).
+
+    Segments of a segmented recording use the calibration of the recording
+    (see `recording_of`).
+    '''
+    jobs = []
+    skipped = []
+    for video_path in find_videos(paths, suffix=suffix):
+        warp_path = find_sidecar(recording_of(video_path)[0])
+        output_path = output_path_for(video_path, output_dir, suffix)
+        if warp_path is None:
+            skipped.append((video_path, 'no calibration'))
+        elif not force and is_done(output_path):
+            skipped.append((video_path, 'done'))
+        else:
+            jobs.append((video_path, warp_path, output_path))
+    return jobs, skipped
+
+
+class WarpSchedule(object):
+    '''
+    Warp calibration in effect at each frame of a recording.
+
+    Arguments
+    ---------
+
+     - `calibration`: Calibration stored next to the video (i.e., the warp at
+       the start of the recording).
+     - `timeline`: Optional `timeline.WarpTimeline` of the recording.
+     - `offset`: Start time (in nanoseconds) of the video in the recording
+       (e.g., of a segment, see `recording_of`).
+    '''
+    def __init__(self, calibration, timeline=None, offset=0):
+        self.calibration = calibration
+        self.offset = offset
+        self.timeline = timeline if timeline is not None and len(timeline) \
+            else None
+        self._index = None
+        self._current = calibration
+
+    def at(self, pts):
+        '''
+        Return calibration in effect at time `pts` (in nanoseconds since the
+        start of the video).
+        '''
+        if self.timeline is None:
+            return self.calibration
+        index = max(self.timeline.index_at(pts + self.offset), 0)
+        if index != self._index:
+            record = self.timeline.records[index]
+            self._current = WarpCalibration(self.calibration.parent_bbox,
+                                            self.calibration.child_bbox,
+                                            record['parent_corners'],
+                                            record['child_corners'])
+            self._index = index
+        return self._current
+
+
+def frame_pts(capture, index, fps):
+    '''
+    Return timestamp (in nanoseconds) of the frame last read from `capture`.
+
+    The stream timestamp (`CAP_PROP_POS_MSEC`) is used where the backend
+    provides one, such that frames of variable frame rate recordings (e.g.,
+    with frames dropped by a leaky queue) are matched to the warp timeline.
+    Otherwise, the timestamp is derived from the frame `index` and `fps`.
+    '''
+    msec = capture.get(cv2.CAP_PROP_POS_MSEC)
+    if msec > 0 or (msec == 0 and index == 0):
+        return int(round(msec * 1e6))
+    return int(index * 1e9 / fps)
+
+
+def rectify_video(video_path, warp_path, output_path, fourcc='XVID',
+                  cache=None, on_frames=None, frames_per_update=30):
+    '''
+    Rectify a video, streaming one frame at a time.
+
+    Arguments
+    ---------
+
+     - `video_path`: Input video path.
+     - `warp_path`: Warp calibration path (see
+       `calibration.load_calibration`).
+     - `output_path`: Output video path (written once complete).
+     - `fourcc`: Output codec four character code.
+     - `cache`: `remap_cache.RemapCache` (remap tables stored next to the
+       calibration are loaded into it, if available).
+     - `on_frames`: Called as `on_frames(count)` every `frames_per_update`
+       frames (and once done).
+
+    Returns `dict` with the number of `frames` and the run time in `seconds`.
+    '''
+    start = time.time()
+    video_path = path(video_path)
+    output_path = path(output_path)
+    if cache is None:
+        cache = RemapCache()
+    tables_path = remap_path(warp_path)
+    if tables_path.isfile():
+        try:
+            cache.load(tables_path)
+        except Exception:
+            pass
+    recording_path, offset = recording_of(video_path)
+    timeline = None
+    if timeline_path(recording_path).isfile():
+        timeline = WarpTimeline(timeline_path(recording_path))
+    schedule = WarpSchedule(load_calibration(warp_path), timeline,
+                            offset=offset)
+
+    capture = cv2.VideoCapture(str(video_path))
+    if not capture.isOpened():
+        raise IOError('Could not open video: %s' % video_path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    output_path.parent.makedirs_p()
+    tmp_path = partial_path(output_path)
+    writer = cv2.VideoWriter(str(tmp_path), cv2.VideoWriter_fourcc(*fourcc),
+                             fps, (width, height))
+    if not writer.isOpened():
+        capture.release()
+        raise IOError('Could not open output: %s' % tmp_path)
+
+    frames = 0
+    pending = 0
+    frame = None
+    rectified = None
+    calibration = None
+    try:
+        while True:
+            ok, frame = capture.read(frame)
+            if not ok:
+                break
+            calibration_i = schedule.at(frame_pts(capture, frames, fps))
+            if calibration_i is not calibration:
+                calibration = calibration_i
+                tables = cache.get(frame_homography(calibration,
+                                                    frame.shape),
+                                   frame.shape)
+            rectified = cv2.remap(frame, tables.map1, tables.map2,
+                                  cv2.INTER_LINEAR, dst=rectified,
+                                  borderMode=cv2.BORDER_CONSTANT)
+            writer.write(rectified)
+            frames += 1
+            pending += 1
+            if on_frames is not None and pending == frames_per_update:
+                on_frames(pending)
+                pending = 0
+    except:
+        writer.release()
+        capture.release()
+        if tmp_path.isfile():
+            tmp_path.remove()
+        raise
+    writer.release()
+    capture.release()
+    if on_frames is not None and pending:
+        on_frames(pending)
+    if os.name == 'nt' and output_path.exists():
+        output_path.remove()
+    os.rename(tmp_path, output_path)
+    result = {'video': str(video_path), 'warp': str(warp_path),
+              'output': str(output_path), 'frames': frames,
+              'seconds': time.time() - start,
+              'timeline': timeline is not None}
+    with open(done_path(output_path), 'w') as output:
+        json.dump(result, output)
+    return result
+
+
+def _init_worker(frame_counter):
+    global _frame_counter
+
+    _frame_counter = frame_counter
+
+
+def _count_frames(count):
+    with _frame_counter.get_lock():
+        _frame_counter.value += count
+
+
+def _run_job(job, fourcc='XVID'):
+    '''
+    Rectify a single job in a pool worker, returning a result `dict` (with an
+    `error` entry on failure, rather than raising).
+    '''
+    video_path, warp_path, output_path = job
+    try:
+        return rectify_video(video_path, warp_path, output_path,
+                             fourcc=fourcc,
+                             on_frames=_count_frames if _frame_counter
+                             is not None else None)
+    except Exception, exception:
+        return {'video': str(video_path), 'output': str(output_path),
+                'error': '%s: %s' % (exception.__class__.__name__,
+                                     exception),
+                'traceback': traceback.format_exc()}
+
+
+class _Job(object):
+    # Picklable `_run_job` partial (for `Pool.imap_unordered`).
+    def __init__(self, fourcc):
+        self.fourcc = fourcc
+
+    def __call__(self, job):
+        return _run_job(job, fourcc=self.fourcc)
+
+
+def run_batch(jobs, processes=None, fourcc='XVID', interval=2.,
+              on_result=None, on_progress=None):
+    '''
+    Rectify `jobs` (see `find_jobs`) across a process pool.
+
+    Arguments
+    ---------
+
+     - `processes`: Number of worker processes (default: one per CPU).
+     - `interval`: Seconds between calls to `on_progress`.
+     - `on_result`: Called as `on_result(result, completed)` as each job
+       completes (in completion order).
+     - `on_progress`: Called as `on_progress(frames, elapsed, completed)`
+       every `interval` seconds, where `frames` is the total number of frames
+       processed so far (including files still in progress).
+
+    Returns list of result `dict`s.
+    '''
+    if processes is None:
+        processes = cpu_count()
+    frame_counter = Value('L', 0)
+    pool = Pool(min(processes, len(jobs)) or 1, _init_worker,
+                (frame_counter, ))
+    start = time.time()
+    results = []
+    try:
+        iterator = pool.imap_unordered(_Job(fourcc), jobs)
+        while len(results) < len(jobs):
+            try:
+                result = iterator.next(timeout=interval)
+            except TimeoutError:
+                if on_progress is not None:
+                    on_progress(frame_counter.value, time.time() - start,
+                                len(results))
+                continue
+            results.append(result)
+            if on_result is not None:
+                on_result(result, len(results))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def parse_args(args=None):
+    """Parses arguments, returns (options, args)."""
+    from argparse import ArgumentParser
+
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description='Rectify recorded videos according '
+                            'to their stored warp calibrations.')
+    parser.add_argument('path', nargs='+', help='Video file or directory.')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='Output directory (default: next to each '
+                        'video).')
+    parser.add_argument('-s', '--suffix', default=DEFAULT_SUFFIX,
+                        help='Output name suffix (default: %(default)s).')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Worker processes (default: one per CPU).')
+    parser.add_argument('-c', '--fourcc', default='XVID',
+                        help='Output codec (default: %(default)s).')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Redo completed files.')
+    parser.add_argument('-i', '--interval', type=float, default=2.,
+                        help='Seconds between progress updates (default: '
+                        '%(default)s).')
+
+    return parser.parse_args(args)
+
+
+def main(args):
+    jobs, skipped = find_jobs(args.path, output_dir=args.output_dir,
+                              suffix=args.suffix, force=args.force)
+    for video_path, reason in skipped:
+        print 'Skipping %s (%s)' % (video_path, reason)
+    if not jobs:
+        print 'Nothing to do.'
+        return []
+    print 'Rectifying %d video(s)...' % len(jobs)
+    start = time.time()
+
+    def on_progress(frames, elapsed, completed):
+        print ('  %d/%d files, %d frames, %.1f frames/s' %
+               (completed, len(jobs), frames, frames / elapsed))
+
+    def on_result(result, completed):
+        if 'error' in result:
+            print '[%d/%d] FAILED %s: %s' % (completed, len(jobs),
+                                             result['video'], result['error'])
+        else:
+            print ('[%d/%d] %s -> %s (%d frames, %.1f frames/s)' %
+                   (completed, len(jobs), result['video'], result['output'],
+                    result['frames'], result['frames'] / result['seconds']))
+
+    results = run_batch(jobs, processes=args.processes, fourcc=args.fourcc,
+                        interval=args.interval, on_result=on_result,
+                        on_progress=on_progress)
+    elapsed = time.time() - start
+    frames = sum(r.get('frames', 0) for r in results)
+    failed = [r for r in results if 'error' in r]
+    print ('Done: %d succeeded, %d failed, %d frames in %.1f s (%.1f '
+           'frames/s).' % (len(results) - len(failed), len(failed), frames,
+                           elapsed, frames / elapsed))
+    return results
+
+
+if __name__ == '__main__':
+    results = main(parse_args())
+    if any('error' in r for r in results):
+        sys.exit(1)
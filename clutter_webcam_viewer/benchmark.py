@@ -0,0 +1,472 @@
+'''
+Hardware-free pipeline benchmarks.
+
+Pipelines are built from `videotestsrc` (see `create_video_source`) using
+synthetic device configurations, with a `fakesink` in place of the Clutter
+sink, such that benchmarks can run without a camera or a display.
+
+The `draw` and `record` cases run a `CapturePipeline`, with a recording
+branch attached (see `CapturePipeline.start_recording`) for `record`, i.e.,
+the same pipelines run by `PipelineManager`.
+
+Results are written as JSON, e.g.:
+
+    python -m clutter_webcam_viewer.benchmark -d 5 -o results.json
+
+To compare encode rate and CPU use of encoder profiles only:
+
+    python -m clutter_webcam_viewer.benchmark -c encoders -r 1280x720
+'''
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+import pandas as pd
+from path_helpers import path
+from webcam_recorder.caps import get_caps_str
+
+from .encoders import PROFILES, get_profile, select_profile
+from .pipeline_manager import (CapturePipeline, PipelineManager,
+                               add_first_buffer_probe)
+from .queues import DEFAULT_PRESET, PRESETS
+
+
+DEFAULT_RESOLUTIONS = ((320, 240), (640, 480), (1280, 720))
+CASES = ('draw', 'record', 'switch', 'encoders')
+
+
+def synthetic_device_configs(resolutions=DEFAULT_RESOLUTIONS, framerate=30,
+                             source='videotestsrc'):
+    '''
+    Return frame of `I420` device configurations (in the format returned by
+    `caps.get_device_configs()`) backed by `source` element factory.
+    '''
+    return pd.DataFrame([{'device': '%s-%dx%d' % (source, width, height),
+                          'source': source, 'format': 'I420',
+                          'width': width, 'height': height,
+                          'framerate_numerator': framerate,
+                          'framerate_denominator': 1,
+                          'framerate': float(framerate)}
+                         for width, height in resolutions])
+
+
+def create_sink():
+    '''
+    Create headless sink to stand in for the Clutter video sink.
+    '''
+    sink = Gst.ElementFactory.make('fakesink', None)
+    sink.set_property('enable-last-sample', False)
+    sink.set_property('qos', True)
+    return sink
+
+
+def cpu_time():
+    '''
+    Return user + system CPU time (in seconds) of this process.
+    '''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def thread_cpu_times():
+    '''
+    Return `dict` mapping the id of each thread of this process to its user
+    + system CPU time (in seconds), or `None` if not available (i.e., no
+    `/proc` file system).
+    '''
+    try:
+        thread_ids = os.listdir('/proc/self/task')
+    except OSError:
+        return None
+    tick = float(os.sysconf('SC_CLK_TCK'))
+    times = {}
+    for thread_id in thread_ids:
+        try:
+            with open('/proc/self/task/%s/stat' % thread_id, 'r') as input_:
+                # Thread name may contain spaces; fields follow the last `)`.
+                fields = input_.read().rsplit(')', 1)[1].split()
+        except IOError:
+            # Thread exited.
+            continue
+        # Fields 14 and 15 (`utime`, `stime`), in clock ticks.
+        times[int(thread_id)] = (int(fields[11]) + int(fields[12])) / tick
+    return times
+
+
+class BufferCounter(object):
+    '''
+    Count buffers passing through `pad` and measure latency, i.e., pipeline
+    running time when each buffer reaches the pad minus the buffer timestamp.
+    '''
+    def __init__(self, pipeline, pad):
+        self.pipeline = pipeline
+        self.count = 0
+        self.first_time = None
+        self.last_time = None
+        self.latency_sum = 0
+        self.latency_count = 0
+        self.latency_max = 0
+        pad.add_probe(Gst.PadProbeType.BUFFER, self.on_buffer)
+
+    def on_buffer(self, pad, info):
+        now = time.time()
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        self.count += 1
+        clock = self.pipeline.get_clock()
+        pts = info.get_buffer().pts
+        if clock is not None and pts != Gst.CLOCK_TIME_NONE:
+            latency = clock.get_time() - self.pipeline.get_base_time() - pts
+            self.latency_sum += latency
+            self.latency_count += 1
+            self.latency_max = max(self.latency_max, latency)
+        return Gst.PadProbeReturn.OK
+
+    def results(self, framerate=None):
+        '''
+        Return `dict` with buffer `count`, `throughput` (buffers/second),
+        latency (in seconds), and (if `framerate` is provided) the number of
+        `dropped` frames.
+        '''
+        results = {'count': self.count, 'throughput': None,
+                   'latency_mean': None, 'latency_max': None}
+        if self.count > 1:
+            duration = self.last_time - self.first_time
+            results['throughput'] = (self.count - 1) / duration
+            if framerate is not None:
+                expected = int(round(duration * framerate)) + 1
+                results['dropped'] = max(0, expected - self.count)
+        if self.latency_count:
+            results['latency_mean'] = (1e-9 * self.latency_sum /
+                                       self.latency_count)
+            results['latency_max'] = 1e-9 * self.latency_max
+        return results
+
+
+def _run_main_loop(duration, stop):
+    '''
+    Run main loop for `duration` seconds, then call `stop(callback)`, where
+    `callback` quits the main loop.
+    '''
+    loop = GLib.MainLoop()
+
+    def on_timeout():
+        stop(loop.quit)
+        return False
+
+    GLib.timeout_add(int(duration * 1000), on_timeout)
+    loop.run()
+
+
+def _pipeline_results(case, device_config, pipeline, start, duration,
+                      stop=None):
+    '''
+    Call `start(add_counter)`, run the main loop for `duration` seconds, then
+    call `stop(callback)` (default: `pipeline.stop`).
+
+    `add_counter(name, pad)` adds a `BufferCounter` on `pad`, whose results
+    are reported as `name`.
+    '''
+    framerate = (device_config['framerate_numerator'] /
+                 float(device_config['framerate_denominator']))
+    results = {'case': case, 'width': int(device_config['width']),
+               'height': int(device_config['height']),
+               'framerate': framerate, 'duration': duration}
+    counters = {}
+
+    def add_counter(name, pad):
+        counters[name] = BufferCounter(pipeline.pipeline, pad)
+
+    cpu_start = cpu_time()
+    start(add_counter)
+    _run_main_loop(duration, stop or pipeline.stop)
+    results['cpu_seconds'] = cpu_time() - cpu_start
+    for k, counter in counters.items():
+        results[k] = counter.results(framerate)
+    return results
+
+
+def benchmark_draw(device_config, duration=5., policies=DEFAULT_PRESET):
+    '''
+    Benchmark `CapturePipeline` without recording (source -> tee -> queue ->
+    sink).
+    '''
+    pipeline = CapturePipeline()
+    sink = create_sink()
+
+    def start(add_counter):
+        pipeline.run(device_config=device_config, sink=sink,
+                     policies=policies)
+        add_counter('sink', sink.get_static_pad('sink'))
+
+    return _pipeline_results('draw', device_config, pipeline, start,
+                             duration)
+
+
+def benchmark_record(device_config, duration=5., output_dir=None,
+                     extension='.avi', policies=DEFAULT_PRESET):
+    '''
+    Benchmark `CapturePipeline` with a recording branch (source -> tee ->
+    queue -> sink + queue -> encoder -> muxer -> file), with the specified
+    queue `policies` preset (see `queues.PRESETS`).
+
+    Recording starts once the first frame reaches the sink (i.e., as when
+    recording is started from the UI), using the encoder profile selected by
+    `PipelineManager`.  `encoder_cpu_seconds` is the CPU time of the threads
+    started by the recording branch (i.e., the branch streaming thread and
+    any encoder worker threads), or `None` if per-thread CPU time is not
+    available.
+    '''
+    remove_output_dir = output_dir is None
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix='clutter-webcam-benchmark-')
+    output_path = path(output_dir).joinpath('record' + extension)
+    profile = select_profile(device_config)
+    bitrate = profile.bitrate(device_config['height'])
+    pipeline = CapturePipeline()
+    sink = create_sink()
+    state = {'threads': None, 'encoder_cpu_seconds': None}
+
+    def start(add_counter):
+        pipeline.run(device_config=device_config, sink=sink,
+                     policies=policies)
+        add_counter('sink', sink.get_static_pad('sink'))
+
+        def start_recording():
+            state['threads'] = thread_cpu_times()
+            branch = pipeline.start_recording(output_path, bitrate=bitrate,
+                                              profile=profile)
+            add_counter('encoder', branch.encoder.get_static_pad('src'))
+            return False
+
+        add_first_buffer_probe(sink.get_static_pad('sink'),
+                               lambda timestamp:
+                               GLib.idle_add(start_recording))
+
+    def stop(callback):
+        before, after = state['threads'], thread_cpu_times()
+        if before is not None and after is not None:
+            state['encoder_cpu_seconds'] = sum(seconds for thread_id, seconds
+                                               in after.items()
+                                               if thread_id not in before)
+        # Finalize the recording, then stop the pipeline.
+        pipeline.stop_recording(callback=lambda: pipeline.stop(callback))
+
+    try:
+        results = _pipeline_results('record', device_config, pipeline, start,
+                                    duration, stop=stop)
+        results['output_bytes'] = (output_path.getsize()
+                                   if output_path.isfile() else 0)
+        results['queue_policy'] = policies
+        results['profile'] = profile.name
+        results['bitrate'] = bitrate
+        results['encoder_cpu_seconds'] = state['encoder_cpu_seconds']
+    finally:
+        if remove_output_dir:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+def benchmark_switch(device_configs, switches=6, dwell=1.):
+    '''
+    Benchmark config-switch latency through `PipelineManager.set_config`,
+    i.e., time from requesting a config to the first frame at the new sink.
+
+    Configurations are cycled in order, holding each for `dwell` seconds.
+    '''
+    manager = PipelineManager()
+    loop = GLib.MainLoop()
+    latencies = []
+    state = {'switch': 0}
+
+    def on_first_frame(requested, timestamp):
+        latencies.append(timestamp - requested)
+
+    def switch():
+        if state['switch'] >= switches:
+            manager.shutdown(callback=loop.quit)
+            return False
+        config = device_configs.iloc[state['switch'] % len(device_configs)]
+        state['switch'] += 1
+        requested = time.time()
+        manager.set_config(config, sink=create_sink(),
+                           on_first_frame=lambda t:
+                           on_first_frame(requested, t))
+        return True
+
+    cpu_start = cpu_time()
+    switch()
+    GLib.timeout_add(int(dwell * 1000), switch)
+    loop.run()
+    return {'case': 'switch', 'switches': switches,
+            'completed': len(latencies),
+            'cpu_seconds': cpu_time() - cpu_start,
+            'latency_mean': (sum(latencies) / len(latencies)
+                             if latencies else None),
+            'latency_max': max(latencies) if latencies else None,
+            'latencies': latencies}
+
+
+def benchmark_encoder(device_config, profile, frames=300):
+    '''
+    Encode `frames` test frames of the configured size as fast as possible
+    (i.e., not live) using an encoder profile.
+
+    Returns `dict` with encode rate (`fps`) and CPU time per frame.
+    '''
+    profile = get_profile(profile)
+    results = {'case': 'encoder', 'profile': profile.name,
+               'width': int(device_config['width']),
+               'height': int(device_config['height']),
+               'available': profile.is_available()}
+    if not results['available']:
+        return results
+
+    pipeline = Gst.Pipeline()
+    src = Gst.ElementFactory.make('videotestsrc', None)
+    src.set_property('num-buffers', frames)
+    filter_ = Gst.ElementFactory.make('capsfilter', None)
+    filter_.set_property('caps', Gst.Caps(get_caps_str(device_config)))
+    bitrate = profile.bitrate(device_config['height'])
+    encoder = profile.create_encoder(bitrate)
+    sink = create_sink()
+    sink.set_property('sync', False)
+    elements = (src, filter_, encoder, sink)
+    for element in elements:
+        pipeline.add(element)
+    for i, j in zip(elements[:-1], elements[1:]):
+        i.link(j)
+    counter = BufferCounter(pipeline, encoder.get_static_pad('src'))
+
+    loop = GLib.MainLoop()
+    bus = pipeline.get_bus()
+    bus.add_signal_watch()
+    errors = []
+
+    def on_error(bus, message):
+        errors.append(str(message.parse_error()[0]))
+        loop.quit()
+
+    bus.connect('message::eos', lambda *args: loop.quit())
+    bus.connect('message::error', on_error)
+
+    cpu_start = cpu_time()
+    start = time.time()
+    pipeline.set_state(Gst.State.PLAYING)
+    loop.run()
+    elapsed = time.time() - start
+    cpu_seconds = cpu_time() - cpu_start
+    pipeline.set_state(Gst.State.NULL)
+    bus.remove_signal_watch()
+
+    results.update({'frames': counter.count, 'bitrate': bitrate,
+                    'seconds': elapsed, 'fps': counter.count / elapsed,
+                    'cpu_seconds': cpu_seconds,
+                    'cpu_seconds_per_frame': (cpu_seconds / counter.count
+                                              if counter.count else None),
+                    'errors': errors})
+    return results
+
+
+def run_benchmarks(device_configs, duration=5., cases=CASES, switches=6,
+                   profiles=None, frames=300, policies=(DEFAULT_PRESET, )):
+    '''
+    Run benchmark cases and return machine-readable `dict` of results.
+    '''
+    Gst.init(None)
+    results = []
+    for i, device_config in device_configs.iterrows():
+        if 'draw' in cases:
+            results.append(benchmark_draw(device_config, duration=duration,
+                                          policies=policies[0]))
+        if 'record' in cases:
+            for policies_i in policies:
+                results.append(benchmark_record(device_config,
+                                                duration=duration,
+                                                policies=policies_i))
+        if 'encoders' in cases:
+            for profile in (profiles or PROFILES.keys()):
+                results.append(benchmark_encoder(device_config, profile,
+                                                 frames=frames))
+    if 'switch' in cases:
+        results.append(benchmark_switch(device_configs, switches=switches))
+    return {'timestamp': time.time(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'gstreamer': Gst.version_string(),
+            'results': results}
+
+
+def parse_args(args=None):
+    """Parses arguments, returns (options, args)."""
+    import sys
+    from argparse import ArgumentParser
+
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description='Benchmark webcam pipelines using a '
+                            'test video source.')
+    parser.add_argument('-d', '--duration', type=float, default=5.,
+                        help='Seconds to run each pipeline (default: '
+                        '%(default)s).')
+    parser.add_argument('-r', '--resolution', action='append', default=None,
+                        help='Resolution as `<width>x<height>` (may be '
+                        'repeated, default: %s).' %
+                        ', '.join('%dx%d' % r for r in DEFAULT_RESOLUTIONS))
+    parser.add_argument('-f', '--framerate', type=int, default=30)
+    parser.add_argument('-c', '--case', action='append', default=None,
+                        choices=CASES,
+                        help='Benchmark case (may be repeated, default: '
+                        'all).')
+    parser.add_argument('-n', '--switches', type=int, default=6,
+                        help='Number of config switches (default: '
+                        '%(default)s).')
+    parser.add_argument('-p', '--profile', action='append', default=None,
+                        choices=PROFILES.keys(), help='Encoder profile for '
+                        '`encoders` case (may be repeated, default: all).')
+    parser.add_argument('-q', '--queue-policy', action='append',
+                        default=None, choices=PRESETS.keys(),
+                        help='Queue policy preset for `record` case (may be '
+                        'repeated, default: %s).' % DEFAULT_PRESET)
+    parser.add_argument('--frames', type=int, default=300,
+                        help='Frames to encode per profile in `encoders` '
+                        'case (default: %(default)s).')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Output JSON path (default: stdout).')
+
+    return parser.parse_args(args)
+
+
+def main(args):
+    if args.resolution is None:
+        resolutions = DEFAULT_RESOLUTIONS
+    else:
+        resolutions = [map(int, r.split('x')) for r in args.resolution]
+    device_configs = synthetic_device_configs(resolutions,
+                                              framerate=args.framerate)
+    cases = args.case or CASES
+    results = run_benchmarks(device_configs, duration=args.duration,
+                             cases=cases, switches=args.switches,
+                             profiles=args.profile, frames=args.frames,
+                             policies=args.queue_policy or
+                             (DEFAULT_PRESET, ))
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print output
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    return results
+
+
+if __name__ == '__main__':
+    main(parse_args())
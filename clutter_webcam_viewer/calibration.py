@@ -0,0 +1,287 @@
+'''
+Read/write perspective warp calibrations.
+
+A calibration consists of the parent and child bounding boxes and the four
+parent/child corner correspondences of a `WarpActor`.
+
+Two file formats are supported, selected based on the file extension:
+
+ - `.h5`: HDF5 file with `/shape/parent`, `/shape/child`,
+   `/corners/parent`, and `/corners/child` tables (legacy format, written
+   using `pandas`).
+ - Any other extension (e.g., `.json`): Small JSON document, e.g.:
+
+       {"format": "warp-calibration", "version": 1,
+        "shape": {"parent": {"x": 0, "y": 0, "width": 640, "height": 480},
+                  "child": {...}},
+        "corners": {"parent": [[0, 0], [640, 0], [640, 480], [0, 480]],
+                    "child": [...]}}
+
+In both cases, files are written atomically (i.e., written to a temporary
+file, which is then renamed).
+'''
+from collections import OrderedDict, namedtuple
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+from path_helpers import path
+
+from .homography import find_homography_4pt
+
+
+FORMAT_NAME = 'warp-calibration'
+FORMAT_VERSION = 1
+HDF_EXTENSION = '.h5'
+# Extension of calibration file written next to each recording.
+SIDECAR_EXTENSION = '.warp.json'
+BBOX_KEYS = 'x', 'y', 'width', 'height'
+
+
+class WarpCalibration(namedtuple('WarpCalibration', 'parent_bbox child_bbox '
+                                 'parent_corners child_corners')):
+    '''
+    Attributes
+    ----------
+
+     - `parent_bbox`, `child_bbox`: `(4, )` arrays containing `x`, `y`,
+       `width`, and `height` of parent and child allocation, respectively.
+     - `parent_corners`, `child_corners`: `(4, 2)` arrays of corresponding
+       corners in parent and child coordinates, respectively.
+    '''
+    __slots__ = ()
+
+    def homography(self):
+        '''
+        Return 3x3 homography mapping child coordinates to parent coordinates.
+        '''
+        return find_homography_4pt(self.child_corners, self.parent_corners)
+
+
+def sidecar_path(video_path):
+    '''
+    Return path of calibration file to write next to a recorded video.
+    '''
+    video_path = path(video_path)
+    return video_path.parent.joinpath(video_path.namebase + SIDECAR_EXTENSION)
+
+
+def find_sidecar(video_path):
+    '''
+    Return path of existing calibration file next to a recorded video
+    (preferring the JSON sidecar over the legacy `.h5` sidecar), or `None`.
+    '''
+    video_path = path(video_path)
+    for candidate in (sidecar_path(video_path),
+                      video_path.parent.joinpath(video_path.namebase +
+                                                 HDF_EXTENSION)):
+        if candidate.isfile():
+            return candidate
+    return None
+
+
+_umask_lock = threading.Lock()
+
+
+def _get_umask():
+    '''
+    Return the current umask of the process.
+    '''
+    # `os.umask` can only be read by (temporarily) setting it for the whole
+    # process, so read it from `/proc` where available (Linux >= 4.7).
+    try:
+        with open('/proc/self/status', 'r') as input_:
+            for line in input_:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (IOError, ValueError):
+        pass
+    with _umask_lock:
+        umask = os.umask(0)
+        os.umask(umask)
+    return umask
+
+
+def _atomic_write(output_path, write):
+    '''
+    Call `write(tmp_path)` and rename the temporary file to `output_path`.
+
+    The file is given the default permissions of new files (i.e., `0666`
+    masked by the umask) rather than the `0600` of `tempfile.mkstemp`.
+    '''
+    output_path = path(output_path).abspath()
+    handle, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix=output_path.ext,
+                                        dir=output_path.parent)
+    os.close(handle)
+    try:
+        write(tmp_path)
+        os.chmod(tmp_path, 0666 & ~_get_umask())
+        if os.name == 'nt' and output_path.exists():
+            # `os.rename` does not replace existing files on Windows.
+            output_path.remove()
+        os.rename(tmp_path, output_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def to_json(calibration):
+    return json.dumps(OrderedDict([
+        ('format', FORMAT_NAME),
+        ('version', FORMAT_VERSION),
+        ('shape', OrderedDict([
+            (k, OrderedDict(zip(BBOX_KEYS,
+                                np.asarray(getattr(calibration, k + '_bbox'),
+                                           dtype=float).tolist())))
+            for k in ('parent', 'child')])),
+        ('corners', OrderedDict([
+            (k, np.asarray(getattr(calibration, k + '_corners'),
+                           dtype=float).tolist())
+            for k in ('parent', 'child')]))]))
+
+
+def from_json(data):
+    document = json.loads(data)
+    if document.get('format') != FORMAT_NAME:
+        raise ValueError('Not a warp calibration document.')
+    if document.get('version', 0) > FORMAT_VERSION:
+        raise ValueError('Unsupported warp calibration version: %s' %
+                         document['version'])
+    bboxes = [np.array([document['shape'][k][key] for key in BBOX_KEYS],
+                       dtype=float) for k in ('parent', 'child')]
+    corners = [np.array(document['corners'][k], dtype=float).reshape(4, 2)
+               for k in ('parent', 'child')]
+    return WarpCalibration(*(bboxes + corners))
+
+
+def save_json(warp_path, calibration):
+    data = to_json(calibration)
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as output:
+            output.write(data)
+    _atomic_write(warp_path, write)
+
+
+def load_json(warp_path):
+    with open(warp_path, 'r') as input_:
+        return from_json(input_.read())
+
+
+def save_hdf(warp_path, calibration):
+    import pandas as pd
+
+    def write(tmp_path):
+        # PyTables cannot append to the empty placeholder file.
+        os.remove(tmp_path)
+        common_settings = dict(format='table', data_columns=True,
+                               complib='zlib', complevel=6)
+        for k in ('parent', 'child'):
+            bbox = pd.Series(getattr(calibration, k + '_bbox'),
+                             index=list(BBOX_KEYS), name='bounding_box')
+            corners = pd.DataFrame(getattr(calibration, k + '_corners'),
+                                   columns=['x', 'y'])
+            bbox.to_hdf(tmp_path, '/shape/%s' % k, **common_settings)
+            corners.to_hdf(tmp_path, '/corners/%s' % k, **common_settings)
+    _atomic_write(warp_path, write)
+
+
+def load_hdf(warp_path):
+    import pandas as pd
+
+    warp_path = str(warp_path)
+    bboxes = [pd.read_hdf(warp_path, '/shape/%s' % k)[list(BBOX_KEYS)]
+              .values.astype(float) for k in ('parent', 'child')]
+    corners = [pd.read_hdf(warp_path, '/corners/%s' % k)[['x', 'y']]
+               .values.astype(float) for k in ('parent', 'child')]
+    return WarpCalibration(*(bboxes + corners))
+
+
+def save_calibration(warp_path, calibration):
+    '''
+    Write calibration to file (format is selected based on file extension).
+    '''
+    if path(warp_path).ext.lower() == HDF_EXTENSION:
+        save_hdf(warp_path, calibration)
+    else:
+        save_json(warp_path, calibration)
+
+
+def load_calibration(warp_path):
+    '''
+    Read calibration from file (format is selected based on file extension).
+    '''
+    if path(warp_path).ext.lower() == HDF_EXTENSION:
+        return load_hdf(warp_path)
+    else:
+        return load_json(warp_path)
+
+
+def load_calibrations(directory, patterns=('*' + SIDECAR_EXTENSION,
+                                           '*' + HDF_EXTENSION)):
+    '''
+    Read all calibration files matching any of `patterns` in `directory`.
+
+    Returns `OrderedDict` mapping each file path to its calibration, sorted by
+    path.  Files that cannot be read as calibrations are skipped.
+    '''
+    directory = path(directory)
+    warp_paths = sorted(set(p for pattern in patterns
+                            for p in directory.files(pattern)))
+    calibrations = OrderedDict()
+    for warp_path in warp_paths:
+        try:
+            calibrations[warp_path] = load_calibration(warp_path)
+        except Exception:
+            continue
+    return calibrations
+
+
+def benchmark(count=200):
+    '''
+    Compare mean time (in seconds) to write and read a calibration using the
+    JSON and HDF formats.
+    '''
+    import shutil
+    import time
+
+    corners = np.array([[0, 0], [640, 0], [640, 480], [0, 480]], dtype=float)
+    calibration = WarpCalibration(np.array([0, 0, 640, 480.]),
+                                  np.array([0, 0, 640, 480.]), corners + 10,
+                                  corners)
+    tmp_dir = path(tempfile.mkdtemp(prefix='warp-calibration-'))
+    results = {}
+    try:
+        for extension in (SIDECAR_EXTENSION, HDF_EXTENSION):
+            warp_path = tmp_dir.joinpath('warp' + extension)
+            try:
+                # Exclude one-time (i.e., import) cost.
+                save_calibration(warp_path, calibration)
+                load_calibration(warp_path)
+            except ImportError, exception:
+                print 'Skipping `%s` format: %s' % (extension, exception)
+                continue
+            runs = count if extension != HDF_EXTENSION else max(1, count // 10)
+            start = time.time()
+            for i in xrange(runs):
+                save_calibration(warp_path, calibration)
+            write_seconds = (time.time() - start) / runs
+            start = time.time()
+            for i in xrange(runs):
+                loaded = load_calibration(warp_path)
+            read_seconds = (time.time() - start) / runs
+            assert np.allclose(loaded.parent_corners, calibration.parent_corners)
+            results[extension] = {'write_seconds': write_seconds,
+                                  'read_seconds': read_seconds}
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    for extension, result in sorted(benchmark().items()):
+        print ('%-10s write %.2e s, read %.2e s' %
+               (extension, result['write_seconds'], result['read_seconds']))
@@ -0,0 +1,96 @@
+from gi.repository import Clutter
+
+
+class FrameCoalescer(object):
+    '''
+    Coalesce repeated update requests into at most one call of `callback` per
+    stage frame.
+
+    Requests only mark the update as pending (the caller is responsible for
+    writing the latest state somewhere `callback` can read it).  The pending
+    update is applied from a Clutter *pre-paint* repaint function, i.e., once
+    per frame, just before the stage is painted.
+
+    Arguments
+    ---------
+
+     - `callback`: Function called (without arguments) to apply the latest
+       pending state.
+     - `actor`: Optional actor to queue a redraw on when an update is
+       requested (ensures that the master clock schedules a frame).
+    '''
+    def __init__(self, callback, actor=None):
+        self.callback = callback
+        self.actor = actor
+        self._pending = False
+        self._repaint_id = None
+        self.reset_stats()
+
+    def start(self):
+        '''
+        Install pre-paint repaint function (no-op if already installed).
+        '''
+        if self._repaint_id is None:
+            self._repaint_id = Clutter.threads_add_repaint_func_full(
+                Clutter.RepaintFlags.PRE_PAINT, self._on_pre_paint)
+
+    def stop(self):
+        '''
+        Apply any pending update and remove the repaint function.
+        '''
+        if self._repaint_id is not None:
+            Clutter.threads_remove_repaint_func(self._repaint_id)
+            self._repaint_id = None
+        self.flush()
+
+    def request(self):
+        '''
+        Mark an update as pending, to be applied before the next frame.
+        '''
+        self.requested_count += 1
+        if not self._pending:
+            self._pending = True
+            if self._repaint_id is None:
+                self.start()
+            if self.actor is not None:
+                self.actor.queue_redraw()
+
+    def flush(self):
+        '''
+        Apply pending update (if any) immediately.
+        '''
+        if self._pending:
+            self._pending = False
+            self.applied_count += 1
+            self.callback()
+
+    def _on_pre_paint(self, *args):
+        self.flush()
+        # Keep repaint function installed.
+        return True
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def dropped_count(self):
+        '''
+        Number of requests that were superseded by a later request before
+        being applied.
+        '''
+        return self.requested_count - self.applied_count - int(self._pending)
+
+    def reset_stats(self):
+        # Count a still-pending update as requested (but not yet applied).
+        self.requested_count = int(self._pending)
+        self.applied_count = 0
+
+    def stats(self):
+        '''
+        Return `dict` with the number of `requested`, `applied`, and `dropped`
+        updates since the last call to `reset_stats`.
+        '''
+        return {'requested': self.requested_count,
+                'applied': self.applied_count,
+                'dropped': self.dropped_count}
@@ -0,0 +1,212 @@
+'''
+On-disk cache of video device configurations (i.e., capabilities).
+
+Probing the caps of every video device (see `caps.get_device_configs`) takes
+seconds.  Cached configurations are instead served immediately and
+revalidated by probing in a background thread.
+
+Cache entries are keyed by device path (e.g., `/dev/v4l/by-id/...`) and are
+only used while the identity of the device (device node, and USB vendor,
+product, and serial number read from `sysfs`, where available) is unchanged.
+'''
+import json
+import os
+import tempfile
+import threading
+
+from path_helpers import path
+
+
+CACHE_VERSION = 1
+
+
+def default_cache_path():
+    '''
+    Return default cache path (i.e.,
+    `$XDG_CACHE_HOME/clutter-webcam-viewer/devices.json`).
+    '''
+    root = os.environ.get('XDG_CACHE_HOME', path('~/.cache').expand())
+    return path(root).joinpath('clutter-webcam-viewer', 'devices.json')
+
+
+def _read_sysfs(sys_dir, name):
+    try:
+        with open(sys_dir.joinpath(name), 'r') as input_:
+            return input_.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def device_identity(device):
+    '''
+    Return `dict` identifying the hardware behind a video device path.
+
+    On Linux, includes the device node (e.g., `/dev/video0`), the V4L2 device
+    name, and (for USB devices) the vendor ID, product ID, and serial number.
+    '''
+    device = path(device)
+    identity = {'device': str(device)}
+    if not device.exists():
+        return identity
+    node = device.realpath()
+    identity['node'] = str(node)
+    sys_dir = path('/sys/class/video4linux').joinpath(node.name)
+    if not sys_dir.isdir():
+        return identity
+    identity['name'] = _read_sysfs(sys_dir, 'name')
+    # Walk up from the V4L2 device to the USB device (if any).
+    usb_dir = sys_dir.joinpath('device').realpath()
+    while usb_dir != usb_dir.parent and not usb_dir.joinpath('idVendor')\
+            .isfile():
+        usb_dir = usb_dir.parent
+    if usb_dir.joinpath('idVendor').isfile():
+        for key, name in (('vendor', 'idVendor'), ('product', 'idProduct'),
+                          ('serial', 'serial')):
+            identity[key] = _read_sysfs(usb_dir, name)
+    return identity
+
+
+def filter_device_configs(device_configs, format_='I420', min_framerate=10):
+    '''
+    Return configurations with the specified format and a framerate greater
+    than `min_framerate`.
+    '''
+    return device_configs[(device_configs.format == format_) &
+                          (device_configs.framerate > min_framerate)]
+
+
+def _to_json_table(df):
+    return json.loads(df.to_json(orient='split', index=False))
+
+
+def _from_json_table(table):
+    import pandas as pd
+
+    return pd.DataFrame(table['data'], columns=table['columns'])
+
+
+def probe_device_configs():
+    '''
+    Probe all devices (slow), see `caps.get_device_configs`.
+    '''
+    from webcam_recorder.caps import get_device_configs
+
+    return get_device_configs().reset_index(drop=True)
+
+
+class DeviceConfigCache(object):
+    '''
+    Arguments
+    ---------
+
+     - `cache_path`: Cache file path (default: `default_cache_path()`).
+     - `probe`: Function returning `pandas.DataFrame` of the configurations of
+       all connected devices (default: `probe_device_configs`).
+    '''
+    def __init__(self, cache_path=None, probe=probe_device_configs):
+        self.cache_path = (default_cache_path() if cache_path is None
+                           else path(cache_path))
+        self.probe = probe
+        self.revalidate_thread = None
+
+    def load(self):
+        '''
+        Return cached configurations of connected devices with unchanged
+        identity, or `None` if no connected device is cached.
+        '''
+        try:
+            with open(self.cache_path, 'r') as input_:
+                cache = json.load(input_)
+            if cache.get('version') != CACHE_VERSION:
+                return None
+            entries = cache['entries']
+        except Exception:
+            return None
+
+        from webcam_recorder.caps import get_video_sources
+
+        try:
+            devices = [str(d) for d in get_video_sources()]
+        except Exception:
+            return None
+        frames = [_from_json_table(entries[d]['configs']) for d in devices
+                  if d in entries and
+                  entries[d]['identity'] == device_identity(d)]
+        if not frames:
+            return None
+        import pandas as pd
+
+        return pd.concat(frames).reset_index(drop=True)
+
+    def save(self, device_configs):
+        '''
+        Atomically write cache entries for the specified configurations.
+        '''
+        entries = dict((device, {'identity': device_identity(device),
+                                 'configs': _to_json_table(df_i)})
+                       for device, df_i in
+                       device_configs.groupby('device', sort=False))
+        self.cache_path.parent.makedirs_p()
+        handle, tmp_path = tempfile.mkstemp(prefix='.tmp-',
+                                            dir=self.cache_path.parent)
+        try:
+            with os.fdopen(handle, 'w') as output:
+                json.dump({'version': CACHE_VERSION, 'entries': entries},
+                          output)
+            if os.name == 'nt' and self.cache_path.exists():
+                self.cache_path.remove()
+            os.rename(tmp_path, self.cache_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, on_changed=None, revalidate=True):
+        '''
+        Return device configurations.
+
+        If cached configurations are available, they are returned right away
+        and (if `revalidate` is `True`) devices are probed in a background
+        thread.  If the probed configurations differ from the cached ones,
+        the cache is updated and `on_changed(device_configs)` is called (from
+        the background thread).
+
+        Otherwise, devices are probed (blocking) and the cache is written.
+        '''
+        cached = self.load()
+        if cached is None:
+            device_configs = self.probe()
+            try:
+                self.save(device_configs)
+            except Exception:
+                # Caching is best-effort (e.g., read-only cache directory).
+                pass
+            return device_configs
+        if revalidate:
+            self.revalidate_thread = threading.Thread(target=self.revalidate,
+                                                      args=(cached,
+                                                            on_changed),
+                                                      name='device-cache')
+            self.revalidate_thread.daemon = True
+            self.revalidate_thread.start()
+        return cached
+
+    def revalidate(self, cached, on_changed=None):
+        '''
+        Probe devices, updating cache and calling `on_changed(device_configs)`
+        if configurations differ from `cached`.
+        '''
+        try:
+            device_configs = self.probe()
+        except Exception, exception:
+            print 'Error probing devices: %s' % exception
+            return
+        if (_to_json_table(device_configs.sort_index(axis=1)) ==
+                _to_json_table(cached.sort_index(axis=1))):
+            return
+        try:
+            self.save(device_configs)
+        except Exception:
+            pass
+        if on_changed is not None:
+            on_changed(device_configs)
@@ -0,0 +1,193 @@
+'''
+Encoder profiles for recording branches.
+
+Each profile describes an encoder element (and its properties), the muxers it
+can be written with (by output file extension), and a bitrate policy, i.e.,
+a scale factor applied to `caps.get_bitrate(height)`.
+
+The profile for a recording is `DEFAULT_PROFILE`, unless another profile is
+selected by the user (see `select_profile`).
+'''
+from collections import OrderedDict
+
+from gi.repository import Gst
+from path_helpers import path
+from webcam_recorder.caps import get_bitrate
+
+
+DEFAULT_PROFILE = 'mpeg4'
+
+
+class EncoderProfile(object):
+    '''
+    Arguments
+    ---------
+
+     - `name`: Profile name.
+     - `encoder`: Encoder element factory name.
+     - `muxers`: Ordered mapping from output file extension (e.g., `'.mp4'`)
+       to muxer element factory name.
+     - `properties`: Encoder properties.  String values are parsed using
+       `Gst.util_set_object_arg` (e.g., to set enum properties by nick).
+     - `bitrate_property`: Encoder bitrate property (or `None` if the encoder
+       is not bitrate-controlled, e.g., lossless).
+     - `bitrate_unit`: Bits/second per unit of `bitrate_property` (e.g.,
+       `1000` if the property is in kbit/s).
+     - `bitrate_factor`: Scale factor applied to `get_bitrate(height)`.
+     - `description`: Short description.
+    '''
+    def __init__(self, name, encoder, muxers, properties=None,
+                 bitrate_property='bitrate', bitrate_unit=1,
+                 bitrate_factor=1., description=''):
+        self.name = name
+        self.encoder = encoder
+        self.muxers = OrderedDict(muxers)
+        self.properties = OrderedDict(properties or {})
+        self.bitrate_property = bitrate_property
+        self.bitrate_unit = bitrate_unit
+        self.bitrate_factor = bitrate_factor
+        self.description = description
+
+    def __repr__(self):
+        return '<EncoderProfile %s (%s)>' % (self.name, self.encoder)
+
+    def with_properties(self, **properties):
+        '''
+        Return copy of profile with additional/overridden encoder properties,
+        e.g., `get_profile('x264').with_properties(threads=2)`.
+        '''
+        merged = self.properties.copy()
+        merged.update(properties)
+        return EncoderProfile(self.name, self.encoder, self.muxers,
+                              properties=merged,
+                              bitrate_property=self.bitrate_property,
+                              bitrate_unit=self.bitrate_unit,
+                              bitrate_factor=self.bitrate_factor,
+                              description=self.description)
+
+    def is_available(self):
+        '''
+        Return `True` if the encoder and at least one muxer are installed.
+        '''
+        return (Gst.ElementFactory.find(self.encoder) is not None and
+                any(Gst.ElementFactory.find(m) is not None
+                    for m in self.muxers.values()))
+
+    def supports(self, output_path):
+        return path(output_path).ext.lower() in self.muxers
+
+    def bitrate(self, height):
+        '''
+        Return target bitrate (in bits/second) for video of the specified
+        height, or `None` if the encoder is not bitrate-controlled.
+        '''
+        if self.bitrate_property is None:
+            return None
+        return int(get_bitrate(height) * self.bitrate_factor)
+
+    def create_encoder(self, bitrate=None):
+        encoder = Gst.ElementFactory.make(self.encoder, None)
+        if encoder is None:
+            raise ValueError('Encoder element not available: %s' %
+                             self.encoder)
+        for key, value in self.properties.items():
+            if isinstance(value, basestring):
+                Gst.util_set_object_arg(encoder, key, value)
+            else:
+                encoder.set_property(key, value)
+        if bitrate is not None and self.bitrate_property is not None:
+            encoder.set_property(self.bitrate_property,
+                                 int(bitrate // self.bitrate_unit))
+        return encoder
+
+    def create_muxer(self, output_path):
+        extension = path(output_path).ext.lower()
+        if extension not in self.muxers:
+            raise ValueError('Unsupported output file type for `%s` profile: '
+                             '%s (supported: %s)' %
+                             (self.name, extension,
+                              ', '.join(self.muxers.keys())))
+        return Gst.ElementFactory.make(self.muxers[extension], None)
+
+
+PROFILES = OrderedDict()
+
+
+def register_profile(profile):
+    PROFILES[profile.name] = profile
+    return profile
+
+
+def get_profile(name=None):
+    '''
+    Return registered profile (default: `DEFAULT_PROFILE`).
+    '''
+    if name is None:
+        name = DEFAULT_PROFILE
+    if isinstance(name, EncoderProfile):
+        return name
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError('Unknown encoder profile: %s (available: %s)' %
+                         (name, ', '.join(PROFILES.keys())))
+
+
+def select_profile(device_config=None, encoder=None):
+    '''
+    Return encoder profile for a recording.
+
+    The profile selected by the user is used, i.e., `encoder` (a profile or
+    profile name, e.g., from the `--encoder` command-line option) or else
+    the `encoder` entry of `device_config` (if any).  Otherwise,
+    `DEFAULT_PROFILE` is used.
+    '''
+    if encoder is None and device_config is not None:
+        name = device_config.get('encoder')
+        if isinstance(name, basestring) and name:
+            encoder = name
+    return get_profile(encoder)
+
+
+register_profile(EncoderProfile(
+    'mpeg4', 'avenc_mpeg4',
+    [('.mp4', 'mp4mux'), ('.avi', 'avimux'), ('.mkv', 'matroskamux')],
+    properties={'bitrate-tolerance': 500 << 10},
+    description='MPEG-4 part 2 (libav)'))
+register_profile(EncoderProfile(
+    'x264', 'x264enc',
+    [('.mp4', 'mp4mux'), ('.mkv', 'matroskamux'), ('.avi', 'avimux')],
+    properties=OrderedDict([('tune', 'zerolatency'),
+                            ('speed-preset', 'ultrafast'),
+                            # 0: automatic (i.e., based on CPU count).
+                            ('threads', 0),
+                            ('key-int-max', 60)]),
+    bitrate_unit=1000, bitrate_factor=.5,
+    description='H.264, low-latency ultrafast preset'))
+register_profile(EncoderProfile(
+    'vp8', 'vp8enc',
+    [('.webm', 'webmmux'), ('.mkv', 'matroskamux')],
+    properties=OrderedDict([('deadline', 1), ('cpu-used', 8),
+                            ('threads', 4), ('end-usage', 'cbr'),
+                            ('keyframe-max-dist', 60)]),
+    bitrate_property='target-bitrate', bitrate_factor=.75,
+    description='VP8, realtime'))
+register_profile(EncoderProfile(
+    'vp9', 'vp9enc',
+    [('.webm', 'webmmux'), ('.mkv', 'matroskamux')],
+    properties=OrderedDict([('deadline', 1), ('cpu-used', 8),
+                            ('threads', 4), ('end-usage', 'cbr'),
+                            ('keyframe-max-dist', 60)]),
+    bitrate_property='target-bitrate', bitrate_factor=.5,
+    description='VP9, realtime'))
+register_profile(EncoderProfile(
+    'mjpeg', 'jpegenc',
+    [('.avi', 'avimux'), ('.mkv', 'matroskamux'), ('.mov', 'qtmux')],
+    properties={'quality': 85}, bitrate_property=None,
+    description='Motion JPEG (intra-frame only)'))
+register_profile(EncoderProfile(
+    'ffv1', 'avenc_ffv1', [('.mkv', 'matroskamux'), ('.avi', 'avimux')],
+    bitrate_property=None, description='FFV1 (lossless)'))
+register_profile(EncoderProfile(
+    'raw', 'identity', [('.avi', 'avimux'), ('.mkv', 'matroskamux')],
+    bitrate_property=None, description='Raw video passthrough'))
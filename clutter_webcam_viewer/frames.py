@@ -0,0 +1,342 @@
+'''
+NumPy access to frames of a running pipeline.
+
+A `FrameBranch` (leaky queue -> [videoconvert -> capsfilter] -> appsink) is
+attached to the tee of a `CapturePipeline`.  Each buffer is mapped and exposed
+as a NumPy array over the mapped data (see `Frame` for when the bindings copy
+it) and stored in a fixed-size `FrameRingBuffer`, replacing the oldest frame
+once the ring is full.
+
+Frame lifetime is explicit: a frame (and its mapped buffer) stays alive until
+both the ring buffer and every consumer holding it have called `release()`.
+Since the branch queue is leaky and the appsink drops buffers, a slow consumer
+never slows down the display or recording branches; it only misses frames.
+
+__NB__ Holding many frames alive may exhaust the buffer pool of some sources
+(e.g., `v4l2src`).  Use a small ring buffer, release frames promptly, or use
+`copy=True`.
+'''
+from collections import deque
+import threading
+
+import numpy as np
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstVideo, GLib
+
+
+def video_info_from_caps(caps):
+    try:
+        return GstVideo.VideoInfo.new_from_caps(caps)
+    except AttributeError:
+        # GStreamer < 1.20
+        info = GstVideo.VideoInfo()
+        info.from_caps(caps)
+        return info
+
+
+def map_buffer(buffer, flags=Gst.MapFlags.READ):
+    '''
+    Map `buffer` and return its `Gst.MapInfo`.
+
+    Supports both return conventions of `Gst.Buffer.map`, i.e., an
+    `(ok, map_info)` tuple (plain introspection bindings) or the map info
+    itself (gst-python overrides).  Raises `RuntimeError` if the buffer
+    cannot be mapped.
+    '''
+    result = buffer.map(flags)
+    if isinstance(result, tuple):
+        ok, map_info = result
+    else:
+        map_info = result
+        ok = map_info is not None
+    if not ok:
+        raise RuntimeError('Error mapping buffer.')
+    return map_info
+
+
+class Frame(object):
+    '''
+    Mapped video frame.
+
+    Attributes
+    ----------
+
+     - `data`: 1D read-only `uint8` array of the mapped buffer data.  With the
+       plain introspection bindings, `MapInfo.data` is a `bytes` copy of the
+       mapped memory, so each frame is copied once.  With the gst-python
+       overrides, `MapInfo.data` exposes the mapped memory without copying.
+     - `pts`: Buffer timestamp (in nanoseconds).
+     - `sequence`: Frame number assigned by the ring buffer.
+     - `width`, `height`, `format`: Video frame size and format name.
+
+    The frame starts with a reference count of one.  Call `acquire()` to take
+    an additional reference and `release()` to drop one; the buffer is
+    unmapped once the count reaches zero.  Frames may also be used as context
+    managers, releasing on exit.
+    '''
+    def __init__(self, sample, copy=False):
+        self.buffer = sample.get_buffer()
+        self.info = video_info_from_caps(sample.get_caps())
+        self.pts = self.buffer.pts
+        self.sequence = None
+        self.width = self.info.width
+        self.height = self.info.height
+        self.format = self.info.finfo.name
+        self._lock = threading.Lock()
+        self._refcount = 1
+        self._map_info = map_buffer(self.buffer)
+        # `np.frombuffer` wraps `MapInfo.data` (no further copy).
+        self.data = np.frombuffer(self._map_info.data, dtype='uint8')
+        if copy:
+            self.data = self.data.copy()
+            self._unmap()
+
+    def _unmap(self):
+        if self._map_info is not None:
+            self.buffer.unmap(self._map_info)
+            self._map_info = None
+            self.buffer = None
+
+    def acquire(self):
+        with self._lock:
+            if self._refcount <= 0:
+                raise RuntimeError('Frame has been released.')
+            self._refcount += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._refcount -= 1
+            if self._refcount == 0:
+                # Arrays must not be used after this point.
+                self._unmap()
+
+    @property
+    def released(self):
+        return self._refcount <= 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def plane(self, index=0):
+        '''
+        Return `(rows, columns[, pixel_stride])` view of a plane, e.g., the Y
+        plane (`index=0`) of an `I420` frame, or the pixels of a `BGR` frame.
+        '''
+        finfo = self.info.finfo
+        components = [c for c in xrange(finfo.n_components)
+                      if finfo.plane[c] == index]
+        if not components:
+            raise IndexError('Frame has no plane %d.' % index)
+        component = components[0]
+        # Plane size, rounding up subsampled dimensions.
+        rows = -((-self.height) >> finfo.h_sub[component])
+        columns = -((-self.width) >> finfo.w_sub[component])
+        pixel_stride = finfo.pixel_stride[component]
+        stride = self.info.stride[index]
+        offset = self.info.offset[index]
+        plane = np.lib.stride_tricks.as_strided(self.data[offset:],
+                                                shape=(rows, columns,
+                                                       pixel_stride),
+                                                strides=(stride, pixel_stride,
+                                                         1))
+        return plane[:, :, 0] if pixel_stride == 1 else plane
+
+    @property
+    def array(self):
+        '''
+        View of the first plane (e.g., pixels of packed formats).
+        '''
+        return self.plane(0)
+
+
+class FrameRingBuffer(object):
+    '''
+    Fixed-size ring buffer of frames, dropping the oldest frame when full.
+
+    Thread-safe: frames are pushed from a streaming thread and read from any
+    number of consumer threads.
+    '''
+    def __init__(self, size=4):
+        self.size = size
+        self._frames = deque()
+        self._condition = threading.Condition()
+        self.pushed_count = 0
+        self.dropped_count = 0
+        self.closed = False
+
+    def push(self, frame):
+        with self._condition:
+            if self.closed:
+                frame.release()
+                return
+            frame.sequence = self.pushed_count
+            self.pushed_count += 1
+            self._frames.append(frame)
+            if len(self._frames) > self.size:
+                self._frames.popleft().release()
+                self.dropped_count += 1
+            self._condition.notify_all()
+
+    def latest(self, timeout=None, after=None):
+        '''
+        Return latest frame (acquired, i.e., the caller must release it), or
+        `None` if no frame is available within `timeout` seconds.
+
+        If `after` is provided, only frames with a greater sequence number are
+        returned.
+        '''
+        with self._condition:
+            def ready():
+                return self.closed or (self._frames and
+                                       (after is None or
+                                        self._frames[-1].sequence > after))
+
+            if not ready():
+                self._condition.wait(timeout)
+            if self.closed or not ready():
+                return None
+            return self._frames[-1].acquire()
+
+    def get(self, sequence, timeout=None):
+        '''
+        Return oldest available frame with sequence number at least
+        `sequence` (acquired), or `None` on timeout.  Frames dropped before
+        being read are skipped.
+        '''
+        with self._condition:
+            def find():
+                for frame in self._frames:
+                    if frame.sequence >= sequence:
+                        return frame
+
+            frame = find()
+            if frame is None and not self.closed:
+                self._condition.wait(timeout)
+                frame = find()
+            return None if frame is None else frame.acquire()
+
+    def frames(self, timeout=None):
+        '''
+        Iterate over frames in order until closed (or no frame arrives within
+        `timeout` seconds).
+
+        Each frame is released when the iteration advances, so frames needed
+        beyond one loop iteration must be `acquire()`d by the consumer.
+        '''
+        sequence = 0
+        while not self.closed:
+            frame = self.get(sequence, timeout=timeout)
+            if frame is None:
+                if timeout is not None:
+                    return
+                continue
+            try:
+                yield frame
+            finally:
+                frame.release()
+            sequence = frame.sequence + 1
+
+    def clear(self):
+        with self._condition:
+            while self._frames:
+                self._frames.popleft().release()
+
+    def close(self):
+        '''
+        Release all frames and wake up waiting consumers.
+        '''
+        with self._condition:
+            self.closed = True
+            self.clear()
+            self._condition.notify_all()
+
+
+class FrameBranch(object):
+    '''
+    Leaky queue -> [videoconvert -> capsfilter] -> appsink branch feeding a
+    `FrameRingBuffer`, which can be attached to (and detached from) the `tee`
+    of a running pipeline.
+
+    Arguments
+    ---------
+
+     - `ring_buffer`: Ring buffer to push frames to.
+     - `caps`: Optional caps string (e.g., `'video/x-raw,format=BGR'`) to
+       convert frames to.  By default, frames are passed through in the
+       pipeline format.
+     - `copy`: If `True`, copy each frame and release its buffer immediately.
+    '''
+    def __init__(self, ring_buffer, caps=None, copy=False):
+        self.ring_buffer = ring_buffer
+        self.copy = copy
+        self.queue = Gst.ElementFactory.make('queue', None)
+        # Drop frames rather than block the tee when consumers fall behind.
+        self.queue.set_property('leaky', 2)  # downstream (i.e., drop oldest)
+        self.queue.set_property('max-size-buffers', 1)
+        self.queue.set_property('max-size-bytes', 0)
+        self.queue.set_property('max-size-time', 0)
+        self.appsink = Gst.ElementFactory.make('appsink', None)
+        self.appsink.set_property('emit-signals', True)
+        self.appsink.set_property('sync', False)
+        self.appsink.set_property('max-buffers', 1)
+        self.appsink.set_property('drop', True)
+        self.appsink.connect('new-sample', self.on_new_sample)
+        self.elements = [self.queue]
+        if caps is not None:
+            convert = Gst.ElementFactory.make('videoconvert', None)
+            filter_ = Gst.ElementFactory.make('capsfilter', None)
+            filter_.set_property('caps', Gst.Caps.from_string(caps))
+            self.elements += [convert, filter_]
+        self.elements.append(self.appsink)
+        self.tee_pad = None
+        self.detached = threading.Event()
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        if sample is not None:
+            try:
+                self.ring_buffer.push(Frame(sample, copy=self.copy))
+            except RuntimeError, exception:
+                print 'Error reading frame: %s' % exception
+        return Gst.FlowReturn.OK
+
+    def attach(self, pipeline, tee):
+        self.pipeline = pipeline
+        self.tee = tee
+        for element in self.elements:
+            self.pipeline.add(element)
+        for i, j in zip(self.elements[:-1], self.elements[1:]):
+            i.link(j)
+        for element in self.elements[::-1]:
+            element.sync_state_with_parent()
+        self.tee_pad = tee.get_request_pad('src_%u')
+        self.tee_pad.link(self.queue.get_static_pad('sink'))
+
+    def detach(self, callback=None):
+        '''
+        Unlink branch from tee (once the tee pad is idle) and remove branch
+        elements from the pipeline (from the main loop), without blocking.
+        '''
+        def on_idle(pad, info):
+            pad.unlink(self.queue.get_static_pad('sink'))
+            GLib.idle_add(self._finish_detach, callback)
+            return Gst.PadProbeReturn.REMOVE
+
+        self.tee_pad.add_probe(Gst.PadProbeType.IDLE, on_idle)
+        return self.detached
+
+    def _finish_detach(self, callback):
+        for element in self.elements:
+            element.set_state(Gst.State.NULL)
+            self.pipeline.remove(element)
+        self.tee.release_request_pad(self.tee_pad)
+        self.detached.set()
+        if callback is not None:
+            callback()
+        return False
@@ -0,0 +1,311 @@
+'''
+Closed-form perspective transforms for exactly four point correspondences.
+
+For four points, the homography can be solved directly by composing the
+unit-square-to-quadrilateral projections of the source and destination
+corners (see Heckbert, "Fundamentals of Texture Mapping and Image Warping",
+1989), which avoids the general least-squares solver used by
+`cv2.findHomography`.
+
+The resulting 3x3 matrices are normalized such that `H[2, 2] == 1`, matching
+the output of `opencv_helpers.find_homography_array`, and the 4x4 matrices
+follow the layout of `opencv_helpers.cvwarp_mat_to_4x4`.
+'''
+import numpy as np
+
+
+def _square_to_quad(x0, y0, x1, y1, x2, y2, x3, y3):
+    '''
+    Return the 8 free coefficients `(a, b, c, d, e, f, g, h)` of the
+    projection mapping the unit square corners `(0, 0)`, `(1, 0)`, `(1, 1)`,
+    `(0, 1)` to the specified quadrilateral corners.
+
+    Arguments may be scalars or arrays (in which case, the projections are
+    computed element-wise).
+    '''
+    sx = x0 - x1 + x2 - x3
+    sy = y0 - y1 + y2 - y3
+    dx1 = x1 - x2
+    dx2 = x3 - x2
+    dy1 = y1 - y2
+    dy2 = y3 - y2
+    den = dx1 * dy2 - dx2 * dy1
+    g = (sx * dy2 - dx2 * sy) / den
+    h = (dx1 * sy - sx * dy1) / den
+    return (x1 - x0 + g * x1, x3 - x0 + h * x3, x0,
+            y1 - y0 + g * y1, y3 - y0 + h * y3, y0, g, h)
+
+
+# Triples of corner indices checked for collinearity.
+_TRIPLES = ((0, 1, 2), (0, 1, 3), (0, 2, 3), (1, 2, 3))
+# Minimum area of a corner triangle, relative to the squared extent of the
+# corners, for the corners to be considered non-collinear.
+COLLINEAR_TOLERANCE = 1e-9
+
+
+def _check_quad(x0, y0, x1, y1, x2, y2, x3, y3):
+    '''
+    Raise `ValueError` if three or more of the four points are collinear
+    (including coincident points).
+    '''
+    xs = (x0, x1, x2, x3)
+    ys = (y0, y1, y2, y3)
+    extent = max(max(xs) - min(xs), max(ys) - min(ys))
+    tolerance = COLLINEAR_TOLERANCE * extent * extent
+    for i, j, k in _TRIPLES:
+        area = ((xs[j] - xs[i]) * (ys[k] - ys[i]) -
+                (xs[k] - xs[i]) * (ys[j] - ys[i]))
+        if abs(area) <= tolerance:
+            raise ValueError('Degenerate corner configuration (collinear '
+                             'points).')
+
+
+def _degenerate(points):
+    '''
+    Return boolean array of shape `(...)`, `True` where three or more of the
+    four points of each `(..., 4, 2)` corner set are collinear.
+    '''
+    extent = (points.max(axis=-2) - points.min(axis=-2)).max(axis=-1)
+    tolerance = COLLINEAR_TOLERANCE * extent * extent
+    degenerate = np.zeros(points.shape[:-2], dtype=bool)
+    for i, j, k in _TRIPLES:
+        u = points[..., j, :] - points[..., i, :]
+        v = points[..., k, :] - points[..., i, :]
+        area = u[..., 0] * v[..., 1] - v[..., 0] * u[..., 1]
+        degenerate |= ~(np.abs(area) > tolerance)
+    return degenerate
+
+
+def _coords(points):
+    '''
+    Return the four `(x, y)` points as a flat list of 8 Python floats.
+    '''
+    return np.asarray(points, dtype=float).ravel().tolist()
+
+
+def _solve_4pt(src, dst):
+    '''
+    Return the 8 free coefficients `(m00, m01, m02, m10, m11, m12, m20, m21)`
+    of the homography mapping the four `src` points to the four `dst` points,
+    normalized such that `m22 == 1`.
+
+    Computation is done with Python floats, since per-element NumPy
+    operations are slower than scalar arithmetic for a single solve.
+    '''
+    src = _coords(src)
+    dst = _coords(dst)
+    _check_quad(*src)
+    _check_quad(*dst)
+    try:
+        # Unit square to source quad.
+        a, b, c, d, e, f, g, h = _square_to_quad(*src)
+        # Unit square to destination quad.
+        A, B, C, D, E, F, G, H = _square_to_quad(*dst)
+    except ZeroDivisionError:
+        raise ValueError('Degenerate corner configuration.')
+
+    # Adjugate (i.e., inverse up to scale) of source projection, mapping
+    # source quad to the unit square.
+    ia, ib, ic = e - f * h, c * h - b, b * f - c * e
+    id_, ie, if_ = f * g - d, a - c * g, c * d - a * f
+    ig, ih, ii = d * h - e * g, b * g - a * h, a * e - b * d
+
+    # Compose: source quad -> unit square -> destination quad.
+    m22 = G * ic + H * if_ + ii
+    if m22 == 0:
+        raise ValueError('Degenerate corner configuration.')
+    return ((A * ia + B * id_ + C * ig) / m22,
+            (A * ib + B * ie + C * ih) / m22,
+            (A * ic + B * if_ + C * ii) / m22,
+            (D * ia + E * id_ + F * ig) / m22,
+            (D * ib + E * ie + F * ih) / m22,
+            (D * ic + E * if_ + F * ii) / m22,
+            (G * ia + H * id_ + ig) / m22,
+            (G * ib + H * ie + ih) / m22)
+
+
+def find_homography_4pt(src, dst):
+    '''
+    Return 3x3 homography matrix mapping the four `src` points to the four
+    `dst` points.
+
+    Arguments
+    ---------
+
+     - `src`: Source points as a sequence of four `(x, y)` pairs (e.g., a
+       `(4, 2)` array).
+     - `dst`: Destination points as a sequence of four `(x, y)` pairs.
+
+    Raises `ValueError` if three or more of the `src` or `dst` points are
+    collinear.
+    '''
+    m00, m01, m02, m10, m11, m12, m20, m21 = _solve_4pt(src, dst)
+    return np.array([[m00, m01, m02], [m10, m11, m12], [m20, m21, 1.]])
+
+
+def homography_to_4x4(homography, out=None):
+    '''
+    Write 3x3 `homography` into a 4x4 Cogl-compatible transform matrix.
+
+    If `out` is provided, it must be a `(4, 4)` array and it is filled in
+    place, allowing the same buffer to be reused across calls.
+    '''
+    if out is None:
+        out = np.empty((4, 4), dtype='float32')
+    out.fill(0)
+    out[:2, :2] = homography[:2, :2]
+    out[:2, 3] = homography[:2, 2]
+    out[3, :2] = homography[2, :2]
+    out[2, 2] = 1
+    out[3, 3] = 1
+    return out
+
+
+def find_transform_4x4(src, dst, out=None):
+    '''
+    Return 4x4 Cogl-compatible transform matrix mapping the four `src` points
+    to the four `dst` points.
+
+    Equivalent to:
+
+        cvwarp_mat_to_4x4(find_homography_array(src, dst))
+
+    If `out` is provided, the result is written to it in place and no
+    intermediate arrays are allocated.
+    '''
+    m00, m01, m02, m10, m11, m12, m20, m21 = _solve_4pt(src, dst)
+    if out is None:
+        out = np.empty((4, 4), dtype='float32')
+    out.flat[:] = (m00, m01, 0, m02,
+                   m10, m11, 0, m12,
+                   0, 0, 1, 0,
+                   m20, m21, 0, 1)
+    return out
+
+
+def find_homographies(src, dst):
+    '''
+    Batched version of `find_homography_4pt`.
+
+    Arguments
+    ---------
+
+     - `src`: Source corner sets, as an array of shape `(..., 4, 2)`.
+     - `dst`: Destination corner sets, as an array of shape `(..., 4, 2)`.
+
+    Returns an array of shape `(..., 3, 3)`.  The matrices corresponding to
+    degenerate corner sets are filled with `nan`.
+    '''
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    src, dst = np.broadcast_arrays(src, dst)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a, b, c, d, e, f, g, h = _square_to_quad(*[src[..., i, j]
+                                                   for i in xrange(4)
+                                                   for j in xrange(2)])
+        A, B, C, D, E, F, G, H = _square_to_quad(*[dst[..., i, j]
+                                                   for i in xrange(4)
+                                                   for j in xrange(2)])
+
+        result = np.empty(src.shape[:-2] + (3, 3))
+        adjugate = np.empty_like(result)
+        adjugate[..., 0, 0] = e - f * h
+        adjugate[..., 0, 1] = c * h - b
+        adjugate[..., 0, 2] = b * f - c * e
+        adjugate[..., 1, 0] = f * g - d
+        adjugate[..., 1, 1] = a - c * g
+        adjugate[..., 1, 2] = c * d - a * f
+        adjugate[..., 2, 0] = d * h - e * g
+        adjugate[..., 2, 1] = b * g - a * h
+        adjugate[..., 2, 2] = a * e - b * d
+
+        projection = np.empty_like(result)
+        projection[..., 0, :] = np.stack([A, B, C], axis=-1)
+        projection[..., 1, :] = np.stack([D, E, F], axis=-1)
+        projection[..., 2, :] = np.stack([G, H, np.ones_like(G)], axis=-1)
+
+        np.matmul(projection, adjugate, out=result)
+        result /= result[..., 2:, 2:]
+    result[_degenerate(src) | _degenerate(dst)] = np.nan
+    return result
+
+
+def find_transforms_4x4(src, dst, out=None):
+    '''
+    Batched version of `find_transform_4x4`.
+
+    Returns an array of shape `(..., 4, 4)` (or fills `out`, if provided).
+    '''
+    homographies = find_homographies(src, dst)
+    if out is None:
+        out = np.zeros(homographies.shape[:-2] + (4, 4), dtype='float32')
+    out[...] = 0
+    out[..., :2, :2] = homographies[..., :2, :2]
+    out[..., :2, 3] = homographies[..., :2, 2]
+    out[..., 3, :2] = homographies[..., 2, :2]
+    out[..., 2, 2] = 1
+    out[..., 3, 3] = 1
+    return out
+
+
+def _random_corners(count, scale=640., jitter=.2, seed=0):
+    '''
+    Return `(count, 4, 2)` array of randomly perturbed rectangle corners.
+    '''
+    random = np.random.RandomState(seed)
+    rectangle = scale * np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=float)
+    offsets = random.uniform(-jitter * scale, jitter * scale,
+                             size=(count, 4, 2))
+    return rectangle + offsets
+
+
+def benchmark(count=1000, repeat=3):
+    '''
+    Compare accuracy and speed of the closed-form solver against
+    `opencv_helpers.find_homography_array` + `cvwarp_mat_to_4x4`.
+
+    Returns a `dict` containing the maximum error (relative to the largest
+    matrix coefficient) of each closed-form method with respect to OpenCV and
+    the mean time per solve (in seconds) for each method.
+    '''
+    import timeit
+    from opencv_helpers import find_homography_array, cvwarp_mat_to_4x4
+
+    src = _random_corners(count, seed=0)
+    dst = _random_corners(count, seed=1)
+    out = np.identity(4, dtype='float32')
+
+    reference = np.array([cvwarp_mat_to_4x4(find_homography_array(s, d))
+                          for s, d in zip(src, dst)])
+    closed_form = find_transforms_4x4(src, dst)
+    single = np.array([find_transform_4x4(s, d).copy()
+                       for s, d in zip(src, dst)])
+
+    def run_opencv():
+        for s, d in zip(src, dst):
+            cvwarp_mat_to_4x4(find_homography_array(s, d))
+
+    def run_single():
+        for s, d in zip(src, dst):
+            find_transform_4x4(s, d, out=out)
+
+    def run_batched():
+        find_transforms_4x4(src, dst)
+
+    scale = np.abs(reference).max(axis=(1, 2))[:, None, None]
+    results = {'count': count,
+               'max_relative_error_single':
+               float((np.abs(single - reference) / scale).max()),
+               'max_relative_error_batched':
+               float((np.abs(closed_form - reference) / scale).max())}
+    for name, f in (('opencv', run_opencv), ('single', run_single),
+                    ('batched', run_batched)):
+        results['seconds_per_solve_%s' % name] = \
+            min(timeit.repeat(f, number=1, repeat=repeat)) / count
+    return results
+
+
+if __name__ == '__main__':
+    for k, v in sorted(benchmark().items()):
+        print '%-32s %s' % (k, v)
@@ -0,0 +1,404 @@
+'''
+Concurrent capture from several cameras on a shared Clutter stage.
+
+Each `Camera` has its own pipeline actor, warp actor, pipeline manager, and
+recording state.  `MultiCameraManager` lays out the cameras as tiles on a
+shared stage and coordinates startup, shutdown, and recording across all
+cameras.
+
+`show_cameras` displays (and optionally records) every connected camera,
+e.g.:
+
+    python -m clutter_webcam_viewer --multi-camera [--record-dir <dir>]
+'''
+from collections import OrderedDict
+import threading
+import time
+
+from gi.repository import Clutter, GLib
+from path_helpers import path
+
+from .calibration import sidecar_path
+from .pipeline import PipelineActor
+from .pipeline_manager import DEFAULT_STOP_TIMEOUT, PipelineManager
+from .stats import StatsTimer
+from .timeline import WarpTimelineRecorder
+from .warp import WarpActor
+
+
+class CountdownCallback(object):
+    '''
+    Call `callback(results)` (from the main loop) once `arrive(key, value)`
+    has been called for each of `keys`, where `results` is an `OrderedDict`
+    mapping each key to its value.
+
+    `arrive` may be called from any thread.
+    '''
+    def __init__(self, keys, callback):
+        self.results = OrderedDict((k, None) for k in keys)
+        self.remaining = set(self.results)
+        self.callback = callback
+        self._lock = threading.Lock()
+        if not self.remaining:
+            self._done()
+
+    def arrive(self, key, value=None):
+        with self._lock:
+            if key not in self.remaining:
+                return
+            self.results[key] = value
+            self.remaining.remove(key)
+            done = not self.remaining
+        if done:
+            self._done()
+
+    def _done(self):
+        if self.callback is not None:
+            GLib.idle_add(lambda: self.callback(self.results) and False)
+
+
+class Camera(object):
+    '''
+    Single capture device with its own actors, pipeline, and recording state.
+
+    Arguments
+    ---------
+
+     - `name`: Camera name (used, e.g., to name recorded files).
+     - `device_config`: Configuration dictionary or a `pandas.Series` in the
+       format of a row of a frame returned by `caps.get_device_configs()`.
+     - `segment_policy`: If set, recordings are split into segment files
+       (see `segments.SegmentPolicy`).
+     - `encoder`: Encoder profile (or profile name) of recordings (default:
+       `encoders.DEFAULT_PROFILE`).
+    '''
+    def __init__(self, name, device_config, stop_timeout=DEFAULT_STOP_TIMEOUT,
+                 policies=None, segment_policy=None, encoder=None):
+        self.name = name
+        self.device_config = device_config
+        self.pipeline_actor = PipelineActor(device=device_config['device'])
+        self.warp_actor = WarpActor(self.pipeline_actor)
+        self.pipeline_actor.connect('allocation-changed', lambda *args:
+                                    self.warp_actor.fit_child_to_parent())
+        self.manager = PipelineManager(stop_timeout=stop_timeout,
+                                       policies=policies)
+        self.manager.segment_policy = segment_policy
+        self.manager.encoder = encoder
+        self.warp_timeline = \
+            WarpTimelineRecorder(self.warp_actor, self.manager.recording_time)
+        self.warp_actor.on_transform_changed = \
+            self.warp_timeline.on_transform_changed
+
+    @property
+    def record_path(self):
+        return self.manager.record_path
+
+    def start(self, on_first_frame=None):
+        '''
+        Start pipeline (without blocking).
+
+        If provided, `on_first_frame(timestamp)` is called (from a streaming
+        thread) when the first frame reaches the display sink.
+        '''
+        self.manager.set_config(self.device_config,
+                                sink=self.pipeline_actor.create_sink,
+                                on_first_frame=on_first_frame)
+
+    def set_record_path(self, record_path, on_first_frame=None,
+                        on_finalized=None):
+        '''
+        Start/stop recording (without blocking, see
+        `PipelineManager.set_record_path`).
+
+        If the pipeline is not running, it is started when recording starts.
+        '''
+        if record_path is not None and self.warp_actor.state.initialized:
+            self.warp_actor.save(sidecar_path(record_path),
+                                 tables=self.manager.rectifier is not None)
+        self.warp_timeline.set_record_path(record_path)
+        if self.manager.pipeline is not None:
+            self.manager.set_record_path(record_path,
+                                         on_first_frame=on_first_frame,
+                                         on_finalized=on_finalized)
+            return
+        if record_path is not None:
+            self.manager.set_config(self.device_config,
+                                    record_path=record_path,
+                                    sink=self.pipeline_actor.create_sink,
+                                    on_first_frame=on_first_frame)
+        elif on_first_frame is not None:
+            on_first_frame(time.time())
+        if on_finalized is not None:
+            on_finalized()
+
+    def stop(self, callback=None):
+        '''
+        Stop pipeline (without blocking), finalizing any active recording.
+        '''
+        self.warp_timeline.set_record_path(None)
+        self.manager.shutdown(callback=callback)
+
+
+class MultiCameraManager(object):
+    '''
+    Run one pipeline per camera, with the cameras tiled on a shared stage.
+
+    Arguments
+    ---------
+
+     - `stage`: Clutter stage.
+     - `device_configs`: Ordered mapping from camera name to device
+       configuration, or a `pandas.DataFrame` with one row per camera (named
+       `camera<i>`).
+     - `columns`: Number of tile columns (default: square-ish grid).
+     - `spacing`: Spacing between tiles (in pixels).
+     - `policies`: Queue policies of every camera (see `PipelineManager`).
+     - `segment_policy`, `encoder`: Segment policy and encoder profile of
+       every camera (see `Camera`).
+    '''
+    def __init__(self, stage, device_configs, columns=None, spacing=4,
+                 stop_timeout=DEFAULT_STOP_TIMEOUT, policies=None,
+                 segment_policy=None, encoder=None):
+        if hasattr(device_configs, 'iterrows'):
+            device_configs = OrderedDict(('camera%d' % i, config)
+                                         for i, (j, config) in
+                                         enumerate(device_configs.iterrows()))
+        self.stage = stage
+        self.cameras = OrderedDict((name, Camera(name, config,
+                                                 stop_timeout=stop_timeout,
+                                                 policies=policies,
+                                                 segment_policy=
+                                                 segment_policy,
+                                                 encoder=encoder))
+                                   for name, config in device_configs.items())
+        if columns is None:
+            columns = int(len(self.cameras) ** .5 + .999) or 1
+        self.columns = columns
+
+        layout = Clutter.GridLayout()
+        layout.set_row_homogeneous(True)
+        layout.set_column_homogeneous(True)
+        layout.set_row_spacing(spacing)
+        layout.set_column_spacing(spacing)
+        self.group = Clutter.Actor()
+        self.group.set_layout_manager(layout)
+        for i, camera in enumerate(self.cameras.values()):
+            camera.warp_actor.set_x_expand(True)
+            camera.warp_actor.set_y_expand(True)
+            camera.warp_actor.set_clip_to_allocation(True)
+            layout.attach(camera.warp_actor, i % columns, i // columns, 1, 1)
+        self.stage.add_actor(self.group)
+        self.group.add_constraint(Clutter.BindConstraint
+                                  .new(self.stage,
+                                       Clutter.BindCoordinate.SIZE, 0))
+        self._stats_timers = []
+
+    def start(self, callback=None):
+        '''
+        Start all camera pipelines (without blocking).
+
+        If provided, `callback(first_frames)` is called (from the main loop)
+        once every camera has displayed its first frame, where `first_frames`
+        maps each camera name to the (wall-clock) time of its first frame.
+        '''
+        countdown = CountdownCallback(self.cameras, callback)
+        for name, camera in self.cameras.items():
+            camera.start(on_first_frame=lambda t, name=name:
+                         countdown.arrive(name, t))
+        return countdown
+
+    def record_paths(self, output_dir, prefix='', extension='.avi'):
+        '''
+        Return mapping from camera name to output path
+        `<output_dir>/<prefix><name><extension>`.
+        '''
+        output_dir = path(output_dir)
+        return OrderedDict((name, output_dir.joinpath(prefix + name +
+                                                      extension))
+                           for name in self.cameras)
+
+    def start_recording(self, record_paths, callback=None):
+        '''
+        Start recording on all cameras (without blocking).
+
+        Arguments
+        ---------
+
+         - `record_paths`: Mapping from camera name to output path (see
+           `record_paths`).  Cameras without a path stop recording.
+         - `callback`: Called as `callback(first_frames)` (from the main loop)
+           once the first frame of every camera has entered its recording
+           branch.  Comparing `first_frames` times gives the start skew
+           between cameras.
+        '''
+        countdown = CountdownCallback(self.cameras, callback)
+        for name, camera in self.cameras.items():
+            camera.set_record_path(record_paths.get(name),
+                                   on_first_frame=lambda t, name=name:
+                                   countdown.arrive(name, t))
+        return countdown
+
+    def stop_recording(self, callback=None):
+        '''
+        Stop recording on all cameras (without blocking).
+
+        `callback(results)` is called (from the main loop) once the recordings
+        of all cameras have been finalized, where `results` is keyed by camera
+        name.
+        '''
+        countdown = CountdownCallback(self.cameras, callback)
+        for name, camera in self.cameras.items():
+            camera.set_record_path(None, on_finalized=lambda name=name:
+                                   countdown.arrive(name))
+        return countdown
+
+    def stop(self, callback=None):
+        '''
+        Stop all camera pipelines (without blocking).
+
+        `callback(results)` is called (from the main loop) once all pipelines
+        have stopped, where `results` is keyed by camera name.
+        '''
+        self.disable_stats()
+        countdown = CountdownCallback(self.cameras, callback)
+        for name, camera in self.cameras.items():
+            camera.stop(callback=lambda name=name: countdown.arrive(name))
+        return countdown
+
+    def enable_stats(self, callback=None, interval=1.):
+        '''
+        Collect statistics for all cameras (see
+        `PipelineManager.enable_stats`).
+
+        If provided, `callback(snapshots)` is called every `interval` seconds,
+        where `snapshots` is the return value of `stats_snapshot`.
+        '''
+        for camera in self.cameras.values():
+            camera.manager.enable_stats()
+        if callback is not None:
+            timer = StatsTimer(self.stats_snapshot, callback,
+                               interval=interval)
+            self._stats_timers.append(timer)
+            return timer
+
+    def disable_stats(self):
+        for timer in self._stats_timers:
+            timer.stop()
+        self._stats_timers = []
+        for camera in self.cameras.values():
+            camera.manager.disable_stats()
+
+    def stats_snapshot(self):
+        '''
+        Return `OrderedDict` mapping each camera name to its statistics
+        snapshot (see `PipelineManager.stats_snapshot`).
+        '''
+        return OrderedDict((name, camera.manager.stats_snapshot())
+                           for name, camera in self.cameras.items())
+
+
+def format_stats(snapshots):
+    '''
+    Return per-camera summary table (as text) of stats snapshots returned by
+    `MultiCameraManager.stats_snapshot`.
+    '''
+    lines = ['%-10s %8s %8s %10s %8s %8s %10s' % ('camera', 'src fps',
+                                                 'disp fps', 'latency ms',
+                                                 'dropped', 'rec drop',
+                                                 'enc fps')]
+    for name, snapshot in snapshots.items():
+        if snapshot is None:
+            lines.append('%-10s %8s' % (name, '-'))
+            continue
+        pads = snapshot['pads']
+
+        def value(pad, key, scale=1.):
+            v = pads.get(pad, {}).get(key)
+            return '-' if v is None else '%.1f' % (scale * v)
+
+        dropped = sum(qos.get('dropped', 0)
+                      for qos in snapshot['qos'].values())
+        # Frames dropped by the (leaky) recording queue, see `queues`.
+        record_queue = snapshot['queues'].get('record_queue')
+        record_dropped = ('-' if record_queue is None
+                          else '%d' % record_queue['dropped'])
+        lines.append('%-10s %8s %8s %10s %8d %8s %10s' %
+                     (name, value('source', 'rate'),
+                      value('display_sink', 'rate'),
+                      value('display_sink', 'latency_mean', 1e3), dropped,
+                      record_dropped, value('encoder.src', 'rate')))
+    return '\n'.join(lines)
+
+
+def show_cameras(device_configs=None, policies=None, segment_policy=None,
+                 record_dir=None, stats_interval=2., size=(1280, 720),
+                 encoder=None):
+    '''
+    Display the first configuration of every device on a Clutter stage and
+    print stats every `stats_interval` seconds (if set).
+
+    Blocks until the stage is closed.
+
+    Arguments
+    ---------
+
+     - `device_configs`: Device configurations (default: cached or probed
+       configurations of connected devices, see `device_cache`).
+     - `policies`, `segment_policy`, `encoder`: See `MultiCameraManager`.
+     - `record_dir`: If set, every camera is recorded to
+       `<record_dir>/<timestamp>-<camera name>.avi` once all cameras have
+       started.  Recordings are finalized when the stage is closed.
+
+    Returns `MultiCameraManager`.
+    '''
+    from gi.repository import Gst
+    from .device_cache import DeviceConfigCache, filter_device_configs
+
+    Gst.init(None)
+    Clutter.init(None)
+
+    if device_configs is None:
+        device_configs = filter_device_configs(DeviceConfigCache().get())
+    device_configs = device_configs.groupby('device').first().reset_index()
+
+    stage = Clutter.Stage()
+    stage.set_size(*size)
+    cameras = MultiCameraManager(stage, device_configs, policies=policies,
+                                 segment_policy=segment_policy,
+                                 encoder=encoder)
+
+    def on_started(first_frames):
+        print 'All cameras started: %s' % ', '.join(first_frames)
+        if record_dir is not None:
+            prefix = time.strftime('%Y-%m-%dT%Hh%Mm%S-')
+            cameras.start_recording(cameras.record_paths(record_dir,
+                                                         prefix=prefix))
+
+    def on_delete(*args):
+        # Finalize any recordings before quitting (and keep the stage, which
+        # the pipelines render to, until they have stopped).
+        cameras.stop(lambda results: Clutter.main_quit())
+        return True
+
+    stage.connect('delete-event', on_delete)
+    cameras.start(on_started)
+
+    if stats_interval:
+        def print_stats(snapshots):
+            print format_stats(snapshots)
+
+        cameras.enable_stats(print_stats, interval=stats_interval)
+    stage.show()
+    Clutter.main()
+    return cameras
+
+
+if __name__ == '__main__':
+    '''
+    Display (and print stats for) the first I420 configuration of every
+    connected camera.
+    '''
+    import gi
+    gi.require_version('Gst', '1.0')
+
+    show_cameras()
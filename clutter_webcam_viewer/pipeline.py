@@ -1,18 +1,16 @@
-import pandas as pd
-import numpy as np
-import gi
-gi.require_version('Gst', '1.0')
-from gi.repository import GObject, Gst, Gdk, GstVideo, GLib
-from gi.repository import ClutterGst, Clutter
-import cogl_helpers as ch
-from opencv_helpers import (get_map_array, find_homography_array,
-                            cvwarp_mat_to_4x4)
+from gi.repository import Clutter
 
 
-rand_rgb = lambda: np.concatenate([np.random.randint(255, size=3), [0]])
+def rand_rgb():
+    import numpy as np
+
+    return np.concatenate([np.random.randint(255, size=3), [0]])
 
 
 def aspect_fit(actor, allocation, flags, bbox):
+    import pandas as pd
+    from svg_model import scale_to_fit_a_in_b
+
     actor_shape = pd.Series(allocation.get_size(), index=['width', 'height'])
     actor_scale = .9 * scale_to_fit_a_in_b(bbox[['width', 'height']],
                                            actor_shape)
@@ -37,3 +35,15 @@ class PipelineActor(Clutter.Group):
 
     def on_size_change(self, texture, width, height):
         self.set_size(width, height)
+
+    def create_sink(self):
+        '''
+        Return new display sink element rendering to the texture of the
+        actor.
+        '''
+        from gi.repository import ClutterGst
+
+        sink = ClutterGst.VideoSink.new(self.texture)
+        sink.set_property('sync', True)
+        sink.set_property('qos', True)
+        return sink
@@ -1,90 +1,398 @@
+import threading
 import time
-from threading import Thread
 
 import gi
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst, GstVideo
-from path_helpers import path
+from gi.repository import Gst, GstVideo, GLib
 from webcam_recorder.caps import (get_video_source, get_caps_str,
-                                  get_video_device_key, get_bitrate)
+                                  get_video_device_key)
+from .encoders import get_profile, select_profile
+from .frames import FrameBranch, FrameRingBuffer
+from .queues import get_policies
+from .segments import SegmentedOutput
+from .stats import PipelineStats, StatsTimer
 
 
-class DrawPipeline(object):
+# Maximum time (in seconds) to wait for a pipeline to drain (i.e., for the
+# end-of-stream to reach all sinks) before forcing it to stop.
+DEFAULT_STOP_TIMEOUT = 2.
+
+
+def create_record_elements(output_path, bitrate=350 << 3 << 10,
+                           profile=None, queue_policy=None):
     '''
-    Run webcam pipeline.
+    Create `(queue, encoder, muxer, filesink)` elements to encode video to the
+    specified output file path.
+
+    __NB__ The output file container is determined based on the extension of
+    the output file path.  Supported containers depend on the encoder
+    profile (see `encoders.PROFILES`).  By default, the video is encoded in
+    MPEG4 format, to an `avi` or `mp4` (or `mkv`) container.
+
+    Arguments
+    ---------
+
+     - `output_path`: Output file path.
+     - `bitrate`: Target encode bit rate in bits/second (ignored by profiles
+       that are not bitrate-controlled).
+     - `profile`: Encoder profile (or profile name, default:
+       `encoders.DEFAULT_PROFILE`).
+     - `queue_policy`: `queues.QueuePolicy` of the branch queue (default:
+       recording policy of `queues.DEFAULT_PRESET`).
     '''
-    def run(self, device_config=None, sink=None):
-        # Create GStreamer pipeline
-        self.pipeline = Gst.Pipeline()
+    profile = get_profile(profile)
+    if queue_policy is None:
+        queue_policy = get_policies().record
+    capture_queue = queue_policy.create_queue()
+    encoder = profile.create_encoder(bitrate)
+    muxer = profile.create_muxer(output_path)
+    filesink = Gst.ElementFactory.make('filesink', None)
+    filesink.set_property('location', output_path)
+    return capture_queue, encoder, muxer, filesink
+
+
+def create_video_source(device_config=None):
+    '''
+    Create video source element for the specified device configuration.
 
-        # Create GStreamer elements
-        if device_config is None:
-            self.src = Gst.ElementFactory.make('autovideosrc', 'source')
-        else:
-            self.src = get_video_source()
-            device_key = get_video_device_key()
-            self.src.set_property(device_key, device_config['device'])
-        self.filter_ = Gst.ElementFactory.make('capsfilter', 'filter')
-        if sink is None:
-            self.sink = Gst.ElementFactory.make('autovideosink', 'sink')
-        else:
-            self.sink = sink
-        self.sink.set_property('sync', False)
-        caps = Gst.Caps(get_caps_str(device_config))
-        self.filter_.set_property('caps', caps)
+    If `device_config` is `None`, the GStreamer `autovideosrc` is used.  If
+    `device_config` has a `source` entry, a (live) element is created using the
+    named factory instead of opening `device_config['device']`, e.g.,
+    `'videotestsrc'` to run pipelines without camera hardware.
+    '''
+    if device_config is None:
+        return Gst.ElementFactory.make('autovideosrc', 'source')
+    factory = device_config.get('source')
+    if isinstance(factory, basestring) and factory:
+        src = Gst.ElementFactory.make(factory, 'source')
+        if src.find_property('is-live') is not None:
+            src.set_property('is-live', True)
+        return src
+    src = get_video_source()
+    device_key = get_video_device_key()
+    src.set_property(device_key, device_config['device'])
+    return src
+
+
+def same_device_config(config_a, config_b):
+    '''
+    Return `True` if both configurations select the same device and caps.
+    '''
+    if config_a is None or config_b is None:
+        return config_a is config_b
+    return (config_a['device'] == config_b['device'] and
+            get_caps_str(config_a) == get_caps_str(config_b))
 
-        # Add elements to the pipeline
-        self.pipeline.add(self.src)
-        self.pipeline.add(self.filter_)
-        self.pipeline.add(self.sink)
 
-        self.src.link(self.filter_)
-        self.filter_.link(self.sink)
-        self.pipeline.set_state(Gst.State.PLAYING)
+def add_first_buffer_probe(pad, callback):
+    '''
+    Call `callback(timestamp)` (from the streaming thread) when the next
+    buffer passes through `pad`, where `timestamp` is the wall-clock time
+    (i.e., `time.time()`) the buffer was observed.
+    '''
+    def on_buffer(pad, info):
+        callback(time.time())
+        return Gst.PadProbeReturn.REMOVE
+    return pad.add_probe(Gst.PadProbeType.BUFFER, on_buffer)
+
+
+class PipelineBase(object):
+    '''
+    Shared bus handling and non-blocking shutdown for webcam pipelines.
+
+    Subclasses must create `self.pipeline` and call `self.watch_bus()` in
+    `run()`.
+    '''
+    def watch_bus(self):
+        # Create bus to get events from GStreamer pipeline
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect('message::error', self.on_error)
+        self.bus.connect('message::eos', self.on_eos)
+        self.stopped = threading.Event()
+        self._stop_callbacks = []
+        self._stop_timeout_id = None
 
     def on_error(self, bus, msg):
         print('on_error():', msg.parse_error())
+        if self._stop_callbacks:
+            # Pipeline cannot drain, so finish stopping now.
+            self._finish_stop()
+
+    def on_eos(self, bus, msg):
+        self._finish_stop()
+
+    def stop(self, callback=None, timeout=DEFAULT_STOP_TIMEOUT):
+        '''
+        Stop pipeline *without blocking*.
+
+        An end-of-stream (EOS) event is sent through the pipeline (e.g., to
+        let the muxer write the file header) and the pipeline is set to the
+        `NULL` state once the EOS or an error is reported on the bus, or after
+        `timeout` seconds, whichever comes first.
 
+        __NB__ Bus messages are dispatched by the GLib main loop, which must be
+        running for the stop to complete before the timeout.
 
-class RecordPipeline(object):
-    def run(self, output_path, device_config=None, bitrate=350 << 3 << 10,
-            sink=None):
+        Arguments
+        ---------
+
+         - `callback`: Function called (without arguments, from the main
+           loop) once the pipeline has stopped.
+         - `timeout`: Maximum time (in seconds) to wait for the EOS.  If
+           `timeout` is `0`, the pipeline is stopped immediately, without
+           draining.
+
+        Returns a `threading.Event` that is set once the pipeline has stopped.
+        '''
+        if self.stopped.is_set():
+            if callback is not None:
+                callback()
+            return self.stopped
+        stopping = bool(self._stop_callbacks)
+        self._stop_callbacks.append(callback)
+        if not timeout:
+            self._finish_stop()
+        elif not stopping:
+            self._stop_timeout_id = GLib.timeout_add(int(timeout * 1000),
+                                                     self._on_stop_timeout)
+            self.drain()
+        return self.stopped
+
+    def drain(self):
         '''
-        Run webcam pipeline and optionally record the video to the specified
-        output file path.
+        Start draining pipeline.  The pipeline is stopped when the EOS message
+        is received on the bus.
+        '''
+        # Send end-of-stream (EOS) event through the pipeline.  This is
+        # required, for example, when recording to `mp4`, where the EOS event
+        # triggers the muxer to write the video header to the file.  The
+        # pipeline posts an EOS message on the bus once the EOS has reached
+        # *all* sinks, i.e., once the file has been finalized.
+        self.pipeline.send_event(Gst.Event.new_eos())
+
+    def _on_stop_timeout(self):
+        print('Timed out waiting for end-of-stream.  Forcing stop.')
+        self._stop_timeout_id = None
+        self._finish_stop()
+        return False
+
+    def _finish_stop(self):
+        if self.stopped.is_set():
+            return
+        if self._stop_timeout_id is not None:
+            GLib.source_remove(self._stop_timeout_id)
+            self._stop_timeout_id = None
+        self.pipeline.set_state(Gst.State.NULL)
+        self.bus.remove_signal_watch()
+        self.stopped.set()
+        callbacks, self._stop_callbacks = self._stop_callbacks, []
+        for callback in callbacks:
+            if callback is not None:
+                callback()
+
+
+class RecordBranch(object):
+    '''
+    Encoder -> muxer -> file sink branch, which can be attached to (and
+    detached from) the `tee` of a running pipeline, without interrupting the
+    other branches of the tee.
 
-        __NB__ The output file container is determined based on the extension
-        of the output file path.  Supported containers are `avi` and `mp4`.  In
-        either case, the video is encoded in MPEG4 format.
+    If `segment_policy` (a `segments.SegmentPolicy`) is set, the muxer and
+    file sink are wrapped in a `splitmuxsink`, writing a series of segment
+    files (see `segments`) instead of `output_path`.
+    '''
+    def __init__(self, output_path, bitrate=350 << 3 << 10, profile=None,
+                 queue_policy=None, segment_policy=None):
+        self.output_path = output_path
+        self.profile = get_profile(profile)
+        (self.queue, self.encoder, self.muxer, self.filesink) = \
+            create_record_elements(output_path, bitrate, profile=self.profile,
+                                   queue_policy=queue_policy)
+        if segment_policy is None:
+            self.segmented = None
+            self.output_elements = (self.muxer, self.filesink)
+        else:
+            self.segmented = SegmentedOutput(output_path, self.muxer,
+                                             self.filesink, segment_policy)
+            self.segmented.on_segment_closed = self._on_segment_closed
+            self.output_elements = (self.segmented.splitmuxsink, )
+        self.elements = (self.queue, self.encoder) + self.output_elements
+        self.tee_pad = None
+        self._detaching = False
+        # `True` once the end-of-stream has entered the `splitmuxsink` (see
+        # `_check_segments_closed`).
+        self._segmented_eos = False
+        # Timestamp of first buffer entering the branch (i.e., start of the
+        # recorded video, in pipeline running time).
+        self.start_pts = None
+        self.detached = threading.Event()
+        self._detach_callbacks = []
+        self._detach_timeout_id = None
+
+    def attach(self, pipeline, tee):
+        '''
+        Add branch elements to `pipeline` and link branch to new `tee` source
+        pad.
+        '''
+        self.pipeline = pipeline
+        self.tee = tee
+        if self.segmented is not None:
+            self.segmented.watch(pipeline.get_bus())
+        for element in self.elements:
+            self.pipeline.add(element)
+        self.link_elements()
+        # Start elements from the sink upstream, so each element is ready to
+        # accept data before data arrives.
+        for element in self.elements[::-1]:
+            element.sync_state_with_parent()
+        self.queue.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER,
+                                                    self._on_first_buffer)
+        self.tee_pad = tee.get_request_pad('src_%u')
+        self.tee_pad.link(self.queue.get_static_pad('sink'))
+
+    def link_elements(self):
+        for i, j in zip(self.elements[:-1], self.elements[1:]):
+            i.link(j)
+
+    def _on_first_buffer(self, pad, info):
+        self.start_pts = info.get_buffer().pts
+        return Gst.PadProbeReturn.REMOVE
+
+    def detach(self, callback=None, timeout=DEFAULT_STOP_TIMEOUT):
+        '''
+        Detach branch from tee *without blocking*, once the output file has
+        been finalized.
+
+        The basic idea is to:
+
+         - Block the tee source pad for the branch.
+         - Unlink the tee source pad and send an end-of-stream (EOS) event
+           through the branch queue `sink` pad.  This is required, for
+           example, when recording to `mp4`, where the EOS event triggers the
+           muxer to write the video header to the file.  See [here][1] for
+           more information.
+         - Once the EOS reaches the file sink (or, for a segmented
+           recording, once the EOS has reached the `splitmuxsink` and every
+           opened segment is closed), or after `timeout` seconds, stop the
+           branch elements and remove them from the pipeline (from the main
+           loop).
+
+        Returns a `threading.Event` that is set once the branch is detached.
+
+        [1]: http://gstreamer.freedesktop.org/data/doc/gstreamer/head/manual/html/section-dynamic-pipelines.html#section-dynamic-changing
+        '''
+        self._detach_callbacks.append(callback)
+        if len(self._detach_callbacks) > 1 or self.detached.is_set():
+            # Already detaching (or detached).
+            if self.detached.is_set():
+                self._finish_detach()
+            return self.detached
+        self._detaching = True
+        if self.segmented is None:
+            eos_pad = self.filesink.get_static_pad('sink')
+        else:
+            # `splitmuxsink` sends an EOS to its file sink at the end of each
+            # segment, so watch for the EOS entering the `splitmuxsink`
+            # instead (see `_check_segments_closed`).
+            eos_pad = self.segmented.splitmuxsink.get_static_pad('video')
+        eos_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM,
+                          self.eos_callback)
+        self.tee_pad.add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM,
+                               self.block_callback)
+        self._detach_timeout_id = GLib.timeout_add(int(timeout * 1000),
+                                                   self._on_detach_timeout)
+        return self.detached
+
+    def block_callback(self, pad, info):
+        queue_pad = self.queue.get_static_pad('sink')
+        pad.unlink(queue_pad)
+        queue_pad.send_event(Gst.Event.new_eos())
+        return Gst.PadProbeReturn.REMOVE
+
+    def eos_callback(self, pad, info):
+        if info.get_event().type != Gst.EventType.EOS:
+            return Gst.PadProbeReturn.OK
+        if self.segmented is None:
+            GLib.idle_add(self._finish_detach)
+        else:
+            self._segmented_eos = True
+            GLib.idle_add(self._check_segments_closed)
+        return Gst.PadProbeReturn.REMOVE
 
+    def _on_segment_closed(self, location):
+        self._check_segments_closed()
+
+    def _check_segments_closed(self):
+        '''
+        Finish detaching once the end-of-stream has entered the
+        `splitmuxsink` and every opened segment is closed.
+
+        This covers a recording stopped before any segment was opened, and
+        segments split on size or duration that are only closed after the
+        end-of-stream was sent.
+        '''
+        if (self._detaching and self._segmented_eos and
+                all(s['closed'] for s in self.segmented.manifest.segments)):
+            self._finish_detach()
+        return False
+
+    def _on_detach_timeout(self):
+        print('Timed out waiting for end-of-stream.  Forcing detach.')
+        self._detach_timeout_id = None
+        self._finish_detach()
+        return False
+
+    def _finish_detach(self):
+        if not self.detached.is_set():
+            if self._detach_timeout_id is not None:
+                GLib.source_remove(self._detach_timeout_id)
+                self._detach_timeout_id = None
+            if self.segmented is not None:
+                self.segmented.remove()
+            if self.tee_pad.is_linked():
+                self.tee_pad.unlink(self.queue.get_static_pad('sink'))
+            for element in self.elements:
+                element.set_state(Gst.State.NULL)
+                self.pipeline.remove(element)
+            self.tee.release_request_pad(self.tee_pad)
+            self.detached.set()
+        callbacks, self._detach_callbacks = self._detach_callbacks, []
+        for callback in callbacks:
+            if callback is not None:
+                callback()
+        return False
+
+
+class CapturePipeline(PipelineBase):
+    '''
+    Long-lived webcam pipeline, where the video is split by a `tee` into a
+    display branch and (optionally) a recording branch.
+
+    Recording may be started and stopped while the pipeline is running,
+    without renegotiating the camera or interrupting the display.
+    '''
+    def run(self, device_config=None, sink=None, policies=None):
+        '''
         Arguments
         ---------
 
-         - `output_path`: Output file path.
          - `device_config`:
            * Configuration dictionary or a `pandas.Series` in the format of a
              row of a frame returned by `caps.get_device_configs()`.
            * If not provided, the GStreamer `autovideosrc` is used.
-         - `bitrate`: Target encode bit rate in bits/second (default=350kB/s)
+         - `sink`: Display sink element (default: `autovideosink`).
+         - `policies`: Queue policies of the display and recording branches
+           (`queues.BranchPolicies` or preset name, default:
+           `queues.DEFAULT_PRESET`).
         '''
+        self.policies = get_policies(policies)
         # Create GStreamer pipeline
         self.pipeline = Gst.Pipeline()
-
-        # Create bus to get events from GStreamer pipeline
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect('message::error', self.on_error)
-
-        # This is needed to make the video output in our DrawingArea:
-        self.bus.enable_sync_message_emission()
+        self.watch_bus()
 
         # Create GStreamer elements
-        if device_config is None:
-            self.src = Gst.ElementFactory.make('autovideosrc', 'source')
-        else:
-            self.src = get_video_source()
-            device_key = get_video_device_key()
-            self.src.set_property(device_key, device_config['device'])
+        self.src = create_video_source(device_config)
         if sink is None:
             self.sink = Gst.ElementFactory.make('autovideosink', 'sink')
         else:
@@ -92,128 +400,491 @@ class RecordPipeline(object):
         self.sink.set_property('sync', False)
 
         self.filter_ = Gst.ElementFactory.make('capsfilter', 'filter')
-        tee = Gst.ElementFactory.make('tee', None)
-
-        sink_queue = Gst.ElementFactory.make('queue', None)
-        capture_queue = Gst.ElementFactory.make('queue', None)
-        encoder = Gst.ElementFactory.make('avenc_mpeg4', None)
-        encoder.set_property('bitrate', bitrate)
-        encoder.set_property('bitrate-tolerance', 500 << 10)
-        if path(output_path).ext.lower() == '.mp4':
-            muxer = Gst.ElementFactory.make('mp4mux', None)
-        elif path(output_path).ext.lower() == '.avi':
-            muxer = Gst.ElementFactory.make('avimux', None)
-        else:
-            raise ValueError('Unsupported output file type: %s' %
-                             path(output_path).ext)
-        filesink = Gst.ElementFactory.make('filesink', None)
-        filesink.set_property('location', output_path)
-
-        videorate = Gst.ElementFactory.make('videorate', None)
-        filter1 = Gst.ElementFactory.make('capsfilter', None)
-        filter1.set_property('caps',
-                             Gst.Caps('video/x-raw,framerate={framerate_numerator}/{framerate_denominator}'
-                                      .format(**device_config)))
-
-        caps = Gst.Caps(get_caps_str(device_config))
-        self.filter_.set_property('caps', caps)
-
-        src_elements = (self.src, self.filter_, videorate, filter1, tee)
+        self.tee = Gst.ElementFactory.make('tee', None)
+        # Do not fail while a recording branch is being detached.
+        self.tee.set_property('allow-not-linked', True)
+        sink_queue = self.policies.display.create_queue()
+
+        src_elements = [self.src, self.filter_]
+        if device_config is not None:
+            caps = Gst.Caps(get_caps_str(device_config))
+            self.filter_.set_property('caps', caps)
+
+            videorate = Gst.ElementFactory.make('videorate', None)
+            filter1 = Gst.ElementFactory.make('capsfilter', None)
+            filter1.set_property('caps',
+                                 Gst.Caps('video/x-raw,framerate={framerate_numerator}/{framerate_denominator}'
+                                          .format(**device_config)))
+            src_elements += [videorate, filter1]
+        src_elements.append(self.tee)
         sink_elements = (sink_queue, self.sink)
-        capture_elements = (capture_queue, encoder, muxer, filesink)
 
         # Add elements to the pipeline
-        for d in src_elements + sink_elements + capture_elements:
+        for d in tuple(src_elements) + sink_elements:
             self.pipeline.add(d)
 
-        for elements in (src_elements, sink_elements, capture_elements):
+        for elements in (src_elements, sink_elements):
             for i, j in zip(elements[:-1], elements[1:]):
                 i.link(j)
 
-        tee.link(sink_elements[0])
-        tee.link(capture_elements[0])
+        self.tee.link(sink_queue)
 
-
-        self.output_path = output_path
-        self.tee = tee
-        self.muxer = muxer
-        self.src_elements = src_elements
+        self.device_config = device_config
+        self.src_elements = tuple(src_elements)
         self.sink_elements = sink_elements
-        self.capture_elements = capture_elements
+        self.record_branch = None
+        # Recording branches being finalized, by output path.
+        self.finalizing = {}
+        self.frame_branch = None
 
         self.pipeline.set_state(Gst.State.PLAYING)
-        self._alive = True
 
-    def on_error(self, bus, msg):
-        print('on_error():', msg.parse_error())
+    @property
+    def recording_path(self):
+        if self.record_branch is not None:
+            return self.record_branch.output_path
 
-    def eos_callback(self, pad, event):
-        self.muxer.get_static_pad('src').remove_probe(self.eos_probe)
-        self._alive = False
-        return True
-
-    def block_callback(self, pad, event):
-        mux_pad = self.muxer.get_static_pad('src')
-        capture_pad = self.capture_elements[0].get_static_pad('sink')
-        self.eos_probe = mux_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM,
-                                           self.eos_callback)
-        capture_pad.send_event(Gst.Event.new_eos())
-        self.tee.pads[2].remove_probe(self.block_probe)
-        return True
-
-    def stop(self):
-        # Start callback chain to send EOS (end of stream) event to video
-        # muxer.  This is required, for example, when recording to `mp4`, where
-        # the EOS event triggers the muxer to write the video header to the
-        # file.  See [here][1] for more information.
-        #
-        # The basic idea is to:
-        #
-        #  - Block the tee source pad for the capture branch
-        #  - Send EOS event through the capture queue `sink` pad
-        #  - Wait until EOS is received by the muxer `sink` pad
-        #  - Stop the pipeline (wait is complete when `self._alive` is `True`)
-        #
-        # [1]: http://gstreamer.freedesktop.org/data/doc/gstreamer/head/manual/html/section-dynamic-pipelines.html#section-dynamic-changing
-        self.block_probe = self.tee.pads[2].add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM,
-                                                      self.block_callback)
-        for i in range(10):
-            if not self._alive:
-                self.pipeline.set_state(Gst.State.NULL)
-                break
-            time.sleep(.2)
+    def running_time(self):
+        '''
+        Return current pipeline running time (in nanoseconds), or `None` if
+        the pipeline has no clock (e.g., not yet playing).
+        '''
+        clock = self.pipeline.get_clock()
+        if clock is None:
+            return None
+        return clock.get_time() - self.pipeline.get_base_time()
+
+    def recording_time(self):
+        '''
+        Return time (in nanoseconds) since the first frame of the active
+        recording, or `None` if not recording (or no frame recorded yet).
+        '''
+        branch = self.record_branch
+        if branch is None or branch.start_pts is None:
+            return None
+        running_time = self.running_time()
+        if running_time is None:
+            return None
+        return running_time - branch.start_pts
+
+    def start_recording(self, output_path, bitrate=350 << 3 << 10,
+                        profile=None, rectifier=None, segment_policy=None):
+        '''
+        Attach recording branch to the tee.
+
+        If `rectifier` (a `rectify.Rectifier`) is provided, each frame is
+        rectified according to its warp before being encoded.
+
+        If `segment_policy` (a `segments.SegmentPolicy`) is provided, the
+        recording is split into segment files (see `segments`).
+
+        Raises `RuntimeError` if already recording, or if a previous
+        recording to `output_path` is still being finalized.
+        '''
+        if self.record_branch is not None:
+            raise RuntimeError('Already recording to: %s' %
+                               self.record_branch.output_path)
+        if output_path in self.finalizing:
+            raise RuntimeError('Still finalizing: %s' % output_path)
+        if rectifier is None:
+            branch = RecordBranch(output_path, bitrate=bitrate,
+                                  profile=profile,
+                                  queue_policy=self.policies.record,
+                                  segment_policy=segment_policy)
+        else:
+            from .rectify import RectifyBranch
+
+            branch = RectifyBranch(output_path, rectifier, bitrate=bitrate,
+                                   profile=profile,
+                                   queue_policy=self.policies.record,
+                                   segment_policy=segment_policy)
+        branch.attach(self.pipeline, self.tee)
+        self.record_branch = branch
+        return branch
+
+    def stop_recording(self, callback=None, timeout=DEFAULT_STOP_TIMEOUT):
+        '''
+        Detach recording branch (if any) *without blocking*.
+
+        `callback` is called (without arguments, from the main loop) once the
+        output file has been finalized (or immediately if not recording).
+        Until then, the branch is listed in `finalizing`.
+        '''
+        branch, self.record_branch = self.record_branch, None
+        if branch is None:
+            if callback is not None:
+                callback()
+            return None
+        output_path = branch.output_path
+        self.finalizing[output_path] = branch
+
+        def on_detached():
+            if self.finalizing.get(output_path) is branch:
+                del self.finalizing[output_path]
+            if callback is not None:
+                callback()
+        return branch.detach(callback=on_detached, timeout=timeout)
+
+    def start_frames(self, ring_buffer, caps=None, copy=False):
+        '''
+        Attach `frames.FrameBranch` pushing frames to `ring_buffer`.
+
+        Raises `RuntimeError` if a frame branch is already attached.
+        '''
+        if self.frame_branch is not None:
+            raise RuntimeError('Frame branch already attached.')
+        branch = FrameBranch(ring_buffer, caps=caps, copy=copy)
+        branch.attach(self.pipeline, self.tee)
+        self.frame_branch = branch
+        return branch
+
+    def stop_frames(self, callback=None):
+        '''
+        Detach frame branch (if any) *without blocking*.
+        '''
+        branch, self.frame_branch = self.frame_branch, None
+        if branch is None:
+            if callback is not None:
+                callback()
+            return None
+        return branch.detach(callback=callback)
 
 
 class PipelineManager(object):
-    def __init__(self):
+    '''
+    Manage the active webcam pipeline.
+
+    A single `CapturePipeline` is kept running for as long as the device
+    configuration is unchanged.  Starting or stopping a recording only
+    attaches or detaches a recording branch.
+
+    Changing the device configuration does not block: the active pipeline is
+    drained and stopped in the background (see `PipelineBase.stop`), and the
+    pipeline for the most recently requested configuration is started once
+    the previous pipeline has stopped.
+
+    Arguments
+    ---------
+
+     - `stop_timeout`: Maximum time (in seconds) to wait for a pipeline to
+       drain before forcing it to stop.
+     - `policies`: Queue policies of the display and recording branches
+       (`queues.BranchPolicies` or preset name, default:
+       `queues.DEFAULT_PRESET`, i.e., keep the display responsive if the
+       encoder falls behind).
+    '''
+    def __init__(self, stop_timeout=DEFAULT_STOP_TIMEOUT, policies=None):
         self.pipeline = None
+        self.policies = get_policies(policies)
         self.active_config = None
-
-    def set_config(self, device_config, record_path=None, sink=None):
+        # Display sink passed to the active pipeline (or `None` for the
+        # default sink).
+        self.active_sink = None
+        self.record_path = None
+        self.stop_timeout = stop_timeout
+        # Latest requested configuration, waiting for the previous pipeline to
+        # stop.
+        self._pending = None
+        self._stopping = False
+        self._lock = threading.RLock()
+        # Ring buffer of frames from the active pipeline (see
+        # `enable_frames`).
+        self.frames = None
+        self._frames_args = None
+        # Statistics of active pipeline (only collected once enabled).
+        self.stats = None
+        self._stats_enabled = False
+        self._stats_timers = []
+        # If set to a `rectify.Rectifier`, recordings are rectified
+        # according to its warp.
+        self.rectifier = None
+        # If set to a `segments.SegmentPolicy`, recordings are split into
+        # segment files.
+        self.segment_policy = None
+        # If set to an encoder profile (or profile name), recordings are
+        # encoded with it (see `encoders.select_profile`).
+        self.encoder = None
+
+    def set_config(self, device_config, record_path=None, sink=None,
+                   on_first_frame=None):
+        '''
+        Request new pipeline configuration.
+
+        `sink` is the display sink element, or a function returning a new
+        sink element, which is only called if a new pipeline is started.
+
+        Returns immediately.  If only `record_path` changed (and `sink` is
+        `None`, a function, or the sink of the running pipeline), recording
+        is started/stopped on the running pipeline.  Otherwise (e.g., a
+        different `sink` element), the active pipeline is replaced.  If the
+        previous pipeline is still stopping, only the most recent
+        configuration request is applied once it has stopped.
+
+        If `on_first_frame` is provided, it is called as
+        `on_first_frame(timestamp)` (from a streaming thread) when the first
+        frame passes through the new pipeline (or through the new recording
+        branch, if only `record_path` changed).  If the request is superseded
+        by a later request before being applied, it is never called.
+        '''
         print get_caps_str(device_config)
 
-        self._stop()
-        self.active_config = device_config  # = configs.iloc[config_index]
+        with self._lock:
+            if (not self._stopping and self.pipeline is not None and
+                    same_device_config(self.active_config, device_config) and
+                    (sink is None or callable(sink) or
+                     sink is self.active_sink)):
+                self.set_record_path(record_path,
+                                     on_first_frame=on_first_frame)
+                return
+            self._pending = (device_config, record_path, sink, on_first_frame)
+            if not self._stopping:
+                # Pending configuration is started once the active pipeline
+                # has stopped.
+                self.stop()
+
+    def _start_pending(self):
+        with self._lock:
+            if self._pending is None:
+                return
+            device_config, record_path, sink, on_first_frame = self._pending
+            self._pending = None
+            self.active_config = device_config  # = configs.iloc[config_index]
+            if callable(sink):
+                sink = sink()
+            self.active_sink = sink
+
+            self.pipeline = CapturePipeline()
+            self.pipeline.run(device_config=device_config, sink=sink,
+                              policies=self.policies)
+            if self._stats_enabled:
+                self._instrument_pipeline()
+            if self.frames is not None:
+                self.pipeline.start_frames(*self._frames_args)
+            if on_first_frame is not None:
+                add_first_buffer_probe(self.pipeline.sink
+                                       .get_static_pad('sink'),
+                                       on_first_frame)
+            self.record_path = None
+            self.set_record_path(record_path)
+
+    def set_record_path(self, record_path, on_first_frame=None,
+                        on_finalized=None):
+        '''
+        Start/stop recording on the running pipeline.
+
+        If already recording to a different path, the current recording is
+        finalized before recording to the new path starts.  Likewise, if a
+        previous recording to the new path is still being finalized (e.g.,
+        recording was just stopped), recording only starts once that
+        recording has been finalized.
+
+        If `on_first_frame` is provided, it is called as
+        `on_first_frame(timestamp)` when the first frame enters the new
+        recording branch (or immediately, if recording is stopped or
+        unchanged).
+
+        If `on_finalized` is provided, it is called (without arguments, from
+        the main loop) once the previous recording (if any) has been
+        finalized.
+        '''
+        with self._lock:
+            self.record_path = record_path
+            pipeline = self.pipeline
+            if pipeline.recording_path == record_path:
+                if on_first_frame is not None:
+                    on_first_frame(time.time())
+                if on_finalized is not None:
+                    on_finalized()
+                return
+
+            def start_recording():
+                finalizing = pipeline.finalizing.get(record_path)
+                if finalizing is not None:
+                    # Wait for previous recording to the same file.
+                    finalizing.detach(callback=start_recording)
+                    return
+                if on_finalized is not None:
+                    on_finalized()
+                with self._lock:
+                    # Only start if this is still the requested path and the
+                    # pipeline is still active.
+                    if (self.pipeline is pipeline and
+                            self.record_path == record_path and
+                            pipeline.record_branch is None):
+                        profile = select_profile(self.active_config,
+                                                 encoder=self.encoder)
+                        bitrate = profile.bitrate(self.active_config.height)
+                        branch = pipeline.start_recording(
+                            record_path, bitrate=bitrate, profile=profile,
+                            rectifier=self.rectifier,
+                            segment_policy=self.segment_policy)
+                        if self.stats is not None:
+                            self.stats.instrument_record_branch(branch)
+                        if on_first_frame is not None:
+                            add_first_buffer_probe(branch.queue
+                                                   .get_static_pad('sink'),
+                                                   on_first_frame)
+
+            if record_path is None:
+                pipeline.stop_recording(callback=on_finalized,
+                                        timeout=self.stop_timeout)
+                if on_first_frame is not None:
+                    on_first_frame(time.time())
+            else:
+                pipeline.stop_recording(callback=start_recording,
+                                        timeout=self.stop_timeout)
+
+    def enable_frames(self, size=4, caps=None, copy=False):
+        '''
+        Expose frames of the active pipeline (and of any subsequent
+        pipelines) as NumPy arrays through a `frames.FrameRingBuffer`.
+
+        Frames are delivered through a leaky branch of the tee, so consumers
+        falling behind never slow down the display or recording.
 
-        kwargs = {'device_config': device_config}
-        if record_path is not None:
-            self.pipeline = RecordPipeline()
-            kwargs['output_path'] = record_path
-            kwargs['bitrate'] = get_bitrate(device_config.height)
-        else:
-            self.pipeline = DrawPipeline()
+        Arguments
+        ---------
 
-        kwargs['sink'] = sink
+         - `size`: Number of frames kept in the ring buffer.
+         - `caps`: Optional caps to convert frames to (e.g.,
+           `'video/x-raw,format=BGR'`).  By default, frames are not converted.
+         - `copy`: If `True`, copy each frame and release its buffer right
+           away (see `frames.FrameBranch`).
 
-        self.pipeline.run(**kwargs)
+        Returns the ring buffer.
+        '''
+        with self._lock:
+            if self.frames is not None:
+                return self.frames
+            self.frames = FrameRingBuffer(size)
+            self._frames_args = self.frames, caps, copy
+            if (self.pipeline is not None and
+                    hasattr(self.pipeline, 'pipeline')):
+                self.pipeline.start_frames(*self._frames_args)
+            return self.frames
+
+    def disable_frames(self):
+        '''
+        Detach frame branch and close ring buffer (waking up consumers).
+        '''
+        with self._lock:
+            frames, self.frames = self.frames, None
+            self._frames_args = None
+            if frames is None:
+                return
+            if (self.pipeline is not None and
+                    hasattr(self.pipeline, 'pipeline')):
+                self.pipeline.stop_frames(callback=frames.close)
+            else:
+                frames.close()
 
-    def _stop(self):
+    def _instrument_pipeline(self):
+        if self.stats is not None:
+            self.stats.remove()
+            self.stats = None
         if self.pipeline is not None and hasattr(self.pipeline, 'pipeline'):
-            if hasattr(self.pipeline, 'stop'):
-                self.pipeline.stop()
+            self.stats = PipelineStats(self.pipeline.pipeline,
+                                       bus=self.pipeline.bus)
+            self.stats.instrument_capture(self.pipeline)
+
+    def enable_stats(self, callback=None, interval=1.):
+        '''
+        Collect statistics for the active pipeline (and for any subsequent
+        pipelines and recordings) using pad probes.
+
+        If `callback` is provided, it is called as `callback(snapshot)` every
+        `interval` seconds (from the main loop), where `snapshot` is the
+        return value of `stats_snapshot`.
+
+        Returns `stats.StatsTimer` if `callback` is provided.
+        '''
+        with self._lock:
+            if not self._stats_enabled:
+                self._stats_enabled = True
+                self._instrument_pipeline()
+            if callback is not None:
+                timer = StatsTimer(self.stats_snapshot, callback,
+                                   interval=interval)
+                self._stats_timers.append(timer)
+                return timer
+
+    def disable_stats(self):
+        '''
+        Remove all probes and periodic stats callbacks.
+        '''
+        with self._lock:
+            self._stats_enabled = False
+            for timer in self._stats_timers:
+                timer.stop()
+            self._stats_timers = []
+            if self.stats is not None:
+                self.stats.remove()
+                self.stats = None
+
+    def stats_snapshot(self):
+        '''
+        Return statistics `dict` for the active pipeline (see
+        `stats.PipelineStats.snapshot`), or `None` if stats are disabled.
+        '''
+        with self._lock:
+            stats = self.stats
+            config = self.active_config
+        if stats is None:
+            return None
+        snapshot = stats.snapshot()
+        if config is not None:
+            snapshot['caps'] = get_caps_str(config)
+        return snapshot
+
+    def recording_time(self):
+        '''
+        Return time (in nanoseconds) since the first frame of the active
+        recording, or `None` if not recording.
+        '''
+        with self._lock:
+            pipeline = self.pipeline
+        if pipeline is None or not hasattr(pipeline, 'pipeline'):
+            return None
+        return pipeline.recording_time()
+
+    def stop(self, callback=None, timeout=None):
+        '''
+        Stop active pipeline (if any) without blocking.
+
+        `callback` is called (without arguments) once the pipeline has
+        stopped (or immediately, if there is no active pipeline).  Any
+        configuration requested while stopping is then started.
+        '''
+        if timeout is None:
+            timeout = self.stop_timeout
+
+        def on_stopped():
+            with self._lock:
+                self._stopping = False
+            if callback is not None:
+                callback()
+            self._start_pending()
+
+        with self._lock:
+            pipeline, self.pipeline = self.pipeline, None
+            if pipeline is None or not hasattr(pipeline, 'pipeline'):
+                stopped = None
             else:
-                self.pipeline.pipeline.set_state(Gst.State.NULL)
-            time.sleep(0.05)
+                self._stopping = True
+                stopped = pipeline.stop(callback=on_stopped, timeout=timeout)
+        if stopped is None:
+            on_stopped()
+        return stopped
+
+    def shutdown(self, callback=None, timeout=None):
+        '''
+        Stop active pipeline (if any) without blocking, discarding any
+        pending configuration, such that no pipeline is started afterwards.
+        '''
+        with self._lock:
+            self._pending = None
+        return self.stop(callback=callback, timeout=timeout)
 
     def __del__(self):
-        self._stop()
+        # The main loop may no longer be running, so do not wait for EOS.
+        self.shutdown(timeout=0)
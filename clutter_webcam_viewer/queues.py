@@ -0,0 +1,183 @@
+'''
+Queue policies for the branches after the tee.
+
+Every branch after the tee starts with a `queue`.  With the default `queue`
+settings, a recording branch whose encoder falls behind fills its queue,
+which then blocks the tee, freezing the display.  A `QueuePolicy` sets the
+limits of a branch queue and what happens once they are reached:
+
+ - `leaky='no'`: Block upstream (i.e., the tee and every other branch) until
+   there is room.
+ - `leaky='downstream'`: Drop the oldest queued buffer.
+ - `leaky='upstream'`: Drop the incoming buffer.
+
+`BranchPolicies` pairs the policies of the display and recording branches.
+The presets are:
+
+ - `'never-stall-display'` (default): The recording queue drops the oldest
+   frames once it holds more than a second of video, so an overloaded
+   encoder never stalls the display.
+ - `'never-drop-recording'`: The recording queue never drops frames and is
+   allowed to buffer several seconds of video.  If the encoder stays behind
+   for longer, the tee (and display) is stalled.
+'''
+from collections import OrderedDict, namedtuple
+
+from gi.repository import Gst
+
+
+LEAKY = OrderedDict([('no', 0), ('upstream', 1), ('downstream', 2)])
+
+
+class QueuePolicy(object):
+    '''
+    Arguments
+    ---------
+
+     - `name`: Policy name.
+     - `max_buffers`, `max_bytes`: Maximum number of buffers and bytes queued
+       (`0` is unlimited).
+     - `max_time`: Maximum duration (in seconds) of queued data (`0` is
+       unlimited).
+     - `leaky`: What to do when full: `'no'` (block), `'upstream'` (drop
+       incoming buffers), or `'downstream'` (drop oldest buffers).
+     - `description`: Short description.
+    '''
+    def __init__(self, name, max_buffers=200, max_bytes=10 << 20, max_time=1.,
+                 leaky='no', description=''):
+        if leaky not in LEAKY:
+            raise ValueError('Invalid leaky mode: %s (expected one of: %s)' %
+                             (leaky, ', '.join(LEAKY)))
+        self.name = name
+        self.max_buffers = max_buffers
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        self.leaky = leaky
+        self.description = description
+
+    def __repr__(self):
+        return ('<QueuePolicy %s (buffers=%s, bytes=%s, time=%ss, leaky=%s)>'
+                % (self.name, self.max_buffers, self.max_bytes,
+                   self.max_time, self.leaky))
+
+    def with_limits(self, **kwargs):
+        '''
+        Return copy of policy with the specified attributes overridden (e.g.,
+        `max_time=5.`).
+        '''
+        attributes = dict((k, getattr(self, k))
+                          for k in ('name', 'max_buffers', 'max_bytes',
+                                    'max_time', 'leaky', 'description'))
+        attributes.update(kwargs)
+        return QueuePolicy(**attributes)
+
+    def apply(self, queue):
+        '''
+        Set the limits and leaky mode of a `queue` element.
+        '''
+        queue.set_property('max-size-buffers', self.max_buffers)
+        queue.set_property('max-size-bytes', self.max_bytes)
+        queue.set_property('max-size-time', int(self.max_time * Gst.SECOND))
+        queue.set_property('leaky', LEAKY[self.leaky])
+        return queue
+
+    def create_queue(self, name=None):
+        return self.apply(Gst.ElementFactory.make('queue', name))
+
+
+class BranchPolicies(namedtuple('BranchPolicies', 'name display record')):
+    '''
+    Queue policies of the display and recording branches.
+    '''
+    __slots__ = ()
+
+
+# Keep only the latest frames for display (i.e., show the newest frame
+# rather than a backlog).
+LATEST_FRAMES = QueuePolicy('latest-frames', max_buffers=3, max_bytes=0,
+                            max_time=0, leaky='downstream',
+                            description='Drop oldest frames beyond 3.')
+DROP_OLDEST = QueuePolicy('drop-oldest', max_buffers=0, max_bytes=64 << 20,
+                          max_time=1., leaky='downstream',
+                          description='Buffer up to 1 s, then drop oldest '
+                          'frames.')
+BLOCK = QueuePolicy('block', max_buffers=0, max_bytes=512 << 20,
+                    max_time=10., leaky='no',
+                    description='Buffer up to 10 s, then block upstream.')
+
+PRESETS = OrderedDict((p.name, p) for p in (
+    BranchPolicies('never-stall-display', LATEST_FRAMES, DROP_OLDEST),
+    BranchPolicies('never-drop-recording', LATEST_FRAMES, BLOCK)))
+DEFAULT_PRESET = 'never-stall-display'
+
+
+def get_policies(policies=None):
+    '''
+    Return `BranchPolicies` by preset name (or as-is if already a
+    `BranchPolicies`).  Default: `DEFAULT_PRESET`.
+    '''
+    if policies is None:
+        policies = DEFAULT_PRESET
+    if isinstance(policies, BranchPolicies):
+        return policies
+    try:
+        return PRESETS[policies]
+    except KeyError:
+        raise KeyError('Unknown queue policy preset: %s (expected one of: %s)'
+                       % (policies, ', '.join(PRESETS)))
+
+
+class QueueCounter(object):
+    '''
+    Count buffers entering, leaving, and dropped by a `queue` element, and
+    the number of times it was full (i.e., overrun).
+
+    A queue that is not leaky never drops buffers.  A leaky queue drops a
+    buffer each time it overruns (i.e., the incoming buffer for
+    `leaky='upstream'`, or the oldest buffer for `leaky='downstream'`), so
+    `dropped` is the overrun count.  (Deriving drops as `in - out - queued`
+    is racy, since the counts and queue level are read while buffers are
+    in flight.)
+
+    A downstream-leaky queue limited by time or bytes may drop more than one
+    buffer per overrun if buffers differ in size, in which case `dropped` is
+    a lower bound.
+    '''
+    def __init__(self, queue):
+        self.queue = queue
+        self.in_count = 0
+        self.out_count = 0
+        self.overruns = 0
+        self._probes = []
+        for pad_name, attribute in (('sink', 'in_count'),
+                                    ('src', 'out_count')):
+            pad = queue.get_static_pad(pad_name)
+            probe_id = pad.add_probe(Gst.PadProbeType.BUFFER,
+                                     self._counter(attribute))
+            self._probes.append((pad, probe_id))
+        self._overrun_handler = queue.connect('overrun', self._on_overrun)
+
+    def _counter(self, attribute):
+        def on_buffer(pad, info):
+            setattr(self, attribute, getattr(self, attribute) + 1)
+            return Gst.PadProbeReturn.OK
+        return on_buffer
+
+    def _on_overrun(self, queue):
+        self.overruns += 1
+
+    def snapshot(self):
+        queued = self.queue.get_property('current-level-buffers')
+        leaky = int(self.queue.get_property('leaky'))
+        overruns = self.overruns
+        return {'in': self.in_count, 'out': self.out_count,
+                'queued': queued, 'dropped': overruns if leaky else 0,
+                'overruns': overruns, 'leaky': LEAKY.keys()[leaky]}
+
+    def remove(self):
+        for pad, probe_id in self._probes:
+            pad.remove_probe(probe_id)
+        self._probes = []
+        if self._overrun_handler is not None:
+            self.queue.disconnect(self._overrun_handler)
+            self._overrun_handler = None
@@ -0,0 +1,297 @@
+'''
+CPU perspective rectification of recorded video.
+
+The perspective warp set by a `WarpActor` is only applied on screen (as an
+actor transform).  A `RectifyBranch` instead applies the warp to each frame
+before it is encoded, such that recordings match what the operator sees:
+
+    tee -> queue -> videoconvert -> BGR -> appsink
+        => rectify (remap) =>
+    appsrc -> videoconvert -> encoder -> muxer -> filesink
+
+For each warp change, x/y remap tables (i.e., the source pixel of every
+output pixel) are looked up in (or added to) the shared remap cache (see
+`remap_cache`).  Each frame is then rectified by a table lookup, using
+`cv2.remap` (multi-threaded by OpenCV) if available, or a NumPy gather split
+across a thread pool otherwise.
+
+The output frame has the size of the input frame and shows the parent (i.e.,
+warp actor) allocation, scaled to fit.
+'''
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import threading
+
+import numpy as np
+from gi.repository import Gst
+
+from .calibration import WarpCalibration
+from .frames import Frame, video_info_from_caps
+from .pipeline_manager import RecordBranch
+from .remap_cache import (frame_homography, get_remap_cache,
+                          nearest_coordinates)
+
+
+def _cv2():
+    try:
+        import cv2
+    except ImportError:
+        return None
+    return cv2
+
+
+class NumpyRemap(object):
+    '''
+    Nearest-neighbour remap using precomputed integer lookup tables.
+
+    Rows are split into bands, which are gathered in parallel (NumPy releases
+    the GIL while indexing).
+
+    Arguments
+    ---------
+
+     - `x`, `y`: Integer arrays of the input pixel of each output pixel.
+     - `input_shape`: `(rows, columns)` of input frame.
+    '''
+    def __init__(self, x, y, input_shape):
+        rows, columns = input_shape[:2]
+        self.outside = (x < 0) | (x >= columns) | (y < 0) | (y >= rows)
+        # Compact coordinates (less memory traffic per frame).
+        dtype = 'int16' if max(rows, columns) <= 1 << 15 else 'int32'
+        self.x = np.clip(x, 0, columns - 1).astype(dtype)
+        self.y = np.clip(y, 0, rows - 1).astype(dtype)
+        self.any_outside = self.outside.any()
+
+    @classmethod
+    def from_tables(cls, tables, input_shape):
+        '''
+        Create from `remap_cache.RemapTables`.
+        '''
+        x, y = nearest_coordinates(tables)
+        return cls(x, y, input_shape)
+
+    def _band(self, args):
+        image, out, start, end = args
+        band = out[start:end]
+        band[:] = image[self.y[start:end], self.x[start:end]]
+        if self.any_outside:
+            band[self.outside[start:end]] = 0
+
+    def __call__(self, image, out, pool=None, bands=1):
+        rows = out.shape[0]
+        bounds = np.linspace(0, rows, bands + 1).astype(int)
+        tasks = [(image, out, start, end)
+                 for start, end in zip(bounds[:-1], bounds[1:])]
+        if pool is None or len(tasks) == 1:
+            for task in tasks:
+                self._band(task)
+        else:
+            pool.map(self._band, tasks)
+        return out
+
+
+class Rectifier(object):
+    '''
+    Rectify frames according to the current warp calibration.
+
+    Remap tables are rebuilt (on the next frame) only when the warp or the
+    frame shape changes.  Thread-safe: the warp may be updated from the UI
+    thread while frames are rectified on a streaming thread.
+
+    Arguments
+    ---------
+
+     - `threads`: Number of threads used by the NumPy fallback (default: one
+       per CPU).  OpenCV manages its own threads.
+     - `use_cv2`: If `False`, always use the NumPy fallback.
+     - `cache`: `remap_cache.RemapCache` (default:
+       `remap_cache.get_remap_cache()`).
+    '''
+    def __init__(self, threads=None, use_cv2=True, cache=None):
+        self.cv2 = _cv2() if use_cv2 else None
+        self.cache = get_remap_cache() if cache is None else cache
+        self.threads = cpu_count() if threads is None else threads
+        self._pool = None
+        self._lock = threading.Lock()
+        self._calibration = None
+        # Calibration and frame shape the current tables were built for.
+        self._maps_calibration = None
+        self._maps_shape = None
+        self._maps = None
+        self.rebuild_count = 0
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+        return self._pool
+
+    def set_calibration(self, calibration):
+        '''
+        Set warp to apply, as a `calibration.WarpCalibration` (or `None` to
+        pass frames through unchanged).
+        '''
+        with self._lock:
+            self._calibration = calibration
+
+    def on_transform_changed(self, state):
+        '''
+        Update warp from a `warp.WarpState` (see
+        `WarpActor.on_transform_changed`).
+        '''
+        if state.initialized:
+            self.set_calibration(WarpCalibration(state.parent_bbox.copy(),
+                                                 state.child_bbox.copy(),
+                                                 state.parent_corners.copy(),
+                                                 state.child_corners.copy()))
+
+    def maps(self, shape):
+        '''
+        Return remap tables for frames of shape `(rows, columns)` (or `None`
+        if no warp is set), building them if the warp or shape changed.
+        '''
+        with self._lock:
+            calibration = self._calibration
+        if calibration is None:
+            return None
+        shape = tuple(shape[:2])
+        if (calibration is not self._maps_calibration or
+                shape != self._maps_shape):
+            tables = self.cache.get(frame_homography(calibration, shape),
+                                    shape)
+            if self.cv2 is None:
+                self._maps = NumpyRemap.from_tables(tables, shape)
+            else:
+                self._maps = tables
+            self._maps_calibration = calibration
+            self._maps_shape = shape
+            self.rebuild_count += 1
+        return self._maps
+
+    def rectify(self, image, out=None):
+        '''
+        Return rectified copy of `image` (a `(rows, columns[, channels])`
+        array).
+        '''
+        maps = self.maps(image.shape)
+        if maps is None:
+            if out is None:
+                return image.copy()
+            out[:] = image
+            return out
+        if self.cv2 is not None:
+            return self.cv2.remap(image, maps.map1, maps.map2,
+                                  self.cv2.INTER_LINEAR, dst=out,
+                                  borderMode=self.cv2.BORDER_CONSTANT)
+        if out is None:
+            out = np.empty_like(image)
+        return maps(image, out, pool=self.pool, bands=self.threads)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+class RectifyBranch(RecordBranch):
+    '''
+    Recording branch rectifying each frame (see `Rectifier`) before encoding.
+
+    Arguments
+    ---------
+
+     - `output_path`, `bitrate`, `profile`, `queue_policy`,
+       `segment_policy`: See `RecordBranch`.
+     - `rectifier`: `Rectifier` holding the warp to apply.
+    '''
+    def __init__(self, output_path, rectifier, bitrate=350 << 3 << 10,
+                 profile=None, queue_policy=None, segment_policy=None):
+        super(RectifyBranch, self).__init__(output_path, bitrate=bitrate,
+                                            profile=profile,
+                                            queue_policy=queue_policy,
+                                            segment_policy=segment_policy)
+        self.rectifier = rectifier
+        convert = Gst.ElementFactory.make('videoconvert', None)
+        filter_ = Gst.ElementFactory.make('capsfilter', None)
+        filter_.set_property('caps',
+                             Gst.Caps.from_string('video/x-raw,format=BGR'))
+        self.appsink = Gst.ElementFactory.make('appsink', None)
+        self.appsink.set_property('emit-signals', True)
+        self.appsink.set_property('sync', False)
+        self.appsink.connect('new-sample', self.on_new_sample)
+        self.appsink.connect('eos', self.on_eos)
+        self.appsrc = Gst.ElementFactory.make('appsrc', None)
+        self.appsrc.set_property('format', Gst.Format.TIME)
+        self.appsrc.set_property('is-live', True)
+        encoder_convert = Gst.ElementFactory.make('videoconvert', None)
+        self.elements = (self.queue, convert, filter_, self.appsink,
+                         self.appsrc, encoder_convert,
+                         self.encoder) + self.output_elements
+        self._caps = None
+        self._stride = None
+
+    def link_elements(self):
+        for i, j in zip(self.elements[:-1], self.elements[1:]):
+            # Frames are passed from the appsink to the appsrc by
+            # `on_new_sample`.
+            if i is not self.appsink:
+                i.link(j)
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        if sample is None:
+            return Gst.FlowReturn.OK
+        if self._caps is None:
+            self._caps = sample.get_caps()
+            self._stride = video_info_from_caps(self._caps).stride[0]
+            self.appsrc.set_property('caps', self._caps)
+        source = sample.get_buffer()
+        with Frame(sample) as frame:
+            rectified = self.rectifier.rectify(frame.array)
+        row_size = rectified.shape[1] * rectified.shape[2]
+        if self._stride != row_size:
+            # Pad rows to the stride expected by downstream elements.
+            padded = np.zeros((rectified.shape[0], self._stride),
+                              dtype='uint8')
+            padded[:, :row_size] = rectified.reshape(rectified.shape[0], -1)
+            rectified = padded
+        buffer = Gst.Buffer.new_wrapped(rectified.tobytes())
+        buffer.pts = source.pts
+        buffer.dts = source.dts
+        buffer.duration = source.duration
+        return self.appsrc.emit('push-buffer', buffer)
+
+    def on_eos(self, appsink):
+        # Forward end-of-stream (e.g., from `detach`) to the encoder side.
+        self.appsrc.emit('end-of-stream')
+
+
+if __name__ == '__main__':
+    '''
+    Benchmark remap table construction and per-frame rectification.
+    '''
+    import timeit
+
+    for rows, columns in ((480, 640), (720, 1280)):
+        calibration = WarpCalibration(
+            np.array([0, 0, columns, rows], dtype=float),
+            np.array([0, 0, columns, rows], dtype=float),
+            np.array([[20, 10], [columns - 40, 30], [columns - 10, rows - 5],
+                      [5, rows - 30]], dtype=float),
+            np.array([[0, 0], [columns, 0], [columns, rows], [0, rows]],
+                     dtype=float))
+        image = np.random.randint(255, size=(rows, columns, 3))\
+            .astype('uint8')
+        n = 10
+        print '%dx%d:' % (columns, rows)
+        for name, use_cv2 in (('numpy', False), ('cv2', True)):
+            rectifier = Rectifier(use_cv2=use_cv2)
+            if use_cv2 and rectifier.cv2 is None:
+                print '  %-6s (not available)' % name
+                continue
+            rectifier.set_calibration(calibration)
+            rectifier.rectify(image)
+            duration = min(timeit.repeat(lambda: rectifier.rectify(image),
+                                         repeat=3, number=n)) / n
+            print '  %-6s rectify %.2f ms/frame' % (name, 1e3 * duration)
+            rectifier.close()
@@ -0,0 +1,384 @@
+'''
+Remap lookup tables for perspective rectification, with an LRU cache.
+
+Building the remap tables of a full-resolution frame takes several
+milliseconds.  Tables are therefore cached, keyed by the input-to-output
+homography and the frame shape, such that switching back to a previous warp
+or resolution reuses the existing tables.  The least recently used tables are
+evicted once the cache exceeds its memory cap.
+
+By default, tables are stored in the compact fixed-point layout used by
+`cv2.convertMaps(..., cv2.CV_16SC2)` (6 bytes per pixel instead of 8 for two
+`float32` maps), which `cv2.remap` consumes directly and which cuts the
+memory bandwidth of each remap.
+
+Tables built for a warp calibration can be stored next to its warp file
+(see `remap_path`), so a reloaded session does not rebuild them.
+'''
+from collections import OrderedDict
+import threading
+
+import numpy as np
+from path_helpers import path
+
+from .calibration import _atomic_write
+
+
+REMAP_EXTENSION = '.remap.npz'
+# Number of fractional bits of fixed-point tables (`cv2.INTER_BITS`).
+INTER_BITS = 5
+INTER_TAB_SIZE = 1 << INTER_BITS
+DEFAULT_MAX_BYTES = 256 << 20
+
+
+def frame_homography(calibration, input_shape, output_shape=None):
+    '''
+    Return 3x3 homography mapping input frame pixels to output frame pixels.
+
+    Arguments
+    ---------
+
+     - `calibration`: `calibration.WarpCalibration`, where the child
+       allocation covers the input frame.  The parent allocation is scaled
+       uniformly to fit the output frame and centred (i.e., letterboxed if
+       the aspect ratios differ, as in `svg.scale_to_fit_a_in_b`).
+     - `input_shape`: `(rows, columns)` of input frame.
+     - `output_shape`: `(rows, columns)` of output frame (default:
+       `input_shape`).
+    '''
+    if output_shape is None:
+        output_shape = input_shape
+    child_x, child_y, child_width, child_height = calibration.child_bbox
+    parent_x, parent_y, parent_width, parent_height = calibration.parent_bbox
+    # Input frame pixels -> child coordinates.
+    frame_to_child = np.array([[child_width / float(input_shape[1]), 0,
+                                child_x],
+                               [0, child_height / float(input_shape[0]),
+                                child_y],
+                               [0, 0, 1]])
+    # Parent coordinates -> output frame pixels (same scale for both axes,
+    # centred).
+    scale = min(output_shape[1] / float(parent_width),
+                output_shape[0] / float(parent_height))
+    offset_x = .5 * (output_shape[1] - scale * parent_width)
+    offset_y = .5 * (output_shape[0] - scale * parent_height)
+    parent_to_frame = np.array([[scale, 0, offset_x - scale * parent_x],
+                                [0, scale, offset_y - scale * parent_y],
+                                [0, 0, 1]])
+    return parent_to_frame.dot(calibration.homography()).dot(frame_to_child)
+
+
+def remap_maps(homography, output_shape):
+    '''
+    Return `(map_x, map_y)` `float32` arrays of shape `output_shape`, holding
+    the input pixel coordinates of each output pixel for the input-to-output
+    `homography`.
+
+    Vectorised equivalent of `opencv_helpers.get_map_array`.
+    '''
+    rows, columns = output_shape[:2]
+    inverse = np.linalg.inv(homography)
+    x = np.arange(columns, dtype='float64')
+    y = np.arange(rows, dtype='float64')[:, None]
+    w = inverse[2, 0] * x + inverse[2, 1] * y + inverse[2, 2]
+    map_x = (inverse[0, 0] * x + inverse[0, 1] * y + inverse[0, 2]) / w
+    map_y = (inverse[1, 0] * x + inverse[1, 1] * y + inverse[1, 2]) / w
+    return map_x.astype('float32'), map_y.astype('float32')
+
+
+def to_fixed_point(map_x, map_y):
+    '''
+    Return `(map1, map2)` fixed-point tables equivalent to
+    `cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)`, i.e., a `(rows, columns,
+    2)` `int16` array of integer coordinates and a `uint16` array of
+    interpolation table indices.
+    '''
+    limit = (1 << 15) - 1
+    ix = np.rint(np.clip(np.nan_to_num(map_x), -limit, limit) *
+                 INTER_TAB_SIZE).astype('int32')
+    iy = np.rint(np.clip(np.nan_to_num(map_y), -limit, limit) *
+                 INTER_TAB_SIZE).astype('int32')
+    map1 = np.empty(ix.shape + (2, ), dtype='int16')
+    map1[..., 0] = ix >> INTER_BITS
+    map1[..., 1] = iy >> INTER_BITS
+    map2 = (((iy & (INTER_TAB_SIZE - 1)) << INTER_BITS) |
+            (ix & (INTER_TAB_SIZE - 1))).astype('uint16')
+    return map1, map2
+
+
+def nearest_coordinates(tables):
+    '''
+    Return `(x, y)` integer arrays of the input pixel nearest to each output
+    pixel.
+    '''
+    if not tables.fixed_point:
+        return (np.rint(tables.map1).astype('int32'),
+                np.rint(tables.map2).astype('int32'))
+    half = INTER_TAB_SIZE >> 1
+    x = tables.map1[..., 0].astype('int32')
+    y = tables.map1[..., 1].astype('int32')
+    x += (tables.map2 & (INTER_TAB_SIZE - 1)) >= half
+    y += (tables.map2 >> INTER_BITS) >= half
+    return x, y
+
+
+def _key(homography, shape):
+    homography = np.asarray(homography, dtype=float)
+    # Normalized to `H[2, 2] == 1`; single precision, such that round-off in
+    # the homography computation does not cause misses.
+    return ((homography / homography[2, 2]).astype('float32').tobytes(),
+            tuple(shape[:2]))
+
+
+class RemapTables(object):
+    '''
+    Remap tables of a homography for frames of a specific shape.
+
+    Attributes
+    ----------
+
+     - `homography`: Input-to-output 3x3 homography.
+     - `shape`: `(rows, columns)` of output frame.
+     - `map1`, `map2`: Fixed-point tables (see `to_fixed_point`), or `map_x`
+       and `map_y` `float32` tables, as accepted by `cv2.remap`.
+     - `fixed_point`: `True` if tables are fixed-point.
+    '''
+    def __init__(self, homography, shape, map1, map2):
+        self.homography = np.asarray(homography, dtype=float)
+        self.shape = tuple(shape[:2])
+        self.map1 = map1
+        self.map2 = map2
+        self.fixed_point = map1.dtype == np.int16
+
+    @classmethod
+    def build(cls, homography, shape, fixed_point=True):
+        map_x, map_y = remap_maps(homography, shape)
+        if fixed_point:
+            map_x, map_y = to_fixed_point(map_x, map_y)
+        return cls(homography, shape, map_x, map_y)
+
+    @property
+    def key(self):
+        return _key(self.homography, self.shape)
+
+    @property
+    def nbytes(self):
+        return self.map1.nbytes + self.map2.nbytes
+
+
+def remap_path(warp_path):
+    '''
+    Return path of remap tables file stored next to a warp file.
+    '''
+    warp_path = path(warp_path)
+    return warp_path.parent.joinpath(warp_path.namebase + REMAP_EXTENSION)
+
+
+def save_tables(output_path, tables):
+    '''
+    Atomically write list of `RemapTables` to a `.npz` file.
+    '''
+    arrays = {'homographies': np.array([t.homography for t in tables]),
+              'shapes': np.array([t.shape for t in tables], dtype='int64')}
+    for i, tables_i in enumerate(tables):
+        arrays['map1_%d' % i] = tables_i.map1
+        arrays['map2_%d' % i] = tables_i.map2
+    _atomic_write(output_path, lambda tmp_path: np.savez(tmp_path, **arrays))
+    return output_path
+
+
+def load_tables(input_path):
+    '''
+    Return list of `RemapTables` read from a `.npz` file (see `save_tables`).
+
+    Entries whose tables do not match their frame shape are skipped.
+    '''
+    with np.load(input_path) as data:
+        tables = []
+        for i, (homography, shape) in enumerate(zip(data['homographies'],
+                                                    data['shapes'])):
+            map1 = data['map1_%d' % i]
+            map2 = data['map2_%d' % i]
+            if map1.shape[:2] != tuple(shape) or map2.shape != tuple(shape):
+                continue
+            tables.append(RemapTables(homography, shape, map1, map2))
+    return tables
+
+
+class RemapCache(object):
+    '''
+    Thread-safe LRU cache of `RemapTables`.
+
+    Arguments
+    ---------
+
+     - `max_bytes`: Memory cap (in bytes).  Least recently used tables are
+       evicted to stay under the cap.
+     - `fixed_point`: If `True`, build fixed-point tables (see
+       `to_fixed_point`).
+    '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, fixed_point=True):
+        self.max_bytes = max_bytes
+        self.fixed_point = fixed_point
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, homography, shape):
+        '''
+        Return `RemapTables` for `homography` and frame `shape`, building
+        (and caching) them on a miss.
+        '''
+        key = _key(homography, shape)
+        with self._lock:
+            tables = self._entries.pop(key, None)
+            if tables is not None:
+                # Most recently used.
+                self._entries[key] = tables
+                self.hits += 1
+                return tables
+            self.misses += 1
+        # Build without holding the lock.
+        tables = RemapTables.build(homography, shape,
+                                   fixed_point=self.fixed_point)
+        self.put(tables)
+        return tables
+
+    def put(self, tables):
+        '''
+        Add tables to the cache (tables larger than the cap are not cached).
+        '''
+        if tables.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(tables.key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._entries[tables.key] = tables
+            self.nbytes += tables.nbytes
+            while self.nbytes > self.max_bytes:
+                key, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def tables_for(self, calibration):
+        '''
+        Return list of cached tables of a warp calibration (for any of the
+        cached frame shapes).
+        '''
+        with self._lock:
+            entries = self._entries.copy()
+        shapes = set(shape for h, shape in entries)
+        keys = [_key(frame_homography(calibration, shape), shape)
+                for shape in shapes]
+        return [entries[k] for k in keys if k in entries]
+
+    def save(self, output_path, calibration, shapes=()):
+        '''
+        Write tables of `calibration` to `output_path` (see `save_tables`).
+
+        Tables are written for every cached frame shape, and for each frame
+        shape (`(rows, columns)`) in `shapes`, building them if necessary.
+        Nothing is written if there are no such tables.
+        '''
+        tables = OrderedDict((t.key, t) for t in
+                             self.tables_for(calibration))
+        for shape in shapes:
+            tables_i = self.get(frame_homography(calibration, shape), shape)
+            tables[tables_i.key] = tables_i
+        if tables:
+            return save_tables(output_path, tables.values())
+
+    def load(self, input_path):
+        '''
+        Add tables stored in `input_path` to the cache.
+
+        Returns number of tables loaded (tables in a different format than
+        the cache, e.g., floating point instead of fixed-point, are skipped).
+        '''
+        tables = [t for t in load_tables(input_path)
+                  if t.fixed_point == self.fixed_point]
+        for tables_i in tables:
+            self.put(tables_i)
+        return len(tables)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_remap_cache():
+    '''
+    Return shared `RemapCache`.
+    '''
+    global _default_cache
+
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = RemapCache()
+        return _default_cache
+
+
+if __name__ == '__main__':
+    '''
+    Benchmark table construction, cache hits, and persistence.
+    '''
+    import shutil
+    import tempfile
+    import timeit
+
+    from .calibration import WarpCalibration
+
+    for rows, columns in ((480, 640), (720, 1280)):
+        calibration = WarpCalibration(
+            np.array([0, 0, columns, rows], dtype=float),
+            np.array([0, 0, columns, rows], dtype=float),
+            np.array([[20, 10], [columns - 40, 30], [columns - 10, rows - 5],
+                      [5, rows - 30]], dtype=float),
+            np.array([[0, 0], [columns, 0], [columns, rows], [0, rows]],
+                     dtype=float))
+        homography = frame_homography(calibration, (rows, columns))
+        n = 10
+        print '%dx%d:' % (columns, rows)
+        for fixed_point in (False, True):
+            build = min(timeit.repeat(lambda: RemapTables
+                                      .build(homography, (rows, columns),
+                                             fixed_point=fixed_point),
+                                      repeat=3, number=n)) / n
+            tables = RemapTables.build(homography, (rows, columns),
+                                       fixed_point=fixed_point)
+            print ('  %-11s build %6.2f ms, %5.2f MB' %
+                   ('fixed-point' if fixed_point else 'float', 1e3 * build,
+                    tables.nbytes / 1e6))
+        cache = RemapCache()
+        cache.get(homography, (rows, columns))
+        hit = min(timeit.repeat(lambda: cache.get(homography,
+                                                  (rows, columns)),
+                                repeat=3, number=1000)) / 1000
+        print '  cache hit   %6.2f us' % (1e6 * hit)
+        directory = path(tempfile.mkdtemp(prefix='remap-cache-'))
+        try:
+            tables_path = remap_path(directory.joinpath('warp.h5'))
+            cache.save(tables_path, calibration)
+            load = min(timeit.repeat(lambda: RemapCache().load(tables_path),
+                                     repeat=3, number=n)) / n
+            print '  load        %6.2f ms' % (1e3 * load)
+        finally:
+            shutil.rmtree(directory)
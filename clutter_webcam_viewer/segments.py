@@ -0,0 +1,300 @@
+'''
+Segmented recording.
+
+A recording to a single file is only playable once the muxer has finalized
+it (e.g., `mp4mux` writes its index when the end-of-stream reaches it), so a
+crash during a long session loses the whole recording.  The muxer index also
+grows for as long as the file is being written.
+
+With a `SegmentPolicy`, the muxer and file sink of a recording are wrapped
+in a `splitmuxsink`, which starts a new file (i.e., *segment*) on the first
+keyframe after the maximum duration or size of a segment is reached.  Each
+segment is finalized by its own muxer instance as soon as the next segment
+starts, so:
+
+ - every finished segment is playable on its own,
+ - a crash only loses the segment being written, and
+ - the muxer index only covers the current segment.
+
+Segments of `<name>.<ext>` are written to `<name>-00000.<ext>`,
+`<name>-00001.<ext>`, etc.  A manifest of the segments
+(`<name>.segments.json`) is rewritten (atomically, on the writer thread)
+every time a segment is opened or closed.  Offline tools (e.g.,
+`batch_rectify`) use the manifest to map each segment to the warp sidecar
+and timeline of its recording (see `find_segment`), so this module only
+imports GStreamer where it is used.
+'''
+import json
+import os
+import re
+import time
+
+from path_helpers import path
+
+from .calibration import _atomic_write
+from .writer import get_writer
+
+
+MANIFEST_EXTENSION = '.segments.json'
+# Name of segment file (without extension), see `segment_location`.
+SEGMENT_NAME = re.compile(r'^(?P<name>.*)-(?P<index>\d{5})$')
+
+
+def segment_location(output_path):
+    '''
+    Return `splitmuxsink` location pattern of segments of `output_path`.
+    '''
+    output_path = path(output_path)
+    prefix = output_path.parent.joinpath(output_path.namebase)
+    # `%` is reserved for the segment index format.
+    return '%s-%%05d%s' % (prefix.replace('%', '%%'),
+                           output_path.ext.replace('%', '%%'))
+
+
+def manifest_path(output_path):
+    '''
+    Return path of segment manifest of `output_path`.
+    '''
+    output_path = path(output_path)
+    return output_path.parent.joinpath(output_path.namebase +
+                                       MANIFEST_EXTENSION)
+
+
+class SegmentPolicy(object):
+    '''
+    Arguments
+    ---------
+
+     - `max_time`: Maximum duration (in seconds) of each segment (`0` is
+       unlimited).
+     - `max_bytes`: Maximum size (in bytes) of each segment (`0` is
+       unlimited).
+     - `max_files`: Maximum number of segment files kept on disk (`0` is
+       unlimited).  Once reached, the oldest segment file is overwritten.
+
+    Segments are split on keyframes, so segments may be slightly longer (or
+    larger) than the specified limits.
+    '''
+    def __init__(self, max_time=600., max_bytes=0, max_files=0):
+        if not (max_time or max_bytes):
+            raise ValueError('At least one of `max_time` or `max_bytes` must '
+                             'be set.')
+        self.max_time = max_time
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+
+    def __repr__(self):
+        return ('<SegmentPolicy (time=%ss, bytes=%s, files=%s)>' %
+                (self.max_time, self.max_bytes, self.max_files))
+
+    def apply(self, splitmuxsink):
+        '''
+        Set the limits of a `splitmuxsink` element.
+        '''
+        from gi.repository import Gst
+
+        splitmuxsink.set_property('max-size-time',
+                                  int(self.max_time * Gst.SECOND))
+        splitmuxsink.set_property('max-size-bytes', self.max_bytes)
+        splitmuxsink.set_property('max-files', self.max_files)
+        if (not self.max_bytes and
+                splitmuxsink.find_property('send-keyframe-requests')):
+            # Ask the encoder for a keyframe when a segment is due, rather
+            # than waiting for the next scheduled keyframe (GStreamer 1.12+).
+            splitmuxsink.set_property('send-keyframe-requests', True)
+        return splitmuxsink
+
+    def create_splitmuxsink(self, output_path, muxer, filesink):
+        '''
+        Create `splitmuxsink` writing segments of `output_path` using the
+        specified `muxer` and `filesink` elements.
+        '''
+        from gi.repository import Gst
+
+        splitmuxsink = Gst.ElementFactory.make('splitmuxsink', None)
+        splitmuxsink.set_property('location', segment_location(output_path))
+        splitmuxsink.set_property('muxer', muxer)
+        splitmuxsink.set_property('sink', filesink)
+        return self.apply(splitmuxsink)
+
+
+def save_manifest(output_path, manifest):
+    '''
+    Atomically write manifest (`dict`) to a JSON file.
+    '''
+    def write(tmp_path):
+        with open(tmp_path, 'w') as output:
+            json.dump(manifest, output, indent=2)
+    _atomic_write(output_path, write)
+    return output_path
+
+
+def load_manifest(input_path):
+    with open(input_path, 'r') as input_:
+        return json.load(input_)
+
+
+def find_segment(video_path):
+    '''
+    Return `(output_path, segment)` if `video_path` is a segment listed in
+    the manifest of a segmented recording (i.e., `<name>-<index>.<ext>` of
+    `<name>.<ext>`), where `output_path` is the path of the recording and
+    `segment` is the manifest entry of the segment (e.g., with its `start`
+    time, in seconds since the start of the recording).
+
+    Otherwise, return `None`.
+    '''
+    video_path = path(video_path)
+    match = SEGMENT_NAME.match(video_path.namebase)
+    if match is None:
+        return None
+    output_path = video_path.parent.joinpath(match.group('name') +
+                                             video_path.ext)
+    manifest_path_ = manifest_path(output_path)
+    if not manifest_path_.isfile():
+        return None
+    try:
+        manifest = load_manifest(manifest_path_)
+    except ValueError:
+        return None
+    # Compare file names, such that recordings can be moved.
+    for segment in manifest['segments']:
+        if path(segment['path']).name == video_path.name:
+            return output_path, segment
+    return None
+
+
+def finished_segments(manifest):
+    '''
+    Return paths of finished (i.e., playable) segments in a manifest, in
+    recording order.
+    '''
+    return [s['path'] for s in manifest['segments'] if s['closed']]
+
+
+class SegmentManifest(object):
+    '''
+    Segments of a recording, written to `manifest_path(output_path)`.
+
+    Start and end times of each segment are in seconds since the start of
+    the first segment.
+    '''
+    def __init__(self, output_path, policy, writer=None):
+        self.output_path = path(output_path)
+        self.path = manifest_path(output_path)
+        self.policy = policy
+        self.writer = get_writer() if writer is None else writer
+        self.created = time.time()
+        self.segments = []
+        self._index = 0
+        self._start_time = None
+
+    def _seconds(self, running_time):
+        from gi.repository import Gst
+
+        if self._start_time is None:
+            self._start_time = running_time
+        return (running_time - self._start_time) / float(Gst.SECOND)
+
+    def open(self, location, running_time):
+        # Drop segments overwritten by the new segment (see `max_files`).
+        self.segments = [s for s in self.segments if s['path'] != location]
+        self.segments.append({'index': self._index, 'path': location,
+                              'start': self._seconds(running_time),
+                              'end': None, 'bytes': None, 'closed': False})
+        self._index += 1
+        self.write()
+
+    def close(self, location, running_time):
+        for segment in self.segments[::-1]:
+            if segment['path'] == location:
+                segment['end'] = self._seconds(running_time)
+                try:
+                    segment['bytes'] = os.path.getsize(location)
+                except OSError:
+                    pass
+                segment['closed'] = True
+                break
+        self.write()
+
+    @property
+    def current(self):
+        '''
+        Path of most recently opened segment (or `None`).
+        '''
+        if self.segments:
+            return self.segments[-1]['path']
+
+    def to_dict(self):
+        return {'output_path': str(self.output_path),
+                'created': self.created,
+                'max_time': self.policy.max_time,
+                'max_bytes': self.policy.max_bytes,
+                'max_files': self.policy.max_files,
+                'segments': [dict(s) for s in self.segments]}
+
+    def write(self):
+        '''
+        Queue write of manifest on the writer thread.
+        '''
+        return self.writer.submit(self.path, save_manifest, self.path,
+                                  self.to_dict())
+
+
+class SegmentedOutput(object):
+    '''
+    `splitmuxsink` wrapping the `muxer` and `filesink` of a recording, along
+    with its `SegmentManifest`.
+
+    The manifest is updated from the `splitmuxsink-fragment-opened` and
+    `splitmuxsink-fragment-closed` messages posted on the pipeline bus (see
+    `watch`).
+
+    Attributes
+    ----------
+
+     - `on_segment_closed`: Called as `on_segment_closed(location)` (from
+       the main loop) after a segment has been finalized.
+    '''
+    def __init__(self, output_path, muxer, filesink, policy, writer=None):
+        self.policy = policy
+        self.splitmuxsink = policy.create_splitmuxsink(output_path, muxer,
+                                                       filesink)
+        self.manifest = SegmentManifest(output_path, policy, writer=writer)
+        self.on_segment_closed = None
+        self._bus = None
+        self._handler = None
+
+    def watch(self, bus):
+        '''
+        Update manifest from element messages on `bus` (which must have a
+        signal watch, see `PipelineBase.watch_bus`).
+        '''
+        self._bus = bus
+        self._handler = bus.connect('message::element', self.on_message)
+
+    def on_message(self, bus, message):
+        if message.src is not self.splitmuxsink:
+            return
+        structure = message.get_structure()
+        name = structure.get_name()
+        if name not in ('splitmuxsink-fragment-opened',
+                        'splitmuxsink-fragment-closed'):
+            return
+        location = structure.get_string('location')
+        running_time = structure.get_value('running-time')
+        if name == 'splitmuxsink-fragment-opened':
+            self.manifest.open(location, running_time)
+        else:
+            self.manifest.close(location, running_time)
+            if self.on_segment_closed is not None:
+                self.on_segment_closed(location)
+
+    def remove(self):
+        '''
+        Stop updating manifest.
+        '''
+        if self._handler is not None:
+            self._bus.disconnect(self._handler)
+            self._handler = None
+            self._bus = None
@@ -0,0 +1,312 @@
+'''
+Spatial index for point-in-path queries over many simple polygon paths.
+
+Path bounding boxes are binned into a uniform grid.  A query only tests the
+paths whose bounding box overlaps the grid cell containing the query point,
+using a vectorised even-odd (crossing number) point-in-polygon test.
+
+Paths are also triangulated (by ear clipping) once, such that the fill and
+outline of each path can be drawn from static vertex buffers (see
+`path_geometry`).
+'''
+import numpy as np
+
+
+def points_from_frame(df_paths):
+    '''
+    Return `(path_ids, vertices, offsets)` for a frame with (at least)
+    `path_id`, `x`, and `y` columns, with one row per vertex.
+
+    The vertices of path `path_ids[i]` are `vertices[offsets[i]:offsets[i +
+    1]]`.
+    '''
+    path_ids = []
+    vertices = []
+    for path_id, df_i in df_paths.groupby('path_id'):
+        path_ids.append(path_id)
+        vertices.append(df_i[['x', 'y']].values.astype(float))
+    offsets = np.concatenate([[0], np.cumsum([len(v) for v in vertices])])
+    return path_ids, np.concatenate(vertices), offsets
+
+
+def points_in_polygon(x, y, edges):
+    '''
+    Return `True` if point `(x, y)` is inside the polygon with the specified
+    `edges` (an `(N, 4)` array of `x0, y0, x1, y1` rows), using the even-odd
+    rule.
+    '''
+    x0, y0, x1, y1 = edges.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = (((y0 > y) != (y1 > y)) &
+                    (x < (x1 - x0) * (y - y0) / (y1 - y0) + x0))
+    return bool(np.count_nonzero(crossing) % 2)
+
+
+def _ring(vertices):
+    '''
+    Return number of distinct vertices of a path, i.e., excluding a closing
+    vertex equal to the first vertex.
+    '''
+    count = len(vertices)
+    if count > 1 and (vertices[0] == vertices[-1]).all():
+        count -= 1
+    return count
+
+
+def _is_ear(vertices, remaining, i):
+    '''
+    Return `True` if the (convex) corner at `remaining[i]` of a
+    counter-clockwise polygon contains no other remaining vertex.
+    '''
+    n = len(remaining)
+    a, b, c = (vertices[remaining[(i - 1) % n]], vertices[remaining[i]],
+               vertices[remaining[(i + 1) % n]])
+    others = vertices[[remaining[j] for j in xrange(n)
+                       if j not in ((i - 1) % n, i, (i + 1) % n)]]
+    # Ignore vertices coinciding with the corner (e.g., repeated vertices).
+    others = others[~((others == a).all(axis=1) | (others == b).all(axis=1) |
+                      (others == c).all(axis=1))]
+    if not len(others):
+        return True
+
+    def side(p, q):
+        return ((q[0] - p[0]) * (others[:, 1] - p[1]) -
+                (q[1] - p[1]) * (others[:, 0] - p[0]))
+    inside = (side(a, b) >= 0) & (side(b, c) >= 0) & (side(c, a) >= 0)
+    return not inside.any()
+
+
+def triangulate(vertices):
+    '''
+    Return `(M, 3)` array of indexes of the vertices of triangles covering
+    the simple polygon with the specified `(N, 2)` vertices.
+
+    A closing vertex (i.e., equal to the first vertex) is ignored.  If no
+    ear can be found (e.g., the polygon intersects itself), the remaining
+    vertices are triangulated as a fan.
+    '''
+    vertices = np.asarray(vertices, dtype=float)
+    count = _ring(vertices)
+    if count < 3:
+        return np.empty((0, 3), dtype=int)
+    x, y = vertices[:count].T
+    area = np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)
+    order = np.arange(count) if area >= 0 else np.arange(count)[::-1]
+    ring = vertices[order]
+    edges = np.roll(ring, -1, axis=0) - ring
+    turns = (edges[:, 0] * np.roll(edges, -1, axis=0)[:, 1] -
+             edges[:, 1] * np.roll(edges, -1, axis=0)[:, 0])
+    if (turns >= 0).all():
+        # Convex: fan from the first vertex.
+        return np.column_stack([np.repeat(order[0], count - 2), order[1:-1],
+                                order[2:]])
+    # Clip ears of the counter-clockwise vertex order.
+    remaining = order.tolist()
+    triangles = []
+    i = 0
+    misses = 0
+    while len(remaining) > 3 and misses < len(remaining):
+        n = len(remaining)
+        i %= n
+        a, b, c = (vertices[remaining[(i - 1) % n]], vertices[remaining[i]],
+                   vertices[remaining[(i + 1) % n]])
+        turn = (b[0] - a[0]) * (c[1] - b[1]) - (b[1] - a[1]) * (c[0] - b[0])
+        if turn == 0:
+            # Collinear (or repeated) vertex, which adds no area.
+            del remaining[i]
+            misses = 0
+        elif turn > 0 and _is_ear(vertices, remaining, i):
+            triangles.append((remaining[(i - 1) % n], remaining[i],
+                              remaining[(i + 1) % n]))
+            del remaining[i]
+            misses = 0
+        else:
+            i += 1
+            misses += 1
+    for j in xrange(1, len(remaining) - 1):
+        triangles.append((remaining[0], remaining[j], remaining[j + 1]))
+    return np.array(triangles, dtype=int).reshape(-1, 3)
+
+
+def path_geometry(vertices, offsets):
+    '''
+    Return `(fill, fill_offsets, outline, outline_offsets)` for the paths
+    with the specified `vertices` and `offsets` (see `points_from_frame`).
+
+     - `fill`: `(F, 2)` `float32` array of triangle vertices (three per
+       triangle) covering each path.
+     - `outline`: `(S, 2)` `float32` array of line vertices (two per edge)
+       of the closed outline of each path.
+
+    The fill (outline) vertices of path `i` are
+    `fill[fill_offsets[i]:fill_offsets[i + 1]]`.
+    '''
+    vertices = np.asarray(vertices, dtype=float)
+    fill = []
+    outline = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        path = vertices[start:end]
+        fill.append(path[triangulate(path).ravel()])
+        ring = path[:_ring(path)]
+        if len(ring) > 1:
+            outline.append(np.column_stack([ring, np.roll(ring, -1, axis=0)])
+                           .reshape(-1, 2))
+        else:
+            outline.append(np.empty((0, 2)))
+    fill_offsets = np.concatenate([[0], np.cumsum([len(f) for f in fill])])
+    outline_offsets = np.concatenate([[0],
+                                      np.cumsum([len(o) for o in outline])])
+    return (np.concatenate(fill).astype('float32'), fill_offsets,
+            np.concatenate(outline).astype('float32'), outline_offsets)
+
+
+class PathIndex(object):
+    '''
+    Uniform grid index over the bounding boxes of a set of paths.
+
+    Arguments
+    ---------
+
+     - `vertices`: `(N, 2)` array of vertices of all paths.
+     - `offsets`: Array of `P + 1` offsets, where the vertices of path `i`
+       are `vertices[offsets[i]:offsets[i + 1]]`.
+     - `cell_size`: Grid cell size.  By default, the median path bounding box
+       dimension is used, such that each path overlaps a handful of cells.
+    '''
+    def __init__(self, vertices, offsets, cell_size=None):
+        self.vertices = np.asarray(vertices, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=int)
+        path_count = len(self.offsets) - 1
+
+        # Edges as `(x0, y0, x1, y1)` rows.  Edges joining the last vertex of
+        # a path to the first vertex of the next path are never referenced,
+        # since edges are sliced per path.
+        self.edges = np.hstack([self.vertices[:-1], self.vertices[1:]])
+
+        starts = self.offsets[:-1]
+        self.bbox_min = np.minimum.reduceat(self.vertices, starts, axis=0)
+        self.bbox_max = np.maximum.reduceat(self.vertices, starts, axis=0)
+
+        self.origin = self.bbox_min.min(axis=0)
+        if cell_size is None:
+            cell_size = np.median(self.bbox_max - self.bbox_min)
+        extent = self.bbox_max.max(axis=0) - self.origin
+        if not cell_size > 0:
+            cell_size = max(extent.max(), 1.)
+        self.cell_size = float(cell_size)
+        self.shape = np.floor(extent / self.cell_size).astype(int) + 1
+
+        # Cell ranges (inclusive) covered by each path bounding box.
+        cell_min = self._cell(self.bbox_min)
+        cell_max = self._cell(self.bbox_max)
+        span = cell_max - cell_min + 1
+        counts = span[:, 0] * span[:, 1]
+
+        # Expand each path into one `(cell, path)` entry per covered cell.
+        path_index = np.repeat(np.arange(path_count), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) -
+                                                    counts, counts)
+        span_x = np.repeat(span[:, 0], counts)
+        cell_x = np.repeat(cell_min[:, 0], counts) + local % span_x
+        cell_y = np.repeat(cell_min[:, 1], counts) + local // span_x
+        cell_id = cell_y * self.shape[0] + cell_x
+
+        # Compressed sparse row layout: the candidate paths for cell `c` are
+        # `cell_paths[cell_starts[c]:cell_starts[c + 1]]`, sorted by path
+        # index.
+        order = np.lexsort((path_index, cell_id))
+        self.cell_paths = path_index[order]
+        self.cell_starts = np.searchsorted(cell_id[order],
+                                           np.arange(self.shape.prod() + 1))
+
+    @classmethod
+    def from_frame(cls, df_paths, **kwargs):
+        '''
+        Build index from frame with `path_id`, `x`, and `y` columns.
+
+        Returns `(path_ids, index)`.
+        '''
+        path_ids, vertices, offsets = points_from_frame(df_paths)
+        return path_ids, cls(vertices, offsets, **kwargs)
+
+    def _cell(self, points):
+        cells = np.floor((points - self.origin) / self.cell_size).astype(int)
+        return np.clip(cells, 0, self.shape - 1)
+
+    def candidates(self, x, y):
+        '''
+        Return indexes of paths with a bounding box containing `(x, y)`.
+        '''
+        if not (0 <= x - self.origin[0] <= self.shape[0] * self.cell_size and
+                0 <= y - self.origin[1] <= self.shape[1] * self.cell_size):
+            return np.empty(0, dtype=int)
+        cell_x, cell_y = self._cell(np.array([x, y]))
+        cell_id = cell_y * self.shape[0] + cell_x
+        paths = self.cell_paths[self.cell_starts[cell_id]:
+                                self.cell_starts[cell_id + 1]]
+        inside = ((self.bbox_min[paths, 0] <= x) &
+                  (x <= self.bbox_max[paths, 0]) &
+                  (self.bbox_min[paths, 1] <= y) &
+                  (y <= self.bbox_max[paths, 1]))
+        return paths[inside]
+
+    def path_at(self, x, y):
+        '''
+        Return index of path containing `(x, y)`, or `None`.
+
+        If several paths contain the point, the path with the highest index
+        (i.e., the last path drawn) is returned.
+        '''
+        for i in self.candidates(x, y)[::-1]:
+            edges = self.edges[self.offsets[i]:self.offsets[i + 1] - 1]
+            if points_in_polygon(x, y, edges):
+                return i
+        return None
+
+
+def _grid_of_paths(count, vertex_count=16):
+    '''
+    Return `(vertices, offsets)` for `count` regular polygons laid out on a
+    square grid (closing vertex included).
+    '''
+    side = int(np.ceil(np.sqrt(count)))
+    theta = np.linspace(0, 2 * np.pi, vertex_count + 1)
+    polygon = .45 * np.column_stack([np.cos(theta), np.sin(theta)])
+    centers = np.column_stack([np.arange(count) % side,
+                               np.arange(count) // side]) + .5
+    vertices = (centers[:, None, :] + polygon[None, :, :]).reshape(-1, 2)
+    offsets = np.arange(count + 1) * (vertex_count + 1)
+    return vertices, offsets
+
+
+def benchmark(counts=(100, 1000, 10000), queries=1000, seed=0):
+    '''
+    Time `PathIndex.path_at` for grids of `counts` paths.
+
+    Only the index lookup is timed; the Clutter pick path it replaces needs
+    a stage (and a GL context) to be measured.
+
+    Returns a list of `dict` records, one per path count, containing the
+    mean time per query (in seconds).
+    '''
+    import time
+
+    random = np.random.RandomState(seed)
+    results = []
+    for count in counts:
+        vertices, offsets = _grid_of_paths(count)
+        index = PathIndex(vertices, offsets)
+        side = index.shape * index.cell_size
+        query_points = index.origin + random.uniform(size=(queries, 2)) * side
+
+        start = time.time()
+        for x, y in query_points:
+            index.path_at(x, y)
+        seconds = (time.time() - start) / queries
+        results.append({'paths': count, 'seconds_per_query': seconds})
+    return results
+
+
+if __name__ == '__main__':
+    for result in benchmark():
+        print '%(paths)6d paths: %(seconds_per_query).2e s/query' % result
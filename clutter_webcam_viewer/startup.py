@@ -0,0 +1,163 @@
+'''
+Startup-time measurements.
+
+Heavy dependencies (e.g., `pandas`, `svg_model`, OpenCV) are imported on first
+use, such that importing the package and showing the first frame only pays
+for what is actually needed.  This module reports:
+
+ - the import time of package modules, each measured in a fresh interpreter
+   (see `import_times`), and
+ - the time from process start to the first displayed frame of
+   `python -m clutter_webcam_viewer --time-to-first-frame`.
+
+Run `python -m clutter_webcam_viewer.startup` to print a JSON report.
+'''
+import json
+import os
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+
+# Modules that are expensive to import and should only be loaded on demand.
+HEAVY_MODULES = ('pandas', 'cv2', 'svg_model', 'tables', 'opencv_helpers')
+MODULES = ('clutter_webcam_viewer.homography',
+           'clutter_webcam_viewer.calibration',
+           'clutter_webcam_viewer.warp',
+           'clutter_webcam_viewer.pipeline_manager',
+           'clutter_webcam_viewer')
+# Time-to-first-frame budget (in seconds).
+DEFAULT_BUDGET = 2.
+
+
+def process_start_time():
+    '''
+    Return wall-clock time the current process started (or `None` if not
+    available, e.g., on non-Linux platforms).
+    '''
+    try:
+        with open('/proc/self/stat', 'r') as input_:
+            # Command name may contain spaces; fields follow the last `)`.
+            fields = input_.read().rsplit(')', 1)[1].split()
+        # Field 22 (`starttime`), in clock ticks since boot.
+        start_ticks = int(fields[19])
+        with open('/proc/stat', 'r') as input_:
+            boot_time = [int(line.split()[1]) for line in input_
+                         if line.startswith('btime')][0]
+        return boot_time + start_ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def heavy_modules_loaded():
+    '''
+    Return list of `HEAVY_MODULES` that have been imported.
+    '''
+    return [m for m in HEAVY_MODULES if m in sys.modules]
+
+
+def import_time(module, python=sys.executable):
+    '''
+    Return `(seconds, heavy_modules)` of importing `module` in a fresh
+    interpreter, where `heavy_modules` is the list of `HEAVY_MODULES` loaded
+    as a side effect.
+    '''
+    code = ('import json, sys, time\n'
+            'start = time.time()\n'
+            'import %s\n'
+            'duration = time.time() - start\n'
+            'print json.dumps([duration, [m for m in %r\n'
+            '                             if m in sys.modules]])' %
+            (module, HEAVY_MODULES))
+    output = sp.check_output([python, '-c', code])
+    duration, heavy_modules = json.loads(output.strip().splitlines()[-1])
+    return duration, heavy_modules
+
+
+def import_times(modules=MODULES, repeat=3):
+    '''
+    Return `dict` mapping each module to the minimum import time over
+    `repeat` runs and the heavy modules it loads.
+
+    Modules that fail to import (e.g., missing optional dependencies) are
+    reported with an `error` entry.
+    '''
+    results = {}
+    for module in modules:
+        try:
+            runs = [import_time(module) for i in xrange(repeat)]
+        except sp.CalledProcessError, exception:
+            results[module] = {'error': str(exception)}
+            continue
+        results[module] = {'seconds': min(r[0] for r in runs),
+                           'heavy_modules': runs[0][1]}
+    return results
+
+
+def time_to_first_frame(timeout=60, args=None, python=sys.executable):
+    '''
+    Return report (`dict`) of `python -m clutter_webcam_viewer
+    --time-to-first-frame`, which displays the first available device
+    configuration and exits after the first frame is shown.
+    '''
+    command = [python, '-m', 'clutter_webcam_viewer',
+               '--time-to-first-frame'] + list(args or [])
+    # Write output to a file (rather than a pipe) so a chatty process never
+    # blocks on a full pipe while being polled.
+    with tempfile.TemporaryFile() as output:
+        process = sp.Popen(command, stdout=output)
+        start = time.time()
+        while process.poll() is None:
+            if time.time() - start > timeout:
+                process.kill()
+                raise RuntimeError('No frame within %s seconds.' % timeout)
+            time.sleep(.05)
+        output.seek(0)
+        reports = [line for line in output.read().splitlines()
+                   if line.startswith('{')]
+    if process.returncode != 0 or not reports:
+        raise RuntimeError('`%s` failed (exit code %s).' %
+                           (' '.join(command), process.returncode))
+    return json.loads(reports[-1])
+
+
+def startup_report(startup_times=None, budget=DEFAULT_BUDGET):
+    '''
+    Return report (`dict`) of the time-to-first-frame phases in
+    `startup_times` (wall-clock time of each phase, e.g., `imported`,
+    `first_frame`), relative to process start.
+    '''
+    start = process_start_time()
+    report = {'heavy_modules': heavy_modules_loaded(), 'budget': budget}
+    if start is None:
+        return report
+    for phase, timestamp in (startup_times or {}).items():
+        report[phase] = timestamp - start
+    if 'first_frame' in report:
+        report['within_budget'] = report['first_frame'] <= budget
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure import time and '
+                                     'time-to-first-frame.')
+    parser.add_argument('-m', '--module', action='append', default=None,
+                        help='Module to time (default: %s).' %
+                        ', '.join(MODULES))
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-f', '--first-frame', action='store_true',
+                        help='Also measure time-to-first-frame (requires a '
+                        'camera and a display).')
+    args = parser.parse_args()
+
+    report = {'imports': import_times(args.module or MODULES,
+                                      repeat=args.repeat)}
+    if args.first_frame:
+        try:
+            report['first_frame'] = time_to_first_frame()
+        except RuntimeError, exception:
+            report['first_frame'] = {'error': str(exception)}
+    print json.dumps(report, indent=2, sort_keys=True)
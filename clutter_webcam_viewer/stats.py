@@ -0,0 +1,230 @@
+'''
+Buffer, latency, queue, and QoS statistics for running pipelines.
+
+Statistics are collected using buffer pad probes, which are only installed
+once a pipeline is instrumented (see `PipelineManager.enable_stats`), so
+uninstrumented pipelines carry no overhead.
+
+Latency at a pad is the pipeline running time when a buffer reaches the pad
+minus the buffer timestamp.  The latency of an element is the difference
+between the mean latency at its source and sink pads.
+'''
+from collections import OrderedDict
+import time
+
+from gi.repository import Gst, GLib
+
+from .queues import QueueCounter
+
+
+class PadStats(object):
+    '''
+    Buffer count, byte count, and latency of buffers passing through a pad.
+    '''
+    def __init__(self, pipeline, pad):
+        self.pipeline = pipeline
+        self.pad = pad
+        self.count = 0
+        self.bytes = 0
+        self.first_time = None
+        self.last_time = None
+        self.latency_sum = 0
+        self.latency_count = 0
+        self.latency_max = 0
+        self.probe_id = pad.add_probe(Gst.PadProbeType.BUFFER, self.on_buffer)
+
+    def on_buffer(self, pad, info):
+        now = time.time()
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        buffer_ = info.get_buffer()
+        self.count += 1
+        self.bytes += buffer_.get_size()
+        clock = self.pipeline.get_clock()
+        pts = buffer_.pts
+        if clock is not None and pts != Gst.CLOCK_TIME_NONE:
+            latency = clock.get_time() - self.pipeline.get_base_time() - pts
+            self.latency_sum += latency
+            self.latency_count += 1
+            if latency > self.latency_max:
+                self.latency_max = latency
+        return Gst.PadProbeReturn.OK
+
+    @property
+    def latency_mean(self):
+        '''
+        Mean latency (in seconds), or `None` if no timestamped buffers.
+        '''
+        if self.latency_count:
+            return 1e-9 * self.latency_sum / self.latency_count
+
+    def remove(self):
+        if self.probe_id is not None:
+            self.pad.remove_probe(self.probe_id)
+            self.probe_id = None
+
+    def snapshot(self):
+        rate = None
+        if self.count > 1 and self.last_time > self.first_time:
+            rate = (self.count - 1) / (self.last_time - self.first_time)
+        return {'count': self.count, 'bytes': self.bytes, 'rate': rate,
+                'latency_mean': self.latency_mean,
+                'latency_max': (1e-9 * self.latency_max
+                                if self.latency_count else None)}
+
+
+class PipelineStats(object):
+    '''
+    Statistics for a single GStreamer pipeline.
+
+    Arguments
+    ---------
+
+     - `pipeline`: `Gst.Pipeline` to collect statistics for.
+     - `bus`: Pipeline bus with a signal watch (see
+       `PipelineBase.watch_bus`), used to aggregate QoS messages.
+    '''
+    def __init__(self, pipeline, bus=None):
+        self.pipeline = pipeline
+        self.pads = OrderedDict()
+        self.elements = OrderedDict()
+        self.queues = OrderedDict()
+        self.queue_counters = OrderedDict()
+        self.qos = OrderedDict()
+        self.start_time = time.time()
+        self.bus = bus
+        self._qos_handler = (None if bus is None else
+                             bus.connect('message::qos', self.on_qos))
+
+    def add_pad(self, name, pad):
+        if name in self.pads:
+            self.pads[name].remove()
+        self.pads[name] = PadStats(self.pipeline, pad)
+        return self.pads[name]
+
+    def add_element(self, name, element):
+        '''
+        Probe `sink` and `src` pads of `element` (to measure element latency).
+        '''
+        self.elements[name] = element
+        self.add_pad(name + '.sink', element.get_static_pad('sink'))
+        self.add_pad(name + '.src', element.get_static_pad('src'))
+
+    def add_queue(self, name, queue):
+        '''
+        Probe `queue` element and report its fill level and buffer counts
+        (see `queues.QueueCounter`) in snapshots.
+        '''
+        self.add_element(name, queue)
+        self.queues[name] = queue
+        if name in self.queue_counters:
+            self.queue_counters[name].remove()
+        self.queue_counters[name] = QueueCounter(queue)
+
+    def instrument_capture(self, capture_pipeline):
+        '''
+        Probe source, tee, display queue, and display sink of a
+        `CapturePipeline` (and its recording branch, if any).
+        '''
+        self.add_pad('source', capture_pipeline.src.get_static_pad('src'))
+        self.add_pad('tee', capture_pipeline.tee.get_static_pad('sink'))
+        sink_queue, sink = capture_pipeline.sink_elements
+        self.add_queue('display_queue', sink_queue)
+        self.add_pad('display_sink', sink.get_static_pad('sink'))
+        if capture_pipeline.record_branch is not None:
+            self.instrument_record_branch(capture_pipeline.record_branch)
+
+    def instrument_record_branch(self, branch):
+        '''
+        Probe queue, encoder, and file sink of a `RecordBranch`.
+        '''
+        self.add_queue('record_queue', branch.queue)
+        self.add_element('encoder', branch.encoder)
+        self.add_pad('record_sink', branch.filesink.get_static_pad('sink'))
+
+    def on_qos(self, bus, message):
+        name = message.src.get_name()
+        live, running_time, stream_time, timestamp, duration = \
+            message.parse_qos()
+        format_, processed, dropped = message.parse_qos_stats()
+        jitter, proportion, quality = message.parse_qos_values()
+        qos = self.qos.setdefault(name, {'messages': 0, 'jitter_max': 0})
+        qos['messages'] += 1
+        # Processed/dropped counts are totals reported by the element.
+        qos['processed'] = processed
+        qos['dropped'] = dropped
+        qos['jitter'] = 1e-9 * jitter
+        qos['jitter_max'] = max(qos['jitter_max'], 1e-9 * jitter)
+        qos['proportion'] = proportion
+        qos['quality'] = quality
+
+    def snapshot(self):
+        '''
+        Return `dict` of current statistics:
+
+         - `pads`: Buffer count, rate, and latency at each probed pad.
+         - `elements`: Latency of each probed element.
+         - `queues`: Current fill level, limits, and buffer counts (i.e.,
+           `in`, `out`, `queued`, `dropped`, and `overruns`) of each probed
+           queue.
+         - `qos`: Aggregated QoS messages per reporting element.
+        '''
+        elements = OrderedDict()
+        for name in self.elements:
+            sink = self.pads[name + '.sink'].latency_mean
+            src = self.pads[name + '.src'].latency_mean
+            elements[name] = {'latency': (None if sink is None or src is None
+                                          else src - sink)}
+        queues = OrderedDict()
+        for name, queue in self.queues.items():
+            queues[name] = dict((k.replace('-', '_'), queue.get_property(k))
+                                for k in ('current-level-buffers',
+                                          'current-level-bytes',
+                                          'current-level-time',
+                                          'max-size-buffers', 'max-size-bytes',
+                                          'max-size-time'))
+            queues[name].update(self.queue_counters[name].snapshot())
+        return {'timestamp': time.time(),
+                'uptime': time.time() - self.start_time,
+                'pads': OrderedDict((k, v.snapshot())
+                                    for k, v in self.pads.items()),
+                'elements': elements, 'queues': queues,
+                'qos': OrderedDict((k, dict(v))
+                                   for k, v in self.qos.items())}
+
+    def remove(self):
+        '''
+        Remove all probes and the QoS message handler.
+        '''
+        for pad_stats in self.pads.values():
+            pad_stats.remove()
+        for counter in self.queue_counters.values():
+            counter.remove()
+        if self._qos_handler is not None:
+            self.bus.disconnect(self._qos_handler)
+            self._qos_handler = None
+
+
+class StatsTimer(object):
+    '''
+    Call `callback(snapshot)` every `interval` seconds (from the main loop),
+    where `snapshot` is the return value of `get_snapshot()`.  No call is made
+    while `get_snapshot()` returns `None`.
+    '''
+    def __init__(self, get_snapshot, callback, interval=1.):
+        self.get_snapshot = get_snapshot
+        self.callback = callback
+        self._timeout_id = GLib.timeout_add(int(interval * 1000),
+                                            self._on_timeout)
+
+    def _on_timeout(self):
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            self.callback(snapshot)
+        return True
+
+    def stop(self):
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
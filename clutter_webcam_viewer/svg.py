@@ -1,9 +1,13 @@
+from collections import OrderedDict
 import sys
 
 from gi.repository import Clutter, Cogl, GLib
+import numpy as np
 import pandas as pd
 from svg_model.data_frame import (get_svg_frame, close_paths, get_path_infos,
                                   get_bounding_box)
+from .spatial import PathIndex, path_geometry, points_from_frame
+from . import svg_cache
 
 
 try:
@@ -12,34 +16,139 @@ except NameError:
     profile = lambda f: f
 
 
+def _cogl_context():
+    return Clutter.get_default_backend().get_cogl_context()
+
+
+def _attribute_buffer(context, array):
+    buffer_ = Cogl.AttributeBuffer.new_with_size(context, array.nbytes)
+    buffer_.set_data(0, array.tobytes())
+    return buffer_
+
+
+def _premultiplied(red, green, blue, alpha):
+    '''
+    Return color with premultiplied alpha, as expected by Cogl pipelines and
+    color attributes.
+    '''
+    return (red * alpha // 255, green * alpha // 255, blue * alpha // 255,
+            alpha)
+
+
+class PathPrimitive(object):
+    '''
+    Cogl primitive drawing a static `(N, 2)` array of vertices (e.g., the
+    triangles or outline edges returned by `spatial.path_geometry`).
+
+    The vertices are uploaded once, so drawing involves no per-vertex Python
+    work.
+
+    If `colors` is `True`, each vertex has a (premultiplied) RGBA color
+    attribute, which may be updated in place (see `set_colors`).  Otherwise,
+    vertices are drawn using the color of the pipeline.
+    '''
+    def __init__(self, mode, vertices, colors=False):
+        vertices = np.ascontiguousarray(vertices, dtype='float32')
+        self.count = len(vertices)
+        self.colors = (np.zeros((self.count, 4), dtype='uint8') if colors
+                       else None)
+        # Range of `colors` not yet uploaded.
+        self._dirty = None
+        self.primitive = None
+        if not self.count:
+            return
+        context = _cogl_context()
+        attributes = [Cogl.Attribute.new(_attribute_buffer(context, vertices),
+                                         'cogl_position_in', 8, 0, 2,
+                                         Cogl.AttributeType.FLOAT)]
+        if colors:
+            self._color_buffer = _attribute_buffer(context, self.colors)
+            attributes.append(Cogl.Attribute
+                              .new(self._color_buffer, 'cogl_color_in', 4, 0,
+                                   4, Cogl.AttributeType.UNSIGNED_BYTE))
+        self.primitive = Cogl.Primitive.new_with_attributes(mode, self.count,
+                                                            attributes)
+
+    def set_colors(self, start, end, rgba):
+        '''
+        Set color of vertices `start` to `end` (uploaded on next draw).
+        '''
+        if start == end:
+            return
+        self.colors[start:end] = rgba
+        if self._dirty is None:
+            self._dirty = start, end
+        else:
+            self._dirty = min(self._dirty[0], start), max(self._dirty[1], end)
+
+    def draw(self, framebuffer, pipeline):
+        if self.primitive is None:
+            return
+        if self._dirty is not None:
+            start, end = self._dirty
+            self._color_buffer.set_data(start * 4,
+                                        self.colors[start:end].tobytes())
+            self._dirty = None
+        self.primitive.draw(framebuffer, pipeline)
+
+
 class PathActor(Clutter.Actor):
     '''
     Actor to draw a simple polygon path (no holes or arcs).
 
+    The path vertices are converted once to coordinates local to the bounding
+    box of the path, and the actor is positioned and sized to cover only that
+    bounding box.  The fill (triangulated) and outline of the path are
+    uploaded once as Cogl primitives, which are shared by painting and
+    picking.  Painting is only redirected to an offscreen texture when the
+    path is drawn with partial opacity (one texture per path would cost an
+    FBO per actor for otherwise cheap geometry); use `PathBatchActor` to
+    cache many paths in a single texture.
+
     TODO
     ====
 
-     - Improve performance by painting to texture and repainting only when
-       color or path changes.
      - Add support for attributes other than color (e.g., edge/stroke color,
        alpha, etc.).
     '''
+    # Margin (in path coordinates) around path bounding box to avoid clipping
+    # the stroke.
+    margin = 1.
+
     def __init__(self, path_id, df_path):
         super(PathActor, self).__init__()
 
         self.set_reactive(True)
         self.path_id = path_id
-        self.df_path = df_path[['x', 'y']].copy()
 
         # set default color to black
         self._color = '#000'
-        self.shape = pd.Series([0, 0], index=['width', 'height'])
-
-    def do_allocate(self, box, flags):
-        self.shape = pd.Series(box.get_size(), index=['width', 'height'],
-                               name='shape')
-        self.x, self.y = self.df_path.T.values
-        Clutter.Actor.do_allocate(self, box, flags)
+        self._paint_color = Clutter.Color.from_string(self._color)[1]
+        self.set_path(df_path)
+        self.set_offscreen_redirect(
+            Clutter.OffscreenRedirect.AUTOMATIC_FOR_OPACITY)
+
+    def set_path(self, df_path):
+        '''
+        Set path vertices (in parent coordinates) and invalidate cached
+        geometry.
+        '''
+        self.df_path = df_path[['x', 'y']].copy()
+        vertices = self.df_path.values.astype(float)
+        origin = vertices.min(axis=0) - self.margin
+        shape = vertices.max(axis=0) + self.margin - origin
+        self.vertices = vertices - origin
+        # Fill and outline primitives (built on next paint or pick).
+        self._fill = None
+        self._outline = None
+        self.set_position(*origin)
+        self.set_size(*shape)
+        self.queue_redraw()
+
+    def do_get_paint_volume(self, volume):
+        # Limit redraw clipping (and any offscreen texture) to path bounding
+        # box.
+        return volume.set_from_allocation(self)
 
     @property
     def color(self):
@@ -48,38 +157,193 @@ class PathActor(Clutter.Actor):
     @color.setter
     def color(self, value):
         self._color = value
+        self._paint_color = Clutter.Color.from_string(value)[1]
         Clutter.threads_add_idle(GLib.PRIORITY_HIGH, self.queue_redraw)
 
+    def geometry(self):
+        '''
+        Return `(fill, outline)` primitives, building them if the path
+        changed.
+        '''
+        if self._fill is None:
+            fill, _, outline, _ = path_geometry(self.vertices,
+                                                [0, len(self.vertices)])
+            self._fill = PathPrimitive(Cogl.VerticesMode.TRIANGLES, fill)
+            self._outline = PathPrimitive(Cogl.VerticesMode.LINES, outline)
+            self._pipeline = Cogl.Pipeline.new(_cogl_context())
+        return self._fill, self._outline
+
     @profile
     def do_paint(self):
-        ok, color = Clutter.Color.from_string(self._color)
+        fill, outline = self.geometry()
+        color = self._paint_color
+        framebuffer = Cogl.get_draw_framebuffer()
 
         tmp_alpha = self.get_paint_opacity() * color.alpha / 255
 
-        Cogl.Path.new()
-        Cogl.set_source_color4ub(color.red, color.green, color.blue, tmp_alpha)
-        self.draw_path()
-        Cogl.Path.fill_preserve()
-        Cogl.set_source_color4ub(color.red, color.green, color.blue, 255)
-        Cogl.Path.stroke()
-
-    def draw_path(self):
-        Cogl.Path.move_to(self.x[0], self.y[0])
-        for i in xrange(1, len(self.x)):
-            x = self.x[i]
-            y = self.y[i]
-            Cogl.Path.line_to(x, y)
+        self._pipeline.set_color4ub(*_premultiplied(color.red, color.green,
+                                                    color.blue, tmp_alpha))
+        fill.draw(framebuffer, self._pipeline)
+        self._pipeline.set_color4ub(color.red, color.green, color.blue, 255)
+        outline.draw(framebuffer, self._pipeline)
 
     def do_pick(self, pick_color):
         if not self.should_pick_paint():
             return
 
-        Cogl.Path.new()
+        fill, outline = self.geometry()
+        self._pipeline.set_color4ub(pick_color.red, pick_color.green,
+                                    pick_color.blue, pick_color.alpha)
+        fill.draw(Cogl.get_draw_framebuffer(), self._pipeline)
+
 
-        Cogl.set_source_color4ub(pick_color.red, pick_color.green,
-                                 pick_color.blue, pick_color.alpha)
-        self.draw_path()
-        Cogl.Path.fill()
+class BatchedPath(object):
+    '''
+    Handle to a single path drawn by a `PathBatchActor`.
+
+    Provides the same color and opacity interface as `PathActor`, such that
+    callers (e.g., `clicked_cb`) may treat batched paths and path actors
+    interchangeably.
+    '''
+    __slots__ = ('batch', 'index', 'path_id')
+
+    def __init__(self, batch, index, path_id):
+        self.batch = batch
+        self.index = index
+        self.path_id = path_id
+
+    @property
+    def color(self):
+        return self.batch.path_colors[self.index]
+
+    @color.setter
+    def color(self, value):
+        self.batch.set_path_color(self.index, value)
+
+    def get_opacity(self):
+        return self.batch.path_opacities[self.index]
+
+    def set_opacity(self, opacity):
+        self.batch.set_path_opacity(self.index, opacity)
+
+
+class PathBatchActor(Clutter.Actor):
+    '''
+    Actor to draw many simple polygon paths (no holes or arcs) as a single
+    scene-graph node.
+
+    The fills (triangulated) of all paths are uploaded once to a single Cogl
+    primitive, and the outlines to another (see `PathPrimitive`).  The color
+    and opacity of each path are stored in a per-vertex color attribute, so
+    changing the color of a path only updates (and uploads) the colors of
+    its vertices.
+
+    Painting of the batch (a single actor) is redirected to one offscreen
+    texture, so paths are only redrawn when a path color/opacity or the
+    paint transform changes.  Color changes queue at most one redraw at a
+    time.
+    '''
+    def __init__(self, df_paths):
+        '''
+        Arguments
+        ---------
+
+         - `df_paths`: Frame with (at least) `path_id`, `x`, and `y` columns,
+           with one row per vertex.
+        '''
+        super(PathBatchActor, self).__init__()
+
+        path_ids, self.vertices, self.offsets = points_from_frame(df_paths)
+        self.path_ids = path_ids
+        self.index = PathIndex(self.vertices, self.offsets)
+        (self._fill_vertices, self._fill_offsets, self._outline_vertices,
+         self._outline_offsets) = path_geometry(self.vertices, self.offsets)
+        # Fill and outline primitives (built on first paint).
+        self._fill = None
+        self._outline = None
+
+        self.path_colors = ['#000'] * len(path_ids)
+        self._paint_colors = [(0, 0, 0, 255)] * len(path_ids)
+        self.path_opacities = [255] * len(path_ids)
+        self.paths = [BatchedPath(self, i, path_id)
+                      for i, path_id in enumerate(path_ids)]
+        # Paths with colors not yet written to the color attributes.
+        self._stale = set()
+        # Paint opacity the color attributes were computed for.
+        self._paint_opacity = None
+        self._redraw_queued = False
+
+        self.set_size(*self.vertices.max(axis=0))
+        self.set_offscreen_redirect(Clutter.OffscreenRedirect.ALWAYS)
+
+    def set_path_color(self, index, color):
+        self.path_colors[index] = color
+        color_i = Clutter.Color.from_string(color)[1]
+        self._paint_colors[index] = (color_i.red, color_i.green, color_i.blue,
+                                     color_i.alpha)
+        self._stale.add(index)
+        self._queue_redraw()
+
+    def set_path_opacity(self, index, opacity):
+        self.path_opacities[index] = opacity
+        self._stale.add(index)
+        self._queue_redraw()
+
+    def _queue_redraw(self):
+        # Colors may be set from any thread, so the redraw is queued from the
+        # main loop (once, however many paths changed).
+        if not self._redraw_queued:
+            self._redraw_queued = True
+            Clutter.threads_add_idle(GLib.PRIORITY_HIGH, self._on_redraw)
+
+    def _on_redraw(self, *args):
+        self._redraw_queued = False
+        self.queue_redraw()
+        return False
+
+    def path_at(self, x, y):
+        '''
+        Return index of path containing the point `(x, y)` (in actor
+        coordinates), or `None` if no path contains the point.
+        '''
+        return self.index.path_at(x, y)
+
+    def _update_colors(self):
+        '''
+        Write colors of changed paths (or of all paths, if the paint opacity
+        changed) to the color attributes.
+        '''
+        paint_opacity = self.get_paint_opacity()
+        stale, self._stale = self._stale, set()
+        if paint_opacity != self._paint_opacity:
+            self._paint_opacity = paint_opacity
+            stale = xrange(len(self.path_ids))
+        fill_offsets = self._fill_offsets
+        outline_offsets = self._outline_offsets
+        for i in stale:
+            red, green, blue, alpha = self._paint_colors[i]
+            opacity = paint_opacity * self.path_opacities[i] / 255
+            self._fill.set_colors(fill_offsets[i], fill_offsets[i + 1],
+                                  _premultiplied(red, green, blue,
+                                                 opacity * alpha / 255))
+            self._outline.set_colors(outline_offsets[i],
+                                     outline_offsets[i + 1],
+                                     _premultiplied(red, green, blue,
+                                                    opacity))
+
+    @profile
+    def do_paint(self):
+        if self._fill is None:
+            self._fill = PathPrimitive(Cogl.VerticesMode.TRIANGLES,
+                                       self._fill_vertices, colors=True)
+            self._outline = PathPrimitive(Cogl.VerticesMode.LINES,
+                                          self._outline_vertices, colors=True)
+            self._pipeline = Cogl.Pipeline.new(_cogl_context())
+            self._paint_opacity = None
+        self._update_colors()
+        framebuffer = Cogl.get_draw_framebuffer()
+        self._fill.draw(framebuffer, self._pipeline)
+        self._outline.draw(framebuffer, self._pipeline)
 
 
 def aspect_fit(actor, allocation, flags, bbox, scale=.9):
@@ -94,35 +358,166 @@ def aspect_fit(actor, allocation, flags, bbox, scale=.9):
     actor.set_translation(offset.x, offset.y, 0)
 
 
+def process_svg_frame(df_svg):
+    '''
+    Close paths and translate vertices such that the bounding box of all paths
+    starts at the origin.
+
+    Returns `(df_device, df_paths)`, where `df_paths` contains the path infos
+    (e.g., bounding box) of each path in `df_device`.
+    '''
+    df_device = close_paths(df_svg)
+    bbox = get_bounding_box(df_device)
+    df_device[['x', 'y']] -= bbox[['x', 'y']].values
+    df_paths = get_path_infos(df_device)
+    return df_device, df_paths
+
+
+def parse_svg(svg_path):
+    '''
+    Parse and process SVG file (see `process_svg_frame`).
+    '''
+    return process_svg_frame(get_svg_frame(svg_path))
+
+
 class SvgGroup(Clutter.Group):
     @classmethod
-    def from_path(cls, svg_path):
-        df_svg = get_svg_frame(svg_path)
-        svg_group = cls(df_svg)
+    def from_path(cls, svg_path, cache=True, cache_dir=None, **kwargs):
+        '''
+        Create group from SVG file.
+
+        If `cache` is `True`, the processed path frames are read from (or
+        written to) the on-disk cache in `cache_dir` (see `svg_cache`).
+        '''
+        if cache:
+            frames = svg_cache.load_frames(svg_path, parse_svg,
+                                           cache_dir=cache_dir)
+        else:
+            frames = svg_cache.Frames(*parse_svg(svg_path))
+        svg_group = cls(frames=frames, **kwargs)
         return svg_group
 
-    def __init__(self, df_svg):
+    def __init__(self, df_svg=None, batched=False, frames=None):
+        '''
+        Arguments
+        ---------
+
+         - `df_svg`: Frame with one row per SVG path vertex.
+         - `batched`: If `True`, draw all paths using a single
+           `PathBatchActor` rather than one `PathActor` per path.  This keeps
+           scene-graph overhead constant as the number of paths grows.
+         - `frames`: Already processed frames (see `process_svg_frame`),
+           used instead of `df_svg`, as a `(df_device, df_paths)` tuple or
+           as an object with `df_device` and `df_paths` attributes (e.g., a
+           `svg_cache.CacheEntry`, where `df_paths` is only loaded on first
+           access).
+
+        In either case, `paths` maps each path identifier to an object with a
+        `color` property and `get_opacity`/`set_opacity` methods.
+        '''
         super(SvgGroup, self).__init__()
-        self.df_device = close_paths(df_svg)
-        self.bbox = get_bounding_box(self.df_device)
-        self.df_device[['x', 'y']] -= self.bbox[['x', 'y']].values
+        if frames is None:
+            frames = process_svg_frame(df_svg)
+        if isinstance(frames, tuple):
+            frames = svg_cache.Frames(*frames)
+        self.frames = frames
+        self.df_device = frames.df_device
         self.bbox = get_bounding_box(self.df_device)
         self.set_size(*self.bbox[['width', 'height']])
         print self.bbox
-        self.df_paths = get_path_infos(self.df_device)
-
-        for path_id, df_i in self.df_device.groupby('path_id'):
-            actor = PathActor(path_id, df_i)
-            actor.set_size(self.bbox.width, self.bbox.height)
-            actor.color = '#000000dd'
-            actor.connect("button-release-event",
-                          lambda actor, event: clicked_cb(actor))
-            self.add_actor(actor)
+
+        self.paths = OrderedDict()
+        if batched:
+            self.batch_actor = PathBatchActor(self.df_device)
+            self.add_actor(self.batch_actor)
+            for path in self.batch_actor.paths:
+                path.color = '#000000dd'
+                self.paths[path.path_id] = path
+            self.path_ids = self.batch_actor.path_ids
+            self.path_index = self.batch_actor.index
+        else:
+            self.batch_actor = None
+            for path_id, df_i in self.df_device.groupby('path_id'):
+                actor = PathActor(path_id, df_i)
+                actor.color = '#000000dd'
+                self.add_actor(actor)
+                self.paths[path_id] = actor
+            self.path_ids, self.path_index = \
+                PathIndex.from_frame(self.df_device)
         self.connect("allocation-changed", aspect_fit, self.bbox)
+        # Clicks are resolved with `path_at` from a captured-event handler on
+        # the stage (see `on_captured_event`).  Neither the group nor the
+        # paths are reactive, so picking never paints the paths, and events
+        # outside of the paths reach the actors below (e.g., `WarpActor`).
+        for actor in self.get_children():
+            actor.set_reactive(False)
+        self._paths_clickable = True
+        self._stage = None
+        self._captured_handler = None
+        self._pressed_path = None
+        self.connect('notify::mapped', self.on_mapped)
+
+    @property
+    def df_paths(self):
+        return self.frames.df_paths
+
+    def path_at(self, x, y):
+        '''
+        Return identifier of path containing point `(x, y)` (in group
+        coordinates), or `None` if no path contains the point.
+        '''
+        index = self.path_index.path_at(x, y)
+        return None if index is None else self.path_ids[index]
+
+    def on_mapped(self, actor, param):
+        # Handle events of the stage the group is shown on (if any).
+        stage = self.get_stage() if self.is_mapped() else None
+        if stage is self._stage:
+            return
+        if self._captured_handler is not None:
+            self._stage.disconnect(self._captured_handler)
+            self._captured_handler = None
+        self._stage = stage
+        self._pressed_path = None
+        if stage is not None:
+            self._captured_handler = stage.connect('captured-event',
+                                                   self.on_captured_event)
+
+    def on_captured_event(self, stage, event):
+        '''
+        Toggle path clicked (i.e., pressed and released) within the group.
+
+        Button events on a path are stopped here.  Other events, and all
+        events while the group itself is reactive (see `set_reactive`), are
+        passed through (i.e., return `False`).
+        '''
+        event_type = event.type()
+        if not self._paths_clickable or event_type not in \
+                (Clutter.EventType.BUTTON_PRESS,
+                 Clutter.EventType.BUTTON_RELEASE):
+            return False
+        ok, x, y = self.transform_stage_point(*event.get_coords())
+        path_id = self.path_at(x, y) if ok else None
+        if event_type == Clutter.EventType.BUTTON_PRESS:
+            self._pressed_path = path_id
+            return path_id is not None
+        pressed, self._pressed_path = self._pressed_path, None
+        if pressed is None:
+            # Press outside of paths (e.g., dragging a warp corner).
+            return False
+        if path_id == pressed:
+            clicked_cb(self.paths[path_id])
+        return True
 
     def set_reactive(self, reactive):
-        for c in self.get_children():
-            c.set_reactive(not reactive)
+        '''
+        If `reactive` is `True`, the group receives events as a whole and
+        clicks no longer toggle paths.  Otherwise, paths are clicked through
+        the stage captured-event handler (the path actors themselves are
+        never reactive).
+        '''
+        self._paths_clickable = not reactive
+        self._pressed_path = None
         super(SvgGroup, self).set_reactive(reactive)
 
 
@@ -176,7 +571,7 @@ if __name__ == "__main__":
     stage.set_user_resizable(True)
     stage.connect("destroy", lambda x: Clutter.main_quit())
 
-    group = SvgGroup(args.svg_path)
+    group = SvgGroup.from_path(args.svg_path)
 
     stage.add_actor(group)
     stage.show_all()
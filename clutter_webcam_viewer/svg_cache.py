@@ -0,0 +1,332 @@
+'''
+On-disk cache of processed SVG path frames.
+
+Each cache entry is a directory containing, for the processed device frame
+and the path info frame, one 2D `.npy` array per dtype of numeric columns and
+one array of codes per (factorized) non-numeric column, along with a
+`meta.json` file describing the entry (including the frame index).  Arrays
+are loaded memory-mapped, so nothing but the array headers is read until a
+frame is first accessed.  If all numeric columns of a frame share one dtype,
+the frame wraps the memory-mapped array without copying; otherwise the
+numeric columns are copied into one array per dtype.  Non-numeric columns
+are always decoded (copied) from their codes.
+
+Entries are keyed by the SHA1 hash of the SVG file contents and by
+`CACHE_VERSION`, which must be incremented whenever the entry format or the
+processing applied to parsed SVG frames changes.  A missing, stale, or
+corrupted entry is deleted and replaced by a full parse.
+'''
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from path_helpers import path
+
+
+CACHE_VERSION = 3
+
+_parser_version = None
+
+
+def default_cache_dir():
+    '''
+    Return default cache directory (i.e.,
+    `$XDG_CACHE_HOME/clutter-webcam-viewer/svg`).
+    '''
+    root = os.environ.get('XDG_CACHE_HOME', path('~/.cache').expand())
+    return path(root).joinpath('clutter-webcam-viewer', 'svg')
+
+
+def parser_version():
+    '''
+    Return string identifying the cache format and the installed SVG parser.
+
+    The version is only looked up once per process.
+    '''
+    global _parser_version
+
+    if _parser_version is None:
+        try:
+            import svg_model
+
+            svg_model_version = svg_model.__version__
+        except Exception:
+            svg_model_version = 'unknown'
+        _parser_version = '%s-svg_model-%s' % (CACHE_VERSION,
+                                               svg_model_version)
+    return _parser_version
+
+
+def cache_key(svg_path):
+    '''
+    Return cache key for SVG file, based on file contents and parser version.
+    '''
+    sha1 = hashlib.sha1()
+    with open(svg_path, 'rb') as input_:
+        for chunk in iter(lambda: input_.read(1 << 16), b''):
+            sha1.update(chunk)
+    sha1.update(parser_version())
+    return sha1.hexdigest()
+
+
+def _save_index(entry_dir, prefix, index):
+    '''
+    Write index to `entry_dir` (if necessary) and return description of the
+    index (for `meta.json`).
+
+    A default range index is only described, a numeric index is written as
+    an array, and other index labels are stored in the description (labels
+    must be JSON-serializable).
+    '''
+    if isinstance(index, pd.MultiIndex):
+        raise TypeError('Multi-level index is not supported.')
+    index_meta = {'name': index.name}
+    if (isinstance(index, pd.RangeIndex) and
+            index.equals(pd.RangeIndex(len(index)))):
+        index_meta['kind'] = 'range'
+    elif index.dtype.kind in 'biuf':
+        filename = '%s-index.npy' % prefix
+        np.save(entry_dir.joinpath(filename), index.values)
+        index_meta.update(kind='array', file=filename)
+    else:
+        labels = index.tolist()
+        try:
+            json.dumps(labels)
+        except TypeError:
+            raise TypeError('Index has labels that are not JSON-serializable '
+                            '(unsupported dtype: %s).' % index.dtype)
+        index_meta.update(kind='labels', labels=labels)
+    return index_meta
+
+
+def _save_frame(entry_dir, prefix, df):
+    '''
+    Write columns and index of `df` to `entry_dir` and return description of
+    the frame (for `meta.json`).
+
+    Numeric columns of the same dtype are written as a single 2D array, such
+    that the loaded frame can wrap the memory-mapped array without copying.
+    Other columns (e.g., path identifiers) are factorized: codes are written
+    as an array and labels are stored in the description (labels must be
+    JSON-serializable).
+    '''
+    blocks = OrderedDict()
+    categorical = []
+    for column in df.columns:
+        values = df[column].values
+        if values.dtype.kind in 'biuf':
+            blocks.setdefault(values.dtype.str, []).append(column)
+            continue
+        codes, labels = pd.factorize(values)
+        labels = labels.tolist()
+        try:
+            json.dumps(labels)
+        except TypeError:
+            raise TypeError('Column `%s` has labels that are not '
+                            'JSON-serializable (unsupported dtype: %s).' %
+                            (column, values.dtype))
+        filename = '%s-%s.npy' % (prefix, len(categorical))
+        np.save(entry_dir.joinpath(filename), codes)
+        categorical.append({'column': column, 'file': filename,
+                            'labels': labels})
+    block_meta = []
+    for i, columns in enumerate(blocks.values()):
+        filename = '%s-block-%d.npy' % (prefix, i)
+        np.save(entry_dir.joinpath(filename), df[columns].values)
+        block_meta.append({'file': filename, 'columns': columns})
+    return {'columns': df.columns.tolist(), 'length': len(df),
+            'blocks': block_meta, 'categorical': categorical,
+            'index': _save_index(entry_dir, prefix, df.index)}
+
+
+def _open_frame(entry_dir, frame_meta):
+    '''
+    Memory-map arrays of frame (only reads the array headers) and check
+    their shapes.
+
+    Returns `(blocks, codes, index)`, where `blocks` and `codes` are lists
+    of arrays and `index` is the index array (`None` unless the index was
+    written as an array).
+    '''
+    length = frame_meta['length']
+    blocks = []
+    for block in frame_meta['blocks']:
+        # Copy-on-write, such that the frame may be modified in memory.
+        values = np.load(entry_dir.joinpath(block['file']), mmap_mode='c')
+        if values.shape != (length, len(block['columns'])):
+            raise ValueError('Inconsistent array shape: %s' % block['file'])
+        blocks.append(values)
+    codes = []
+    for column in frame_meta['categorical']:
+        values = np.load(entry_dir.joinpath(column['file']), mmap_mode='c')
+        if values.shape != (length, ):
+            raise ValueError('Inconsistent array shape: %s' % column['file'])
+        codes.append(values)
+    index_meta = frame_meta['index']
+    if index_meta['kind'] == 'array':
+        index = np.load(entry_dir.joinpath(index_meta['file']),
+                        mmap_mode='c')
+        if index.shape != (length, ):
+            raise ValueError('Inconsistent array shape: %s' %
+                             index_meta['file'])
+    else:
+        index = None
+        if (index_meta['kind'] == 'labels' and
+                len(index_meta['labels']) != length):
+            raise ValueError('Inconsistent index length.')
+    return blocks, codes, index
+
+
+def _build_frame(frame_meta, blocks, codes, index_values):
+    '''
+    Return frame wrapping the memory-mapped arrays returned by `_open_frame`.
+
+    Numeric columns are only copied if the frame has numeric columns of more
+    than one dtype (non-numeric columns are decoded from their codes).
+    '''
+    index_meta = frame_meta['index']
+    if index_meta['kind'] == 'range':
+        index = pd.RangeIndex(frame_meta['length'], name=index_meta['name'])
+    elif index_meta['kind'] == 'array':
+        index = pd.Index(index_values, name=index_meta['name'])
+    else:
+        index = pd.Index(index_meta['labels'], name=index_meta['name'])
+    frames = [pd.DataFrame(values, columns=block['columns'], index=index,
+                           copy=False)
+              for block, values in zip(frame_meta['blocks'], blocks)]
+    if len(frames) == 1:
+        df = frames[0]
+    elif frames:
+        df = pd.concat(frames, axis=1)
+    else:
+        df = pd.DataFrame(index=index)
+    columns = frame_meta['columns']
+    # Insert categorical columns in column order, such that each column is
+    # inserted at its final position.
+    for position, column, codes_i in sorted(
+            (columns.index(c['column']), c, codes_i)
+            for c, codes_i in zip(frame_meta['categorical'], codes)):
+        labels = np.asarray(column['labels'], dtype=object)
+        df.insert(min(position, len(df.columns)), column['column'],
+                  labels[codes_i])
+    if df.columns.tolist() != columns:
+        df = df[columns]
+    return df
+
+
+def save_entry(entry_dir, key, df_device, df_paths):
+    '''
+    Atomically write cache entry for the specified frames.
+
+    Non-numeric columns (e.g., `path_id`) and non-numeric index labels must
+    be JSON-serializable.
+    '''
+    entry_dir = path(entry_dir)
+    entry_dir.parent.makedirs_p()
+    tmp_dir = path(tempfile.mkdtemp(prefix='.tmp-', dir=entry_dir.parent))
+    try:
+        meta = {'version': parser_version(),
+                'key': key,
+                'device': _save_frame(tmp_dir, 'device', df_device),
+                'paths': _save_frame(tmp_dir, 'paths', df_paths)}
+        with open(tmp_dir.joinpath('meta.json'), 'w') as output:
+            json.dump(meta, output)
+        if entry_dir.isdir():
+            shutil.rmtree(entry_dir)
+        os.rename(tmp_dir, entry_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+class Frames(object):
+    '''
+    Processed `df_device` and `df_paths` frames (same interface as
+    `CacheEntry`).
+    '''
+    def __init__(self, df_device, df_paths):
+        self.df_device = df_device
+        self.df_paths = df_paths
+
+
+class CacheEntry(object):
+    '''
+    Lazily loaded cache entry.
+
+    On construction, `meta.json` is read and validated, and the column
+    arrays are memory-mapped and checked (which only reads the array
+    headers).  Raises an exception if the entry is stale or corrupted.
+
+    Each frame is only constructed when first accessed, wrapping the
+    memory-mapped arrays, such that only the pages that are actually
+    accessed are read from disk.
+    '''
+    def __init__(self, entry_dir, key):
+        self.entry_dir = path(entry_dir)
+        with open(self.entry_dir.joinpath('meta.json'), 'r') as input_:
+            self.meta = json.load(input_)
+        if (self.meta.get('version') != parser_version() or
+                self.meta.get('key') != key):
+            raise ValueError('Stale cache entry: %s' % self.entry_dir)
+        self._arrays = dict((name, _open_frame(self.entry_dir,
+                                               self.meta[name]))
+                            for name in ('device', 'paths'))
+        self._df_device = None
+        self._df_paths = None
+
+    @property
+    def df_device(self):
+        if self._df_device is None:
+            self._df_device = _build_frame(self.meta['device'],
+                                           *self._arrays['device'])
+        return self._df_device
+
+    @property
+    def df_paths(self):
+        if self._df_paths is None:
+            self._df_paths = _build_frame(self.meta['paths'],
+                                          *self._arrays['paths'])
+        return self._df_paths
+
+
+def load_frames(svg_path, process, cache_dir=None):
+    '''
+    Return processed frames for SVG file (as a `CacheEntry` or `Frames`
+    object, with `df_device` and `df_paths` attributes), using the on-disk
+    cache where possible.
+
+    A stale or corrupted cache entry is deleted and replaced.
+
+    Arguments
+    ---------
+
+     - `svg_path`: Path to SVG file.
+     - `process`: Function called as `process(svg_path)` on a cache miss,
+       returning `(df_device, df_paths)` frames.
+     - `cache_dir`: Cache root directory (default: `default_cache_dir()`).
+    '''
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    key = cache_key(svg_path)
+    entry_dir = path(cache_dir).joinpath(key)
+
+    if entry_dir.isdir():
+        try:
+            return CacheEntry(entry_dir, key)
+        except Exception, exception:
+            print 'Discarding SVG cache entry: %s' % exception
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    df_device, df_paths = process(svg_path)
+    try:
+        save_entry(entry_dir, key, df_device, df_paths)
+    except Exception, exception:
+        # Caching is best-effort (e.g., read-only cache directory, or
+        # unsupported column types).
+        print 'SVG frames not cached: %s' % exception
+    return Frames(df_device, df_paths)
@@ -0,0 +1,18 @@
+from contextlib import contextmanager
+import shutil
+import tempfile
+
+from path_helpers import path
+
+
+@contextmanager
+def tempdir():
+    '''
+    Context manager yielding a temporary directory (as a `path`), which is
+    deleted on exit.
+    '''
+    directory = path(tempfile.mkdtemp(prefix='cwv-test-'))
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
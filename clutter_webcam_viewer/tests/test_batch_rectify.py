@@ -0,0 +1,177 @@
+from unittest import SkipTest
+import json
+
+import numpy as np
+from path_helpers import path
+
+try:
+    import cv2
+except ImportError:
+    raise SkipTest('`cv2` is not installed.')
+
+from clutter_webcam_viewer.batch_rectify import (WarpSchedule, done_path,
+                                                 find_jobs, find_videos,
+                                                 frame_pts, output_path_for,
+                                                 partial_path, recording_of,
+                                                 rectify_video)
+from clutter_webcam_viewer.calibration import (WarpCalibration,
+                                               save_calibration,
+                                               sidecar_path)
+from clutter_webcam_viewer.segments import manifest_path
+from clutter_webcam_viewer.tests.helpers import tempdir
+from clutter_webcam_viewer.timeline import (WarpTimeline, WarpTimelineWriter,
+                                            timeline_path)
+from clutter_webcam_viewer.writer import MetadataWriter
+
+
+PARENT = np.array([[0, 0], [640, 0], [640, 480], [0, 480]], dtype=float)
+CALIBRATION = WarpCalibration(np.array([0, 0, 640, 480.]),
+                              np.array([0, 0, 640, 480.]), PARENT,
+                              PARENT + 10)
+
+
+def _touch(*paths):
+    for path_i in paths:
+        path_i.parent.makedirs_p()
+        path_i.touch()
+
+
+def test_paths():
+    video_path = path('/videos/rec.avi')
+    assert output_path_for(video_path) == path('/videos/rec-rectified.avi')
+    output_path = output_path_for(video_path, output_dir='/out', suffix='-r')
+    assert output_path == path('/out/rec-r.avi')
+    assert done_path(output_path) == path('/out/rec-r.avi.done')
+    assert partial_path(output_path) == path('/out/.rec-r.partial.avi')
+
+
+def test_find_videos():
+    with tempdir() as directory:
+        videos = [directory.joinpath(name)
+                  for name in ('a.avi', 'b.MP4', 'sub/c.mkv')]
+        _touch(*videos)
+        # Not videos, outputs, and partial outputs.
+        _touch(directory.joinpath('a.warp.json'),
+               directory.joinpath('a-rectified.avi'),
+               directory.joinpath('.a-rectified.partial.avi'))
+        assert find_videos([directory]) == videos[:2]
+        assert find_videos([directory, videos[2]]) == videos
+        assert find_videos([directory], suffix='-other') == \
+            sorted(videos[:2] + [directory.joinpath('a-rectified.avi')])
+
+
+def test_find_jobs():
+    with tempdir() as directory:
+        a, b, c = [directory.joinpath(name + '.avi') for name in 'abc']
+        _touch(a, b, c)
+        save_calibration(sidecar_path(a), CALIBRATION)
+        save_calibration(sidecar_path(b), CALIBRATION)
+        # `b` is done.
+        _touch(output_path_for(b), done_path(output_path_for(b)))
+
+        jobs, skipped = find_jobs([directory])
+        assert jobs == [(a, sidecar_path(a), output_path_for(a))]
+        assert skipped == [(b, 'done'), (c, 'no calibration')]
+
+        jobs, skipped = find_jobs([directory], force=True)
+        assert [job[0] for job in jobs] == [a, b]
+        # Output directory.
+        jobs, skipped = find_jobs([a], output_dir=directory.joinpath('out'))
+        assert jobs[0][2] == directory.joinpath('out', 'a-rectified.avi')
+
+
+def test_find_jobs_segments():
+    with tempdir() as directory:
+        recording = directory.joinpath('rec.avi')
+        segments = [directory.joinpath('rec-%05d.avi' % i) for i in
+                    xrange(3)]
+        _touch(*segments)
+        save_calibration(sidecar_path(recording), CALIBRATION)
+        # Last segment is not in the manifest (e.g., manifest lagged).
+        with open(manifest_path(recording), 'w') as output:
+            json.dump({'segments': [{'index': i, 'path': segments[i],
+                                     'start': 600. * i, 'closed': True}
+                                    for i in xrange(2)]}, output)
+
+        assert recording_of(segments[1]) == (recording, 600 * 10 ** 9)
+        assert recording_of(recording) == (recording, 0)
+        jobs, skipped = find_jobs([directory])
+        assert jobs == [(s, sidecar_path(recording), output_path_for(s))
+                        for s in segments[:2]]
+        assert skipped == [(segments[2], 'no calibration')]
+
+
+def test_schedule():
+    with tempdir() as directory:
+        writer = MetadataWriter()
+        output_path = timeline_path(directory.joinpath('rec.avi'))
+        timeline_writer = WarpTimelineWriter(output_path, writer=writer)
+        for i, pts in enumerate((0, 5 * 10 ** 9, 20 * 10 ** 9)):
+            timeline_writer.append(pts, PARENT, PARENT + i)
+        timeline_writer.close()
+        assert writer.close(5)
+        timeline = WarpTimeline(output_path)
+
+        # No timeline: calibration at the start of the recording.
+        schedule = WarpSchedule(CALIBRATION)
+        assert schedule.at(10 ** 12) is CALIBRATION
+
+        schedule = WarpSchedule(CALIBRATION, timeline)
+        calibration = schedule.at(10 ** 9)
+        assert (calibration.child_corners == PARENT).all()
+        assert (calibration.parent_bbox == CALIBRATION.parent_bbox).all()
+        # Same calibration object while the warp is unchanged.
+        assert schedule.at(2 * 10 ** 9) is calibration
+        assert (schedule.at(5 * 10 ** 9).child_corners == PARENT + 1).all()
+
+        # Segment starting 18 s into the recording.
+        schedule = WarpSchedule(CALIBRATION, timeline, offset=18 * 10 ** 9)
+        assert (schedule.at(0).child_corners == PARENT + 1).all()
+        assert (schedule.at(2 * 10 ** 9).child_corners == PARENT + 2).all()
+
+
+class _Capture(object):
+    def __init__(self, msec):
+        self.msec = msec
+
+    def get(self, property_id):
+        assert property_id == cv2.CAP_PROP_POS_MSEC
+        return self.msec
+
+
+def test_frame_pts():
+    # Stream timestamps (e.g., frames dropped while recording).
+    assert frame_pts(_Capture(0.), 0, 10.) == 0
+    assert frame_pts(_Capture(250.5), 1, 10.) == 250500000
+    # No timestamps: derived from frame index.
+    assert frame_pts(_Capture(0.), 3, 10.) == 3 * 10 ** 8
+    assert frame_pts(_Capture(-1.), 3, 10.) == 3 * 10 ** 8
+    assert frame_pts(_Capture(float('nan')), 3, 10.) == 3 * 10 ** 8
+
+
+def test_rectify_video():
+    with tempdir() as directory:
+        video_path = directory.joinpath('rec.avi')
+        writer = cv2.VideoWriter(str(video_path),
+                                 cv2.VideoWriter_fourcc(*'MJPG'), 10.,
+                                 (64, 48))
+        if not writer.isOpened():
+            raise SkipTest('`cv2` cannot write MJPG video.')
+        for i in xrange(5):
+            writer.write(np.full((48, 64, 3), 50 * i, dtype='uint8'))
+        writer.release()
+        save_calibration(sidecar_path(video_path), CALIBRATION)
+
+        jobs, skipped = find_jobs([directory])
+        counts = []
+        result = rectify_video(*jobs[0], fourcc='MJPG',
+                               on_frames=counts.append, frames_per_update=2)
+        output_path = jobs[0][2]
+        assert result['frames'] == 5 and sum(counts) == 5
+        assert not result['timeline']
+        assert output_path.isfile()
+        assert not partial_path(output_path).exists()
+        with open(done_path(output_path), 'r') as input_:
+            assert json.load(input_)['frames'] == 5
+        # Completed outputs are skipped.
+        assert find_jobs([directory]) == ([], [(video_path, 'done')])
@@ -0,0 +1,134 @@
+from unittest import SkipTest
+import json
+import os
+import stat
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from clutter_webcam_viewer.calibration import (WarpCalibration,
+                                               _atomic_write, _get_umask,
+                                               find_sidecar,
+                                               from_json, load_calibration,
+                                               load_calibrations,
+                                               save_calibration,
+                                               sidecar_path, to_json)
+from clutter_webcam_viewer.tests.helpers import tempdir
+
+
+CALIBRATION = WarpCalibration(np.array([0, 0, 640, 480.]),
+                              np.array([10, 20, 320, 240.]),
+                              np.array([[0, 0], [640, 0], [640, 480],
+                                        [0, 480.]]),
+                              np.array([[12, 25], [330, 18], [325, 260],
+                                        [8, 255.]]))
+
+
+def _assert_equal(calibration, expected):
+    for a, b in zip(calibration, expected):
+        assert_allclose(a, b)
+
+
+def test_homography():
+    homography = CALIBRATION.homography()
+    child = np.column_stack([CALIBRATION.child_corners, np.ones(4)])
+    parent = child.dot(homography.T)
+    assert_allclose(parent[:, :2] / parent[:, 2:],
+                    CALIBRATION.parent_corners, atol=1e-9)
+
+
+def test_json_round_trip():
+    _assert_equal(from_json(to_json(CALIBRATION)), CALIBRATION)
+    with tempdir() as directory:
+        warp_path = sidecar_path(directory.joinpath('video.avi'))
+        assert warp_path.name == 'video.warp.json'
+        save_calibration(warp_path, CALIBRATION)
+        _assert_equal(load_calibration(warp_path), CALIBRATION)
+        # Only the renamed file is left behind.
+        assert directory.files() == [warp_path]
+
+
+def test_from_json_invalid():
+    document = json.loads(to_json(CALIBRATION))
+    for key, value in (('format', 'something-else'), ('version', 1000)):
+        invalid = dict(document)
+        invalid[key] = value
+        try:
+            from_json(json.dumps(invalid))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Expected `ValueError` for %s=%r.' %
+                                 (key, value))
+
+
+def test_hdf_round_trip():
+    try:
+        import tables
+    except ImportError:
+        raise SkipTest('`tables` is not installed.')
+    with tempdir() as directory:
+        warp_path = directory.joinpath('video.h5')
+        save_calibration(warp_path, CALIBRATION)
+        _assert_equal(load_calibration(warp_path), CALIBRATION)
+
+
+def test_find_sidecar():
+    with tempdir() as directory:
+        video_path = directory.joinpath('video.avi')
+        assert find_sidecar(video_path) is None
+        hdf_path = directory.joinpath('video.h5')
+        hdf_path.touch()
+        assert find_sidecar(video_path) == hdf_path
+        # JSON sidecar is preferred.
+        save_calibration(sidecar_path(video_path), CALIBRATION)
+        assert find_sidecar(video_path) == sidecar_path(video_path)
+
+
+def test_load_calibrations():
+    with tempdir() as directory:
+        for name in ('b', 'a'):
+            save_calibration(directory.joinpath(name + '.warp.json'),
+                             CALIBRATION)
+        with open(directory.joinpath('invalid.warp.json'), 'w') as output:
+            output.write('{')
+        calibrations = load_calibrations(directory)
+        assert [p.name for p in calibrations] == ['a.warp.json',
+                                                  'b.warp.json']
+
+
+def test_atomic_write():
+    with tempdir() as directory:
+        output_path = directory.joinpath('output.txt')
+
+        def write(text):
+            def write_(tmp_path):
+                with open(tmp_path, 'w') as output:
+                    output.write(text)
+            return write_
+
+        umask = os.umask(027)
+        try:
+            assert _get_umask() == 027
+            _atomic_write(output_path, write('a'))
+        finally:
+            os.umask(umask)
+        # Default permissions of new files (rather than `0600`).
+        assert stat.S_IMODE(os.stat(output_path).st_mode) == 0640
+        # Existing file is replaced.
+        _atomic_write(output_path, write('b'))
+        assert output_path.bytes() == 'b'
+
+        def fail(tmp_path):
+            write('c')(tmp_path)
+            raise RuntimeError('Write failed.')
+
+        try:
+            _atomic_write(output_path, fail)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('Expected `RuntimeError`.')
+        # Existing file is untouched and temporary file is removed.
+        assert output_path.bytes() == 'b'
+        assert directory.files() == [output_path]
@@ -0,0 +1,102 @@
+from unittest import SkipTest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from clutter_webcam_viewer.homography import (find_homographies,
+                                              find_homography_4pt,
+                                              find_transform_4x4,
+                                              find_transforms_4x4,
+                                              homography_to_4x4)
+
+
+SQUARE = np.array([[0, 0], [640, 0], [640, 480], [0, 480]], dtype=float)
+
+
+def _corners(count, seed=0):
+    random = np.random.RandomState(seed)
+    jitter = random.uniform(-.2, .2, size=(count, 4, 2)) * [640, 480]
+    return SQUARE + jitter
+
+
+def _project(homography, points):
+    points = np.column_stack([points, np.ones(len(points))])
+    projected = points.dot(homography.T)
+    return projected[:, :2] / projected[:, 2:]
+
+
+def test_find_homography_4pt_maps_corners():
+    for src, dst in zip(_corners(20, seed=0), _corners(20, seed=1)):
+        homography = find_homography_4pt(src, dst)
+        assert homography[2, 2] == 1
+        assert_allclose(_project(homography, src), dst, atol=1e-6)
+
+
+def test_find_homography_4pt_matches_cv2():
+    try:
+        import cv2
+    except ImportError:
+        raise SkipTest('`cv2` is not installed.')
+    for src, dst in zip(_corners(20, seed=2), _corners(20, seed=3)):
+        expected = cv2.getPerspectiveTransform(src.astype('float32'),
+                                               dst.astype('float32'))
+        assert_allclose(find_homography_4pt(src, dst), expected, rtol=1e-4,
+                        atol=1e-6)
+
+
+def test_find_homography_4pt_collinear():
+    collinear = SQUARE.copy()
+    # Move third corner onto the line through the first two corners.
+    collinear[2] = [320, 0]
+    coincident = SQUARE.copy()
+    coincident[3] = coincident[0]
+    for degenerate in (collinear, coincident):
+        for src, dst in ((degenerate, SQUARE), (SQUARE, degenerate)):
+            try:
+                find_homography_4pt(src, dst)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('Expected `ValueError` for degenerate '
+                                     'corners.')
+
+
+def test_find_transform_4x4():
+    src, dst = _corners(2)
+    expected = homography_to_4x4(find_homography_4pt(src, dst))
+    out = np.empty((4, 4), dtype='float32')
+    assert find_transform_4x4(src, dst, out=out) is out
+    assert_allclose(out, expected)
+    # Maps `(x, y, 0, 1)` row vectors (i.e., Cogl matrix layout).
+    point = np.array([src[1, 0], src[1, 1], 0, 1]).dot(out.T)
+    assert_allclose(point[:2] / point[3], dst[1], rtol=1e-5)
+
+
+def test_find_homographies():
+    src = _corners(10, seed=4)
+    dst = _corners(10, seed=5)
+    # Degenerate source and destination corner sets.
+    src[3, 2] = src[3, 1]
+    dst[7, 1] = .5 * (dst[7, 0] + dst[7, 2])
+
+    homographies = find_homographies(src, dst)
+    assert homographies.shape == (10, 3, 3)
+    for i in xrange(10):
+        if i in (3, 7):
+            assert np.isnan(homographies[i]).all()
+        else:
+            assert_allclose(homographies[i], find_homography_4pt(src[i],
+                                                                 dst[i]),
+                            rtol=1e-9, atol=1e-12)
+    # Broadcast single source corner set.
+    assert_allclose(find_homographies(SQUARE, dst[:3]),
+                    find_homographies(np.tile(SQUARE, (3, 1, 1)), dst[:3]))
+
+
+def test_find_transforms_4x4():
+    src = _corners(5, seed=6)
+    dst = _corners(5, seed=7)
+    transforms = find_transforms_4x4(src, dst)
+    for i in xrange(5):
+        assert_allclose(transforms[i], find_transform_4x4(src[i], dst[i]),
+                        rtol=1e-5, atol=1e-6)
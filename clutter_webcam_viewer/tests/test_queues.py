@@ -0,0 +1,77 @@
+from unittest import SkipTest
+
+try:
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+except (ImportError, ValueError):
+    raise SkipTest('GStreamer (`gi`) is not installed.')
+
+from clutter_webcam_viewer.queues import (DEFAULT_PRESET, LEAKY, PRESETS,
+                                          BranchPolicies, QueueCounter,
+                                          QueuePolicy, get_policies)
+
+
+def test_presets():
+    assert get_policies().name == DEFAULT_PRESET
+    for name, policies in PRESETS.items():
+        assert get_policies(name) is policies
+        assert get_policies(policies) is policies
+        assert policies.name == name
+        # The display never blocks the tee.
+        assert policies.display.leaky != 'no'
+    assert PRESETS['never-stall-display'].record.leaky == 'downstream'
+    assert PRESETS['never-drop-recording'].record.leaky == 'no'
+    try:
+        get_policies('unknown')
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('Expected `KeyError`.')
+
+
+def test_policy():
+    try:
+        QueuePolicy('invalid', leaky='sideways')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected `ValueError`.')
+    policy = PRESETS[DEFAULT_PRESET].record
+    longer = policy.with_limits(max_time=5.)
+    assert longer.max_time == 5. and policy.max_time != 5.
+    assert (longer.leaky, longer.max_bytes) == (policy.leaky,
+                                                policy.max_bytes)
+    policies = BranchPolicies('custom', policy, longer)
+    assert get_policies(policies) is policies
+
+
+def test_apply():
+    Gst.init(None)
+    policy = QueuePolicy('test', max_buffers=7, max_bytes=1 << 20,
+                         max_time=.5, leaky='upstream')
+    queue = policy.create_queue('test_queue')
+    assert queue.get_name() == 'test_queue'
+    assert queue.get_property('max-size-buffers') == 7
+    assert queue.get_property('max-size-bytes') == 1 << 20
+    assert queue.get_property('max-size-time') == Gst.SECOND // 2
+    assert int(queue.get_property('leaky')) == LEAKY['upstream']
+
+
+def test_counter_dropped():
+    Gst.init(None)
+    for leaky in LEAKY:
+        queue = QueuePolicy('test', leaky=leaky).create_queue()
+        counter = QueueCounter(queue)
+        queue.emit('overrun')
+        queue.emit('overrun')
+        snapshot = counter.snapshot()
+        assert snapshot['overruns'] == 2
+        assert snapshot['leaky'] == leaky
+        # Only leaky queues drop buffers (one per overrun).
+        assert snapshot['dropped'] == (0 if leaky == 'no' else 2)
+        assert (snapshot['in'], snapshot['out'], snapshot['queued']) == \
+            (0, 0, 0)
+        counter.remove()
+        queue.emit('overrun')
+        assert counter.snapshot()['overruns'] == 2
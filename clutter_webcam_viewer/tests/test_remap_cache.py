@@ -0,0 +1,199 @@
+from unittest import SkipTest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from clutter_webcam_viewer.calibration import WarpCalibration
+from clutter_webcam_viewer.remap_cache import (RemapCache, RemapTables,
+                                               frame_homography, load_tables,
+                                               nearest_coordinates,
+                                               remap_maps, remap_path,
+                                               save_tables, to_fixed_point)
+from clutter_webcam_viewer.tests.helpers import tempdir
+
+
+SHAPE = (120, 160)
+CALIBRATION = WarpCalibration(np.array([0, 0, 640, 480.]),
+                              np.array([0, 0, 640, 480.]),
+                              np.array([[0, 0], [640, 0], [640, 480],
+                                        [0, 480.]]),
+                              np.array([[40, 25], [610, 10], [630, 470],
+                                        [15, 440.]]))
+
+
+def _cv2():
+    try:
+        import cv2
+    except ImportError:
+        raise SkipTest('`cv2` is not installed.')
+    return cv2
+
+
+def _image(shape=SHAPE, seed=0):
+    random = np.random.RandomState(seed)
+    # Smooth image, such that interpolation differences are small.
+    image = random.randint(0, 256, size=(shape[0] // 8, shape[1] // 8, 3))
+    return np.kron(image, np.ones((8, 8, 1))).astype('uint8')
+
+
+def _project(homography, points):
+    points = np.column_stack([points, np.ones(len(points))])
+    projected = points.dot(homography.T)
+    return projected[:, :2] / projected[:, 2:]
+
+
+def test_frame_homography():
+    # Calibration frame (640x480) to frame pixels (160x120).
+    homography = frame_homography(CALIBRATION, SHAPE)
+    assert_allclose(_project(homography, CALIBRATION.child_corners / 4),
+                    CALIBRATION.parent_corners / 4, atol=1e-9)
+
+    identity = CALIBRATION._replace(child_corners=
+                                    CALIBRATION.parent_corners)
+    assert_allclose(frame_homography(identity, SHAPE), np.identity(3),
+                    atol=1e-12)
+
+
+def test_frame_homography_aspect_fit():
+    # Wide (2:1) stage, with the warp moving the frame corners inside it.
+    parent_corners = np.array([[110, 70], [710, 40], [760, 390], [60, 360.]])
+    calibration = WarpCalibration(np.array([10, 20, 800, 400.]),
+                                  np.array([10, 20, 800, 400.]),
+                                  parent_corners,
+                                  np.array([[10, 20], [810, 20], [810, 420],
+                                            [10, 420.]]))
+    frame_corners = np.array([[0, 0], [800, 0], [800, 400], [0, 400.]])
+    # Relative position of each corner within the stage.
+    relative = (parent_corners - [10, 20]) / [800, 400]
+    # 4:3 output frame: stage is scaled by .8 (to 640x320) and centred
+    # vertically.
+    homography = frame_homography(calibration, (400, 800), (480, 640))
+    assert_allclose(_project(homography, frame_corners),
+                    [0, 80] + relative * [640, 320], atol=1e-9)
+    # Wider output frame: stage is centred horizontally.
+    homography = frame_homography(calibration, (400, 800), (400, 1000))
+    assert_allclose(_project(homography, frame_corners),
+                    [100, 0] + relative * [800, 400], atol=1e-9)
+
+
+def test_remap_maps():
+    homography = frame_homography(CALIBRATION, SHAPE)
+    map_x, map_y = remap_maps(homography, SHAPE)
+    assert map_x.shape == map_y.shape == SHAPE
+    assert map_x.dtype == map_y.dtype == np.float32
+    # Each output pixel maps back to itself.
+    inputs = np.column_stack([map_x.ravel(), map_y.ravel(),
+                              np.ones(map_x.size)]).dot(homography.T)
+    y, x = np.mgrid[:SHAPE[0], :SHAPE[1]]
+    assert_allclose(inputs[:, 0] / inputs[:, 2], x.ravel(), atol=1e-3)
+    assert_allclose(inputs[:, 1] / inputs[:, 2], y.ravel(), atol=1e-3)
+
+
+def test_to_fixed_point_matches_cv2():
+    cv2 = _cv2()
+    map_x, map_y = remap_maps(frame_homography(CALIBRATION, SHAPE), SHAPE)
+    map1, map2 = to_fixed_point(map_x, map_y)
+    expected1, expected2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    assert map1.dtype == expected1.dtype and map2.dtype == expected2.dtype
+    assert (map1 == expected1).all()
+    assert (map2 == expected2).all()
+
+
+def test_remap_matches_warp_perspective():
+    cv2 = _cv2()
+    homography = frame_homography(CALIBRATION, SHAPE)
+    image = _image()
+    expected = cv2.warpPerspective(image, homography, SHAPE[::-1],
+                                   flags=cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_CONSTANT)
+    for fixed_point in (True, False):
+        tables = RemapTables.build(homography, SHAPE,
+                                   fixed_point=fixed_point)
+        assert tables.fixed_point == fixed_point
+        rectified = cv2.remap(image, tables.map1, tables.map2,
+                              cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_CONSTANT)
+        # Ignore pixels along the border of the warped frame.
+        inside = cv2.erode((expected > 0).all(axis=-1).astype('uint8'),
+                           np.ones((3, 3), dtype='uint8')).astype(bool)
+        difference = np.abs(rectified.astype(int) - expected)[inside]
+        assert difference.max() <= 2
+
+
+def test_nearest_coordinates():
+    homography = frame_homography(CALIBRATION, SHAPE)
+    fixed = RemapTables.build(homography, SHAPE, fixed_point=True)
+    floating = RemapTables.build(homography, SHAPE, fixed_point=False)
+    for x, y in (nearest_coordinates(fixed), nearest_coordinates(floating)):
+        # Nearest pixel (up to the fixed-point resolution).
+        assert np.abs(x - floating.map1).max() <= .5 + 1. / 32
+        assert np.abs(y - floating.map2).max() <= .5 + 1. / 32
+
+
+def test_cache():
+    cache = RemapCache()
+    homography = frame_homography(CALIBRATION, SHAPE)
+    tables = cache.get(homography, SHAPE)
+    assert (cache.hits, cache.misses) == (0, 1)
+    # Homographies equal up to scale share tables.
+    assert cache.get(2 * homography, SHAPE) is tables
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.get(homography, (SHAPE[0] // 2, SHAPE[1] // 2)) is not tables
+    assert len(cache) == 2
+    assert cache.nbytes == sum(t.nbytes for t in cache._entries.values())
+
+
+def test_cache_eviction():
+    tables = [RemapTables.build(frame_homography(CALIBRATION, SHAPE) *
+                                [[1, 1, i], [1, 1, 1], [1, 1, 1]], SHAPE)
+              for i in xrange(3)]
+    cache = RemapCache(max_bytes=2 * tables[0].nbytes)
+    cache.put(tables[0])
+    cache.put(tables[1])
+    # Most recently used.
+    assert cache.get(tables[0].homography, SHAPE) is tables[0]
+    cache.put(tables[2])
+    assert len(cache) == 2 and cache.evictions == 1
+    assert tables[1].key not in cache._entries
+    assert cache.nbytes <= cache.max_bytes
+
+    # Tables larger than the cap are not cached.
+    small = RemapCache(max_bytes=tables[0].nbytes - 1)
+    small.get(tables[0].homography, SHAPE)
+    assert len(small) == 0 and small.nbytes == 0
+
+
+def test_save_load():
+    with tempdir() as directory:
+        tables_path = remap_path(directory.joinpath('video.warp.json'))
+        assert tables_path.name == 'video.warp.remap.npz'
+        cache = RemapCache()
+        # Nothing cached.
+        assert cache.save(tables_path, CALIBRATION) is None
+        assert not tables_path.exists()
+        # Tables for the requested frame shapes are built.
+        shapes = [SHAPE, (SHAPE[0] // 2, SHAPE[1] // 2)]
+        cache.save(tables_path, CALIBRATION, shapes=shapes)
+        saved = load_tables(tables_path)
+        assert sorted(t.shape for t in saved) == sorted(shapes)
+
+        loaded = RemapCache()
+        assert loaded.load(tables_path) == 2
+        for shape in shapes:
+            expected = cache.get(frame_homography(CALIBRATION, shape), shape)
+            tables = loaded.get(frame_homography(CALIBRATION, shape), shape)
+            assert loaded.misses == 0
+            assert (tables.map1 == expected.map1).all()
+            assert (tables.map2 == expected.map2).all()
+        # Tables in a different format are skipped.
+        assert RemapCache(fixed_point=False).load(tables_path) == 0
+
+
+def test_load_tables_invalid_shape():
+    with tempdir() as directory:
+        tables = RemapTables.build(frame_homography(CALIBRATION, SHAPE),
+                                   SHAPE)
+        tables.shape = (SHAPE[0] + 1, SHAPE[1])
+        tables_path = directory.joinpath('video.remap.npz')
+        save_tables(tables_path, [tables])
+        assert load_tables(tables_path) == []
@@ -0,0 +1,122 @@
+from unittest import SkipTest
+import json
+
+from path_helpers import path
+
+from clutter_webcam_viewer.segments import (SegmentManifest, SegmentPolicy,
+                                            find_segment, finished_segments,
+                                            load_manifest, manifest_path,
+                                            segment_location)
+from clutter_webcam_viewer.tests.helpers import tempdir
+from clutter_webcam_viewer.writer import MetadataWriter
+
+
+SECOND = 1000000000
+
+
+def _require_gst():
+    try:
+        import gi
+        gi.require_version('Gst', '1.0')
+        from gi.repository import Gst
+    except (ImportError, ValueError):
+        raise SkipTest('GStreamer (`gi`) is not installed.')
+
+
+def test_paths():
+    output_path = path('/videos/rec 50%.avi')
+    location = segment_location(output_path)
+    assert location == '/videos/rec 50%%-%05d.avi'
+    assert location % 3 == '/videos/rec 50%-00003.avi'
+    assert manifest_path(output_path) == path('/videos/rec 50%.segments.json')
+
+
+def test_policy():
+    try:
+        SegmentPolicy(max_time=0, max_bytes=0)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected `ValueError`.')
+    policy = SegmentPolicy(max_time=0, max_bytes=1 << 20, max_files=3)
+    assert (policy.max_time, policy.max_bytes, policy.max_files) == \
+        (0, 1 << 20, 3)
+
+
+def _record(directory, writer, policy, count, start=7 * SECOND):
+    '''
+    Open (and close) `count` segments of 10 seconds, the last one left open.
+    '''
+    output_path = directory.joinpath('rec.avi')
+    manifest = SegmentManifest(output_path, policy, writer=writer)
+    location = segment_location(output_path)
+    for i in xrange(count):
+        location_i = location % (i % policy.max_files if policy.max_files
+                                 else i)
+        if i:
+            manifest.close(manifest.current, start + i * 10 * SECOND)
+        with open(location_i, 'wb') as output:
+            output.write('x' * (i + 1))
+        manifest.open(location_i, start + i * 10 * SECOND)
+    return output_path, manifest
+
+
+def test_manifest():
+    _require_gst()
+    with tempdir() as directory:
+        writer = MetadataWriter()
+        output_path, manifest = _record(directory, writer,
+                                        SegmentPolicy(max_time=10.), 3)
+        assert manifest.current == directory.joinpath('rec-00002.avi')
+        assert writer.close(5)
+
+        document = load_manifest(manifest_path(output_path))
+        assert document == manifest.to_dict()
+        assert document['output_path'] == output_path
+        assert document['max_time'] == 10.
+        segments = document['segments']
+        assert [s['index'] for s in segments] == [0, 1, 2]
+        # Seconds since the start of the first segment.
+        assert [(s['start'], s['end']) for s in segments] == \
+            [(0, 10), (10, 20), (20, None)]
+        assert [s['bytes'] for s in segments] == [1, 2, None]
+        assert finished_segments(document) == [segments[0]['path'],
+                                               segments[1]['path']]
+
+
+def test_manifest_max_files():
+    _require_gst()
+    with tempdir() as directory:
+        writer = MetadataWriter()
+        output_path, manifest = _record(directory, writer,
+                                        SegmentPolicy(max_time=10.,
+                                                      max_files=2), 5)
+        assert writer.close(5)
+        segments = load_manifest(manifest_path(output_path))['segments']
+        # Overwritten segments are dropped.
+        assert [(s['index'], path(s['path']).name) for s in segments] == \
+            [(3, 'rec-00001.avi'), (4, 'rec-00000.avi')]
+        assert segments[0]['start'] == 30
+
+
+def test_find_segment():
+    with tempdir() as directory:
+        output_path = directory.joinpath('rec.avi')
+        segment_path = directory.joinpath('rec-00001.avi')
+        # No manifest.
+        assert find_segment(segment_path) is None
+        segments = [{'index': i, 'path': '/elsewhere/rec-%05d.avi' % i,
+                     'start': 600. * i, 'end': None, 'bytes': None,
+                     'closed': False} for i in xrange(2)]
+        with open(manifest_path(output_path), 'w') as output:
+            json.dump({'segments': segments}, output)
+        # Matched by file name (e.g., recording was moved).
+        assert find_segment(segment_path) == (output_path, segments[1])
+        # Not listed in the manifest, or not a segment name.
+        assert find_segment(directory.joinpath('rec-00002.avi')) is None
+        assert find_segment(output_path) is None
+        assert find_segment(directory.joinpath('rec-1.avi')) is None
+
+        with open(manifest_path(output_path), 'w') as output:
+            output.write('{')
+        assert find_segment(segment_path) is None
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+from clutter_webcam_viewer.spatial import (PathIndex, _grid_of_paths,
+                                           path_geometry, points_from_frame,
+                                           points_in_polygon, triangulate)
+
+
+def _brute_force_path_at(vertices, offsets, x, y):
+    for i in xrange(len(offsets) - 2, -1, -1):
+        path = vertices[offsets[i]:offsets[i + 1]]
+        edges = np.hstack([path[:-1], path[1:]])
+        if points_in_polygon(x, y, edges):
+            return i
+    return None
+
+
+def _random_paths(count, seed=0):
+    '''
+    Return `(vertices, offsets)` of `count` random (possibly overlapping and
+    concave) star-shaped polygons, each including a closing vertex.
+    '''
+    random = np.random.RandomState(seed)
+    paths = []
+    for i in xrange(count):
+        vertex_count = random.randint(3, 12)
+        theta = np.sort(random.uniform(0, 2 * np.pi, vertex_count))
+        radius = random.uniform(.2, 2., vertex_count)
+        center = random.uniform(0, 10, 2)
+        path = center + radius[:, None] * np.column_stack([np.cos(theta),
+                                                           np.sin(theta)])
+        paths.append(np.vstack([path, path[:1]]))
+    offsets = np.concatenate([[0], np.cumsum([len(p) for p in paths])])
+    return np.concatenate(paths), offsets
+
+
+def _area(polygon):
+    x, y = np.asarray(polygon, dtype=float).T
+    return .5 * (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+
+def _check_triangulation(polygon):
+    '''
+    Check that the triangles of a simple polygon are counter-clockwise (for
+    either orientation of the polygon) and cover the polygon (i.e., have the
+    same total area, with every triangle inside the polygon).
+    '''
+    polygon = np.asarray(polygon, dtype=float)
+    triangles = triangulate(polygon)
+    assert triangles.shape == (len(polygon) - 2, 3)
+    areas = np.array([_area(polygon[t]) for t in triangles])
+    assert (areas > 0).all()
+    np.testing.assert_allclose(areas.sum(), abs(_area(polygon)))
+    closed = np.vstack([polygon, polygon[:1]])
+    edges = np.hstack([closed[:-1], closed[1:]])
+    for x, y in polygon[triangles].mean(axis=1):
+        assert points_in_polygon(x, y, edges)
+
+
+def test_triangulate_convex():
+    square = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=float)
+    _check_triangulation(square)
+    _check_triangulation(square[::-1])
+    # Closing vertex is ignored.
+    assert (triangulate(np.vstack([square, square[:1]])) ==
+            triangulate(square)).all()
+
+
+def test_triangulate_concave():
+    l_shape = np.array([[0, 0], [2, 0], [2, 1], [1, 1], [1, 2], [0, 2]],
+                       dtype=float)
+    theta = np.linspace(0, 2 * np.pi, 10, endpoint=False)
+    radius = np.where(np.arange(10) % 2, .4, 1.)
+    star = radius[:, None] * np.column_stack([np.cos(theta), np.sin(theta)])
+    for polygon in (l_shape, star):
+        # Both orientations.
+        _check_triangulation(polygon)
+        _check_triangulation(polygon[::-1])
+
+
+def test_triangulate_degenerate():
+    assert triangulate(np.zeros((0, 2))).shape == (0, 3)
+    assert triangulate([[0, 0], [1, 1], [0, 0]]).shape == (0, 3)
+
+
+def test_path_geometry():
+    vertices, offsets = _random_paths(10, seed=2)
+    fill, fill_offsets, outline, outline_offsets = path_geometry(vertices,
+                                                                 offsets)
+    assert fill.dtype == outline.dtype == np.float32
+    for i in xrange(10):
+        path = vertices[offsets[i]:offsets[i + 1]]
+        # Excluding closing vertex.
+        count = len(path) - 1
+        fill_i = fill[fill_offsets[i]:fill_offsets[i + 1]]
+        outline_i = outline[outline_offsets[i]:outline_offsets[i + 1]]
+        assert len(fill_i) == 3 * (count - 2)
+        np.testing.assert_allclose(sum(abs(_area(t)) for t in
+                                       fill_i.reshape(-1, 3, 2)),
+                                   abs(_area(path[:-1])), rtol=1e-5)
+        # One line segment per edge (including the closing edge).
+        np.testing.assert_allclose(outline_i.reshape(-1, 2, 2),
+                                   np.stack([path[:-1], path[1:]], axis=1),
+                                   rtol=1e-6)
+
+
+def test_points_in_polygon():
+    square = np.array([[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]], dtype=float)
+    edges = np.hstack([square[:-1], square[1:]])
+    assert points_in_polygon(1, 1, edges)
+    assert not points_in_polygon(3, 1, edges)
+    assert not points_in_polygon(1, -1, edges)
+
+
+def test_path_index_matches_brute_force():
+    random = np.random.RandomState(1)
+    for vertices, offsets in (_grid_of_paths(50), _random_paths(40)):
+        index = PathIndex(vertices, offsets)
+        lower = vertices.min(axis=0) - 1
+        upper = vertices.max(axis=0) + 1
+        for x, y in random.uniform(lower, upper, size=(500, 2)):
+            assert (index.path_at(x, y) ==
+                    _brute_force_path_at(vertices, offsets, x, y))
+
+
+def test_path_index_overlapping_paths():
+    square = np.array([[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]], dtype=float)
+    vertices = np.vstack([square, square + 2, square + 1])
+    offsets = np.array([0, 5, 10, 15])
+    index = PathIndex(vertices, offsets)
+    # Last drawn path containing the point.
+    assert index.path_at(2.5, 2.5) == 2
+    assert index.path_at(.5, .5) == 0
+    assert index.path_at(5.5, 5.5) == 1
+    assert index.path_at(5.5, .5) is None
+    assert index.path_at(-10, 50) is None
+
+
+def test_path_index_from_frame():
+    df_paths = pd.DataFrame([['b', 0, 0], ['b', 1, 0], ['b', 1, 1],
+                             ['b', 0, 0], ['a', 2, 2], ['a', 3, 2],
+                             ['a', 3, 3], ['a', 2, 2]],
+                            columns=['path_id', 'x', 'y'])
+    path_ids, vertices, offsets = points_from_frame(df_paths)
+    assert path_ids == ['a', 'b']
+    assert offsets.tolist() == [0, 4, 8]
+    assert vertices[:4].tolist() == [[2, 2], [3, 2], [3, 3], [2, 2]]
+
+    path_ids, index = PathIndex.from_frame(df_paths)
+    assert path_ids[index.path_at(.8, .2)] == 'b'
+    assert path_ids[index.path_at(2.8, 2.2)] == 'a'
+    assert index.path_at(.2, .8) is None
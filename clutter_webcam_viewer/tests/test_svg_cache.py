@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from clutter_webcam_viewer.svg_cache import (CacheEntry, Frames, cache_key,
+                                             load_frames)
+from clutter_webcam_viewer.tests.helpers import tempdir
+
+
+def _frames():
+    df_device = pd.DataFrame({'path_id': ['a', 'a', 'a', 'b', 'b', 'b'],
+                              'vertex_i': np.arange(6),
+                              'x': np.linspace(0, 1, 6),
+                              'y': np.linspace(1, 2, 6),
+                              'layer': ['l0'] * 3 + ['l1'] * 3},
+                             columns=['path_id', 'vertex_i', 'x', 'y',
+                                      'layer'], index=np.arange(10, 16))
+    df_paths = pd.DataFrame({'x_center': [.2, .8], 'area': [1., 2.]},
+                            index=pd.Index(['a', 'b'], name='path_id'))
+    return df_device, df_paths
+
+
+class _Process(object):
+    def __init__(self, frames):
+        self.frames = frames
+        self.count = 0
+
+    def __call__(self, svg_path):
+        self.count += 1
+        return self.frames
+
+
+def _svg(directory, content='<svg/>'):
+    svg_path = directory.joinpath('device.svg')
+    with open(svg_path, 'w') as output:
+        output.write(content)
+    return svg_path
+
+
+def test_load_frames():
+    with tempdir() as directory:
+        svg_path = _svg(directory)
+        cache_dir = directory.joinpath('cache')
+        process = _Process(_frames())
+
+        frames = load_frames(svg_path, process, cache_dir=cache_dir)
+        assert isinstance(frames, Frames) and process.count == 1
+        entry = load_frames(svg_path, process, cache_dir=cache_dir)
+        assert isinstance(entry, CacheEntry) and process.count == 1
+        df_device, df_paths = _frames()
+        assert_frame_equal(entry.df_device, df_device)
+        assert_frame_equal(entry.df_paths, df_paths)
+        # Frames are built once.
+        assert entry.df_device is entry.df_device
+        # Loaded frames may be modified (without modifying the entry).
+        entry.df_device.loc[10, 'x'] = 100
+        entry = load_frames(svg_path, process, cache_dir=cache_dir)
+        assert_frame_equal(entry.df_device, df_device)
+
+        # Modified SVG file.
+        key = cache_key(svg_path)
+        _svg(directory, '<svg></svg>')
+        assert cache_key(svg_path) != key
+        assert isinstance(load_frames(svg_path, process,
+                                      cache_dir=cache_dir), Frames)
+        assert process.count == 2
+
+
+def test_index():
+    with tempdir() as directory:
+        svg_path = _svg(directory)
+        cache_dir = directory.joinpath('cache')
+        df_device, df_paths = _frames()
+        df_device.reset_index(drop=True, inplace=True)
+        df_paths.index = df_paths.index.astype(object)
+        process = _Process((df_device, df_paths))
+        load_frames(svg_path, process, cache_dir=cache_dir)
+        entry = load_frames(svg_path, process, cache_dir=cache_dir)
+        assert isinstance(entry, CacheEntry)
+        assert isinstance(entry.df_device.index, pd.RangeIndex)
+        assert_frame_equal(entry.df_device, df_device, check_index_type=True)
+        assert_frame_equal(entry.df_paths, df_paths, check_index_type=True)
+
+
+def test_corrupted_entry():
+    with tempdir() as directory:
+        svg_path = _svg(directory)
+        cache_dir = directory.joinpath('cache')
+        process = _Process(_frames())
+        load_frames(svg_path, process, cache_dir=cache_dir)
+        entry_dir = cache_dir.joinpath(cache_key(svg_path))
+        # Truncate one of the arrays.
+        block_path = sorted(entry_dir.files('device-block-*.npy'))[0]
+        np.save(block_path, np.zeros((1, 1)))
+
+        frames = load_frames(svg_path, process, cache_dir=cache_dir)
+        assert isinstance(frames, Frames) and process.count == 2
+        # Entry is replaced.
+        entry = load_frames(svg_path, process, cache_dir=cache_dir)
+        assert isinstance(entry, CacheEntry) and process.count == 2
+        assert_frame_equal(entry.df_device, _frames()[0])
+
+
+def test_unsupported_dtype():
+    with tempdir() as directory:
+        svg_path = _svg(directory)
+        cache_dir = directory.joinpath('cache')
+        df_device, df_paths = _frames()
+        # Labels that are not JSON-serializable.
+        df_device['path_id'] = [object()] * len(df_device)
+        process = _Process((df_device, df_paths))
+        for i in xrange(2):
+            frames = load_frames(svg_path, process, cache_dir=cache_dir)
+            assert isinstance(frames, Frames)
+            assert frames.df_device is df_device
+        assert process.count == 2
+        # No partial entry is left behind.
+        assert not cache_dir.exists() or cache_dir.listdir() == []
@@ -0,0 +1,153 @@
+import time
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from clutter_webcam_viewer.homography import find_homography_4pt
+from clutter_webcam_viewer.timeline import (HEADER, RECORD_DTYPE,
+                                            WarpTimeline,
+                                            WarpTimelineRecorder,
+                                            WarpTimelineWriter, timeline_path)
+from clutter_webcam_viewer.tests.helpers import tempdir
+from clutter_webcam_viewer.writer import MetadataWriter, get_writer
+
+
+PARENT = np.array([[0, 0], [640, 0], [640, 480], [0, 480]], dtype=float)
+
+
+def _child(i):
+    return PARENT + [[i, 0], [0, i], [-i, 0], [0, -i]]
+
+
+def _write(output_path, count, chunk_size=4):
+    writer = MetadataWriter()
+    timeline = WarpTimelineWriter(output_path, chunk_size=chunk_size,
+                                  flush_interval=60., writer=writer)
+    for i in xrange(count):
+        timeline.append(i * 1000, PARENT, _child(i))
+    assert timeline.close().wait(5)
+    assert writer.close(5)
+    return timeline
+
+
+def test_round_trip():
+    with tempdir() as directory:
+        output_path = timeline_path(directory.joinpath('video.avi'))
+        assert output_path.name == 'video.warp-timeline'
+        # Several chunks, the last one partial.
+        assert _write(output_path, 10).record_count == 10
+
+        timeline = WarpTimeline(output_path)
+        assert len(timeline) == 10
+        assert (timeline.pts == np.arange(10) * 1000).all()
+        for i, record in enumerate(timeline.records):
+            assert_allclose(record['child_corners'], _child(i))
+            assert_allclose(record['parent_corners'], PARENT)
+            assert_allclose(record['homography'],
+                            find_homography_4pt(_child(i), PARENT))
+
+
+def test_flush_interval():
+    with tempdir() as directory:
+        output_path = timeline_path(directory.joinpath('video.avi'))
+        writer = MetadataWriter()
+        timeline = WarpTimelineWriter(output_path, chunk_size=100,
+                                      flush_interval=.05, writer=writer)
+        timeline.append(0, PARENT, _child(0))
+        timeline.append(1000, PARENT, _child(1))
+        # Buffered records are written without further appends.
+        for i in xrange(100):
+            time.sleep(.02)
+            assert writer.flush(5)
+            if len(WarpTimeline(output_path)) == 2:
+                break
+        else:
+            raise AssertionError('Records not flushed.')
+        timeline.append(2000, PARENT, _child(2))
+        assert timeline.close().wait(5)
+        assert writer.close(5)
+        assert WarpTimeline(output_path).pts.tolist() == [0, 1000, 2000]
+
+
+def test_lookup():
+    with tempdir() as directory:
+        output_path = directory.joinpath('video.warp-timeline')
+        _write(output_path, 3)
+        timeline = WarpTimeline(output_path)
+        assert timeline.index_at(-1) == -1
+        assert timeline.record_at(-1) is None
+        assert timeline.homography_at(-1) is None
+        # Record in effect is the last record at or before `pts`.
+        assert (timeline.index_at([0, 999, 1000, 1500, 10 ** 9]) ==
+                [0, 0, 1, 1, 2]).all()
+        assert timeline.record_at(1999)['pts'] == 1000
+        # Times before the first record use the first record.
+        homographies = timeline.homographies_at([-5, 2500])
+        assert_allclose(homographies[0], timeline.records['homography'][0])
+        assert_allclose(homographies[1], timeline.records['homography'][2])
+
+
+def test_truncated():
+    with tempdir() as directory:
+        output_path = directory.joinpath('video.warp-timeline')
+        _write(output_path, 3)
+        # Partial trailing record (e.g., recording process was killed).
+        with open(output_path, 'ab') as output:
+            output.write('\0' * (RECORD_DTYPE.itemsize // 2))
+        assert len(WarpTimeline(output_path)) == 3
+
+        # Header only.
+        with open(output_path, 'r+b') as output:
+            output.truncate(HEADER.size)
+        assert len(WarpTimeline(output_path)) == 0
+
+        for data in ('', 'NOTATIMELINE' + '\0' * 16):
+            with open(output_path, 'wb') as output:
+                output.write(data)
+            try:
+                WarpTimeline(output_path)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('Expected `ValueError`.')
+
+
+class _State(object):
+    def __init__(self, child_corners):
+        self.initialized = True
+        self.parent_corners = PARENT.copy()
+        self.child_corners = child_corners
+
+
+class _WarpActor(object):
+    def __init__(self):
+        self.state = _State(_child(0))
+
+
+def test_recorder():
+    with tempdir() as directory:
+        warp_actor = _WarpActor()
+        recording_time = [None]
+        recorder = WarpTimelineRecorder(warp_actor, lambda:
+                                        recording_time[0])
+        # Not recording.
+        recorder.on_transform_changed(warp_actor.state)
+
+        video_path = directory.joinpath('video.avi')
+        recorder.set_record_path(video_path)
+        timeline = recorder.timeline
+        # Change before the first recorded frame applies from the start.
+        recorder.on_transform_changed(_State(_child(1)))
+        recording_time[0] = 5000
+        recorder.on_transform_changed(_State(_child(2)))
+        # Unchanged if already recording to the same path.
+        recorder.set_record_path(video_path)
+        assert recorder.timeline is timeline
+        recorder.set_record_path(None)
+        assert recorder.timeline is None
+        assert get_writer().flush(5)
+
+        records = WarpTimeline(timeline_path(video_path)).records
+        assert records['pts'].tolist() == [0, 0, 5000]
+        for i, record in enumerate(records):
+            assert_allclose(record['child_corners'], _child(i))
@@ -0,0 +1,100 @@
+import threading
+
+from clutter_webcam_viewer.writer import MetadataWriter
+
+
+def test_order_and_results():
+    writer = MetadataWriter()
+    written = []
+    results = [writer.submit(None, written.append, i) for i in xrange(5)]
+    assert writer.flush(5)
+    assert written == range(5)
+    assert all(r.done() and r.result() is None for r in results)
+
+    def fail():
+        raise IOError('Disk full.')
+
+    result = writer.submit('key', fail)
+    try:
+        result.result(5)
+    except IOError:
+        pass
+    else:
+        raise AssertionError('Expected `IOError`.')
+    assert writer.close(5)
+    try:
+        writer.submit(None, written.append, 5)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Expected `RuntimeError` (writer is closed).')
+
+
+def test_coalesce_and_never_block():
+    writer = MetadataWriter()
+    started = threading.Event()
+    release = threading.Event()
+    finished = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+        finished.set()
+
+    writer.submit(None, block)
+    assert started.wait(5)
+    written = []
+    # Writer is busy: writes with the same key are coalesced, and any number
+    # of distinct keyed writes are queued without blocking.
+    first = writer.submit('key', written.append, 'a')
+    second = writer.submit('key', written.append, 'b')
+    assert first is second
+    for i in xrange(500):
+        writer.submit(('other', i), written.append, i)
+    assert writer.coalesced_count == 1
+    assert not finished.is_set()
+    release.set()
+    assert writer.close(5)
+    assert written == ['b'] + range(500)
+    assert first.result() is None
+
+
+def test_drop_oldest_unkeyed():
+    writer = MetadataWriter(max_pending=4)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    writer.submit(None, block)
+    assert started.wait(5)
+    written = []
+    keyed = writer.submit('key', written.append, 'key')
+    results = [writer.submit(None, written.append, i) for i in xrange(6)]
+    # Queue is full: each new unkeyed write dropped the oldest unkeyed write
+    # (without blocking), while the keyed write is kept.
+    assert writer.dropped_count == 3
+    assert all(r.done() for r in results[:3])
+    try:
+        results[0].result()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Expected `RuntimeError` (write dropped).')
+    release.set()
+    assert writer.close(5)
+    assert written == ['key', 3, 4, 5]
+    assert keyed.done()
+
+
+def test_done_callback():
+    writer = MetadataWriter()
+    called = []
+    result = writer.submit(None, lambda: 42)
+    result.add_done_callback(lambda r: called.append(r.value))
+    assert writer.close(5)
+    # Called immediately once done.
+    result.add_done_callback(lambda r: called.append(r.value))
+    assert called == [42, 42]
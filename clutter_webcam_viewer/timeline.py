@@ -0,0 +1,278 @@
+'''
+Append-only timeline of perspective warp changes during a recording.
+
+Each record holds the time of a warp change (in nanoseconds, relative to the
+first frame of the recording), the parent/child corner correspondences, and
+the resulting child-to-parent homography.  The warp in effect for a frame is
+the last record with a time less than or equal to the frame timestamp.
+
+File layout:
+
+ - 16 byte header: `MAGIC` (8 bytes), format version, and record size (both
+   little-endian `uint32`).
+ - Fixed-size `RECORD_DTYPE` records, in increasing time order.
+
+Records are buffered in fixed-size chunks, which are appended to the file on
+the background writer thread (see `writer.get_writer`) once full or after at
+most `flush_interval` seconds, so memory use is constant regardless of
+recording length.  A trailing partial record (e.g., if
+the recording process was killed) is ignored by the reader.
+'''
+import struct
+import threading
+
+import numpy as np
+from path_helpers import path
+
+from .homography import find_homography_4pt
+from .writer import get_writer
+
+
+MAGIC = 'CWVWARPT'
+FORMAT_VERSION = 1
+RECORD_DTYPE = np.dtype([('pts', '<i8'),
+                         ('parent_corners', '<f8', (4, 2)),
+                         ('child_corners', '<f8', (4, 2)),
+                         ('homography', '<f8', (3, 3))])
+HEADER = struct.Struct('<8sII')
+TIMELINE_EXTENSION = '.warp-timeline'
+
+
+def timeline_path(video_path):
+    '''
+    Return path of warp timeline file to write next to a recorded video.
+    '''
+    video_path = path(video_path)
+    return video_path.parent.joinpath(video_path.namebase + TIMELINE_EXTENSION)
+
+
+def _write_header(output_path):
+    with open(output_path, 'wb') as output:
+        output.write(HEADER.pack(MAGIC, FORMAT_VERSION,
+                                 RECORD_DTYPE.itemsize))
+
+
+def _append_records(output_path, records):
+    with open(output_path, 'ab') as output:
+        output.write(records.tobytes())
+
+
+class WarpTimelineWriter(object):
+    '''
+    Incrementally write warp timeline for a recording.
+
+    Records are appended from a single (e.g., the Clutter) thread.  Buffered
+    records are flushed from a timer thread once they have been held for
+    `flush_interval` seconds.
+
+    Arguments
+    ---------
+
+     - `output_path`: Timeline output path (truncated if it exists).
+     - `chunk_size`: Number of records buffered before appending to file.
+     - `flush_interval`: Maximum time (in seconds) buffered records are held
+       before being appended to file.
+     - `writer`: `writer.MetadataWriter` (default: `writer.get_writer()`).
+    '''
+    def __init__(self, output_path, chunk_size=256, flush_interval=1.,
+                 writer=None):
+        self.output_path = path(output_path).abspath()
+        self.writer = get_writer() if writer is None else writer
+        self.flush_interval = flush_interval
+        self._chunk = np.zeros(chunk_size, dtype=RECORD_DTYPE)
+        self._count = 0
+        self._lock = threading.Lock()
+        # Timer flushing buffered records (if any are buffered).
+        self._timer = None
+        self.record_count = 0
+        self.closed = False
+        # Keyed, such that the header is never dropped by the writer.
+        self.writer.submit(('header', self.output_path), _write_header,
+                           self.output_path)
+
+    def append(self, pts, parent_corners, child_corners, homography=None):
+        '''
+        Append warp change at time `pts` (in nanoseconds).
+
+        If `homography` is not provided, it is computed from the corners.
+        '''
+        if self.closed:
+            raise RuntimeError('Timeline is closed.')
+        if homography is None:
+            homography = find_homography_4pt(child_corners, parent_corners)
+        with self._lock:
+            record = self._chunk[self._count]
+            record['pts'] = pts
+            record['parent_corners'] = parent_corners
+            record['child_corners'] = child_corners
+            record['homography'] = homography
+            self._count += 1
+            self.record_count += 1
+            if self._count == len(self._chunk):
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval,
+                                              self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            # Ignore timer cancelled after it fired (i.e., by `_flush`).
+            if self._timer is threading.current_thread():
+                self._timer = None
+                self._flush()
+
+    def flush(self):
+        '''
+        Queue append of buffered records to file.
+
+        Returns `writer.WriteResult` (or `None` if no records are buffered).
+        '''
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._count == 0:
+            return None
+        # Copy, since the chunk buffer is reused.
+        records = self._chunk[:self._count].copy()
+        self._count = 0
+        return self.writer.submit(None, _append_records, self.output_path,
+                                  records)
+
+    def close(self):
+        '''
+        Queue append of remaining records.
+
+        Returns `writer.WriteResult` signalled once all records are written.
+        '''
+        if self.closed:
+            return None
+        self.flush()
+        self.closed = True
+        return self.writer.submit(('close', self.output_path),
+                                  lambda: self.output_path)
+
+
+class WarpTimeline(object):
+    '''
+    Memory-mapped warp timeline reader.
+
+    Attributes
+    ----------
+
+     - `records`: `RECORD_DTYPE` record array (memory-mapped).
+     - `pts`: Array of record times (in nanoseconds).
+    '''
+    def __init__(self, timeline_path):
+        self.timeline_path = path(timeline_path)
+        with open(self.timeline_path, 'rb') as input_:
+            header = input_.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError('Truncated warp timeline header.')
+        magic, version, record_size = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('Not a warp timeline: %s' % self.timeline_path)
+        if version > FORMAT_VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise ValueError('Unsupported warp timeline version: %s' % version)
+        count = ((self.timeline_path.getsize() - HEADER.size) //
+                 RECORD_DTYPE.itemsize)
+        if count > 0:
+            self.records = np.memmap(self.timeline_path, dtype=RECORD_DTYPE,
+                                     mode='r', offset=HEADER.size,
+                                     shape=(count, ))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self.pts = self.records['pts']
+
+    def __len__(self):
+        return len(self.records)
+
+    def index_at(self, pts):
+        '''
+        Return index of record in effect at time(s) `pts` (in nanoseconds).
+
+        Index is -1 for times before the first record.
+        '''
+        return np.searchsorted(self.pts, pts, side='right') - 1
+
+    def record_at(self, pts):
+        '''
+        Return record in effect at time `pts` (or `None` if before the first
+        record).
+        '''
+        i = self.index_at(pts)
+        return self.records[i] if i >= 0 else None
+
+    def homography_at(self, pts):
+        '''
+        Return child-to-parent homography in effect at time `pts` (or `None`
+        if before the first record).
+        '''
+        record = self.record_at(pts)
+        return None if record is None else record['homography']
+
+    def homographies_at(self, pts):
+        '''
+        Return `(N, 3, 3)` array of homographies in effect at times `pts`.
+
+        Times before the first record use the first record.
+        '''
+        return self.records['homography'][np.clip(self.index_at(pts), 0,
+                                                  None)]
+
+
+class WarpTimelineRecorder(object):
+    '''
+    Record warp timeline of a `WarpActor` for the active recording.
+
+    Arguments
+    ---------
+
+     - `warp_actor`: Warp actor (see `warp.WarpActor`).
+     - `recording_time`: Function returning time (in nanoseconds) since the
+       first frame of the active recording, or `None` (e.g.,
+       `PipelineManager.recording_time`).
+
+    Set `warp_actor.on_transform_changed` to `on_transform_changed` (or call
+    it from the hook).
+    '''
+    def __init__(self, warp_actor, recording_time):
+        self.warp_actor = warp_actor
+        self.recording_time = recording_time
+        self.timeline = None
+
+    def set_record_path(self, record_path):
+        '''
+        Start a new warp timeline next to `record_path` (closing the timeline
+        of any previous recording).  Unchanged if already recording to
+        `record_path`.
+        '''
+        output_path = (None if record_path is None
+                       else timeline_path(record_path).abspath())
+        if self.timeline is not None:
+            if self.timeline.output_path == output_path:
+                return
+            self.timeline.close()
+            self.timeline = None
+        if output_path is not None:
+            self.timeline = WarpTimelineWriter(output_path)
+            state = self.warp_actor.state
+            if state.initialized:
+                # Warp in effect at the start of the recording.
+                self.timeline.append(0, state.parent_corners,
+                                     state.child_corners)
+
+    def on_transform_changed(self, state):
+        '''
+        Append warp change to timeline of active recording (if any).
+        '''
+        if self.timeline is not None and state.initialized:
+            # Changes before the first recorded frame apply from the start.
+            pts = max(self.recording_time() or 0, 0)
+            self.timeline.append(pts, state.parent_corners,
+                                 state.child_corners)
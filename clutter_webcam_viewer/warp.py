@@ -1,22 +1,127 @@
-import pandas as pd
+from collections import namedtuple
+
 import numpy as np
 from gi.repository import Clutter, GLib
-from opencv_helpers import find_homography_array, cvwarp_mat_to_4x4
 import cogl_helpers as ch
+from path_helpers import path
+from .calibration import WarpCalibration, load_calibration, save_calibration
+from .coalesce import FrameCoalescer
+from .homography import find_transform_4x4
+from .remap_cache import get_remap_cache, remap_path
+from .writer import get_writer
 
 
 def bounding_box_from_allocation(allocation):
+    import pandas as pd
+
     attrs = 'x', 'y', 'width', 'height'
     return pd.Series([getattr(allocation, k) for k in attrs],
                      index=list(attrs), name='bounding_box')
 
 
 def corners_from_bounding_box(bbox):
+    import pandas as pd
+
     corners = pd.DataFrame([[0, 0], [bbox.width, 0], [bbox.width, bbox.height],
                             [0, bbox.height]], columns=list('xy'))
     return corners + bbox[['x', 'y']].values
 
 
+def bounding_box_array(allocation, out):
+    '''
+    Write `x`, `y`, `width`, `height` of `allocation` to `(4, )` array `out`.
+    '''
+    out[:] = allocation.x, allocation.y, allocation.width, allocation.height
+    return out
+
+
+def corners_array(bbox, out):
+    '''
+    Write corners (clockwise, starting at top-left) of `(4, )` bounding box
+    array `bbox` to `(4, 2)` array `out`.
+    '''
+    x, y, width, height = bbox
+    out[:] = ((x, y), (x + width, y), (x + width, y + height),
+              (x, y + height))
+    return out
+
+
+class Point(namedtuple('Point', 'x y')):
+    __slots__ = ()
+
+
+class WarpState(object):
+    '''
+    Corner correspondences of a perspective warp, backed by fixed-size
+    `float64` arrays that are updated in place.
+
+    Attributes
+    ----------
+
+     - `parent_corners`: `(4, 2)` array of corners in warp (i.e., parent)
+       actor coordinates.
+     - `child_corners`: `(4, 2)` array of corresponding corners in child
+       actor coordinates.
+     - `parent_bbox`, `child_bbox`: `(4, )` arrays containing `x`, `y`,
+       `width`, and `height` of parent and child allocation, respectively.
+     - `initialized`: `True` once corners have been fit to an allocation.
+    '''
+    __slots__ = ('parent_corners', 'child_corners', 'parent_bbox',
+                 'child_bbox', 'initialized', '_scratch')
+
+    FLIP_HORIZONTAL = np.array([1, 0, 3, 2])
+    FLIP_VERTICAL = np.array([3, 2, 1, 0])
+
+    def __init__(self):
+        self.parent_corners = np.zeros((4, 2))
+        self.child_corners = np.zeros((4, 2))
+        self.parent_bbox = np.zeros(4)
+        self.child_bbox = np.zeros(4)
+        self.initialized = False
+        self._scratch = np.zeros((4, 2))
+
+    def fit(self, parent_allocation, child_allocation):
+        '''
+        Reset corners to the corners of the parent and child allocations.
+        '''
+        bounding_box_array(parent_allocation, self.parent_bbox)
+        bounding_box_array(child_allocation, self.child_bbox)
+        corners_array(self.parent_bbox, self.parent_corners)
+        corners_array(self.child_bbox, self.child_corners)
+        self.initialized = True
+
+    def nearest_point_index(self, x, y):
+        '''
+        Return index of parent corner nearest (Manhattan distance) to the
+        specified point.
+        '''
+        np.subtract(self.parent_corners, (x, y), out=self._scratch)
+        np.abs(self._scratch, out=self._scratch)
+        return self._scratch.sum(axis=1).argmin()
+
+    def _reorder_child_corners(self, index):
+        np.take(self.child_corners, index, axis=0, out=self._scratch)
+        self.child_corners[:] = self._scratch
+
+    def rotate(self, shift):
+        self._reorder_child_corners((np.arange(4) - shift) % 4)
+
+    def flip_horizontal(self):
+        self._reorder_child_corners(self.FLIP_HORIZONTAL)
+
+    def flip_vertical(self):
+        self._reorder_child_corners(self.FLIP_VERTICAL)
+
+    def frame(self, corners):
+        '''
+        Return `pandas.DataFrame` view (i.e., no copy) of `corners` array with
+        `x` and `y` columns.
+        '''
+        import pandas as pd
+
+        return pd.DataFrame(corners, columns=['x', 'y'], copy=False)
+
+
 class WarpActor(Clutter.Group):
     def __init__(self, actor):
         super(WarpActor, self).__init__()
@@ -31,13 +136,36 @@ class WarpActor(Clutter.Group):
         self.actor.connect('motion-event', self.on_mouse_move)
         self._enter_coords = None
         self._exit_coords = None
-        self.parent_corners = None
-        self.child_corners = None
+        self.state = WarpState()
+        # Reusable buffer for 4x4 transform matrix.
+        self._transform_arr = np.identity(4, dtype='float32')
+        # Apply at most one drag update per stage frame.
+        self.transform_coalescer = FrameCoalescer(self.update_transform, self)
+        self.connect('destroy', lambda *args: self.transform_coalescer.stop())
+        # Called as `on_transform_changed(state)` after each transform update.
+        self.on_transform_changed = None
+
+    @property
+    def parent_corners(self):
+        '''
+        `pandas.DataFrame` view of parent corners (or `None` if not yet
+        initialized).
+        '''
+        if self.state.initialized:
+            return self.state.frame(self.state.parent_corners)
+
+    @property
+    def child_corners(self):
+        '''
+        `pandas.DataFrame` view of child corners (or `None` if not yet
+        initialized).
+        '''
+        if self.state.initialized:
+            return self.state.frame(self.state.child_corners)
 
     def on_allocation_changed(self, warp_actor, allocation, flags, actor):
-        bbox = bounding_box_from_allocation(self.actor
-                                            .get_allocation_geometry())
-        if (bbox[['width', 'height']] > 0).all():
+        geometry = self.actor.get_allocation_geometry()
+        if geometry.width > 0 and geometry.height > 0:
             Clutter.threads_add_idle(GLib.PRIORITY_DEFAULT,
                                      self.fit_child_to_parent)
 
@@ -51,43 +179,38 @@ class WarpActor(Clutter.Group):
         return corners_from_bounding_box(bbox)
 
     def fit_child_to_parent(self):
-        parent_corners = self.warp_actor_corner_points()
-        child_corners = self.actor_corner_points()
-        homography_arr = find_homography_array(child_corners.values,
-                                               parent_corners.values)
-        warp_arr = cvwarp_mat_to_4x4(homography_arr)
-        self.actor.set_transform(ch.from_array(warp_arr))
-        self.parent_corners = self.warp_actor_corner_points()
-        self.child_corners = self.actor_corner_points()
+        self.state.fit(self.get_allocation_geometry(),
+                       self.actor.get_allocation_geometry())
+        self.update_transform()
 
     def on_enter(self, actor, event):
         self._in_bounds = True
-        self._enter_coords = pd.Series([event.x, event.y], index=['x', 'y'])
+        self._enter_coords = Point(event.x, event.y)
 
     def on_exit(self, actor, event):
         self._in_bounds = False
-        self._exit_coords = pd.Series([event.x, event.y], index=['x', 'y'])
+        self._exit_coords = Point(event.x, event.y)
 
     def on_button_press(self, actor, event):
-        self._press_coords = pd.Series([event.x, event.y], index=['x', 'y'])
+        self._press_coords = Point(event.x, event.y)
         self._button_down = True
-        self._press_translate = pd.Series(self.actor.get_translation()[:2],
-                                          index=['x', 'y'])
+        self._press_translate = Point(*self.actor.get_translation()[:2])
         self._press_index = self.nearest_point_index(self._press_coords)
         ok, x, y = self.actor.transform_stage_point(*self._press_coords)
         if not ok:
             raise ValueError('Error translating point.')
-        self.child_corners.iloc[self._press_index] = x, y
-        self.parent_corners.iloc[self._press_index] = event.x, event.y
+        self.state.child_corners[self._press_index] = x, y
+        self.state.parent_corners[self._press_index] = event.x, event.y
 
     def on_button_release(self, actor, event):
         if getattr(self, '_button_down', False):
-            self._release_coords = pd.Series([event.x, event.y],
-                                             index=['x', 'y'])
+            self._release_coords = Point(event.x, event.y)
             self._button_down = False
+            # Make sure final drag position is applied.
+            self.transform_coalescer.flush()
 
     def nearest_point_index(self, p):
-        return (self.parent_corners - p).abs().sum(axis=1).argmin()
+        return self.state.nearest_point_index(*p)
 
     def on_mouse_move(self, actor, event):
         if getattr(self, '_button_down', False):
@@ -97,67 +220,121 @@ class WarpActor(Clutter.Group):
                 # Button was pressed, but is no longer pressed (e.g., released
                 # while outside of stage).
                 self.on_button_release(self.actor, self._exit_coords)
-            self.parent_corners.iloc[self._press_index] = event.x, event.y
-            self.update_transform()
+            # Record latest position and defer transform update to the next
+            # stage frame, since several motion events may arrive per frame.
+            self.state.parent_corners[self._press_index] = event.x, event.y
+            self.transform_coalescer.request()
 
     def update_transform(self):
-        homography_arr = find_homography_array(self.child_corners.values,
-                                               self.parent_corners.values)
-        transform_arr = cvwarp_mat_to_4x4(homography_arr)
-        self.actor.set_transform(ch.from_array(transform_arr))
+        try:
+            find_transform_4x4(self.state.child_corners,
+                               self.state.parent_corners,
+                               out=self._transform_arr)
+        except ValueError:
+            # Corners are (transiently) collinear, e.g., while dragging a
+            # corner across an edge.  Keep the previous transform.
+            return
+        self.actor.set_transform(ch.from_array(self._transform_arr))
+        if self.on_transform_changed is not None:
+            self.on_transform_changed(self.state)
+
+    def drag_stats(self):
+        '''
+        Return `dict` with the number of drag transform updates `requested`,
+        `applied`, and `dropped` (i.e., coalesced within a single frame).
+        '''
+        return self.transform_coalescer.stats()
 
     def rotate(self, shift):
         '''
         Rotate 90 degrees clockwise `shift` times.  If `shift` is negative,
         rotate counter-clockwise.
         '''
-        self.child_corners.values[:] = np.roll(self.child_corners
-                                                 .values, shift, axis=0)
+        self.state.rotate(shift)
         self.update_transform()
 
     def flip_horizontal(self):
-        corners = self.child_corners.values.copy()
-        self.child_corners.values[:2] = np.roll(corners[:2], 1, axis=0)
-        self.child_corners.values[2:] = np.roll(corners[2:], 1, axis=0)
+        self.state.flip_horizontal()
         self.update_transform()
 
     def flip_vertical(self):
-        corners = self.child_corners.values.copy()
-        self.child_corners.values[[0, -1]] = corners[[-1, 0]]
-        self.child_corners.values[1:3] = np.roll(corners[1:3], 1, axis=0)
+        self.state.flip_vertical()
         self.update_transform()
 
     def get_actor_vertices(self):
+        import pandas as pd
+
         return pd.DataFrame([[v.x, v.y] for v in
                              self.actor.get_abs_allocation_vertices()],
                             columns=['x', 'y'])
 
-    def save(self, warp_path):
-        # Parent allocation
-        parent_bbox = \
-            bounding_box_from_allocation(self.get_allocation_geometry())
-        # Child allocation
-        child_bbox = \
-            bounding_box_from_allocation(self.actor.get_allocation_geometry())
-        common_settings = dict(format='table', data_columns=True,
-                               complib='zlib', complevel=6)
-        parent_bbox.to_hdf(str(warp_path), '/shape/parent', **common_settings)
-        child_bbox.to_hdf(str(warp_path), '/shape/child', **common_settings)
-        self.parent_corners.to_hdf(str(warp_path), '/corners/parent',
-                                   **common_settings)
-        self.child_corners.to_hdf(str(warp_path), '/corners/child',
-                                  **common_settings)
+    def calibration(self):
+        '''
+        Return copy of current corners and allocations as `WarpCalibration`.
+        '''
+        return WarpCalibration(
+            bounding_box_array(self.get_allocation_geometry(), np.empty(4)),
+            bounding_box_array(self.actor.get_allocation_geometry(),
+                               np.empty(4)),
+            self.state.parent_corners.copy(), self.state.child_corners.copy())
+
+    def frame_shape(self):
+        '''
+        Return `(rows, columns)` of the frames displayed by the warped actor
+        (i.e., its `texture`), or `None` if no frame has been displayed.
+        '''
+        texture = getattr(self.actor, 'texture', None)
+        if texture is None:
+            return None
+        width, height = texture.get_base_size()
+        if width and height:
+            return height, width
+
+    def save(self, warp_path, tables=False):
+        '''
+        Queue save of warp calibration on the background writer thread
+        (format selected by extension, see `calibration.save_calibration`).
+
+        Repeated saves to the same path that have not been written yet are
+        coalesced.
+
+        If `tables` is `True` (e.g., when recording with rectification
+        enabled, or when the user saves the warp), remap tables of the
+        calibration (see `rectify.Rectifier`) are also written next to the
+        warp file (see `remap_path`), for the shape of the displayed frames
+        and any other frame shape in the shared remap cache.  The tables are
+        built on the writer thread if necessary.  If no frame has been
+        displayed yet, only cached tables (if any) are written.
+
+        Returns `writer.WriteResult`.
+        '''
+        warp_path = path(warp_path).abspath()
+        # Snapshot calibration on the calling (i.e., UI) thread.
+        calibration = self.calibration()
+        writer = get_writer()
+        if tables:
+            shape = self.frame_shape() if self.state.initialized else None
+            tables_path = remap_path(warp_path)
+            writer.submit(tables_path, get_remap_cache().save, tables_path,
+                          calibration,
+                          shapes=[] if shape is None else [shape])
+        return writer.submit(warp_path, save_calibration, warp_path,
+                             calibration)
 
     def load(self, warp_path):
-        warp_path = str(warp_path)
         try:
-            parent_corners = pd.read_hdf(warp_path, '/corners/parent')
-            child_corners = pd.read_hdf(warp_path, '/corners/child')
-            self.parent_corners[:] = parent_corners
-            self.child_corners[:] = child_corners
+            calibration = load_calibration(warp_path)
+            self.state.parent_corners[:] = calibration.parent_corners
+            self.state.child_corners[:] = calibration.child_corners
         except Exception:
             pass
         else:
+            tables_path = remap_path(warp_path)
+            if tables_path.isfile():
+                # Reuse remap tables from a previous session (read on the
+                # background writer thread).
+                get_writer().submit(('load', tables_path),
+                                    get_remap_cache().load, tables_path)
             Clutter.threads_add_idle(GLib.PRIORITY_DEFAULT,
                                      self.update_transform)
 
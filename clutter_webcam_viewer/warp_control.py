@@ -41,12 +41,12 @@ class WarpControl(SlaveView):
         box.show_all()
         self.widget.pack_start(box, False, False, 0)
 
-        if self.warp_actor.parent_corners is None:
+        if not self.warp_actor.state.initialized:
             for b in (rotate_left, rotate_right, flip_horizontal,
                       flip_vertical, reset, load, save):
                 b.set_sensitive(False)
             def check_init():
-                if self.warp_actor.parent_corners is not None:
+                if self.warp_actor.state.initialized:
                     for b in (rotate_left, rotate_right, flip_horizontal,
                               flip_vertical, reset, load, save):
                         b.set_sensitive(True)
@@ -56,17 +56,19 @@ class WarpControl(SlaveView):
 
     def save(self):
         '''
-        Save warp projection settings to HDF file.
+        Save warp projection settings to JSON (or HDF) file.
         '''
-        response = pu.open(title='Save perspective warp', patterns=['*.h5'])
+        response = pu.open(title='Save perspective warp',
+                           patterns=['*.json', '*.h5'])
         if response is not None:
-            self.warp_actor.save(response)
+            self.warp_actor.save(response, tables=True)
 
     def load(self):
         '''
-        Load warp projection settings from HDF file.
+        Load warp projection settings from JSON (or HDF) file.
         '''
-        response = pu.open(title='Load perspective warp', patterns=['*.h5'])
+        response = pu.open(title='Load perspective warp',
+                           patterns=['*.json', '*.h5'])
         if response is not None:
             self.warp_actor.load(response)
 
@@ -0,0 +1,230 @@
+'''
+Background writer for warp calibrations and recording metadata.
+
+Writes are queued to a single worker thread, such that neither the Clutter
+main loop nor pipeline startup ever waits on disk.  Writes submitted with the
+same key (e.g., the output path) that have not started yet are coalesced, i.e.,
+only the most recently submitted write is performed.
+
+`submit` never blocks.  Instead, the number of queued writes is bounded: once
+`max_pending` writes are queued, each new write drops the oldest queued write
+submitted without a key (keyed writes are already bounded by the number of
+distinct keys).
+'''
+from collections import OrderedDict, deque
+import atexit
+import threading
+import traceback
+
+
+DEFAULT_MAX_PENDING = 64
+
+
+class WriteResult(object):
+    '''
+    Completion signal for a queued write.
+
+    Attributes
+    ----------
+
+     - `value`: Return value of the write function (once done).
+     - `exception`: Exception raised by the write function (or `None`).
+    '''
+    def __init__(self):
+        self.value = None
+        self.exception = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for write to complete.  Returns `True` if the write is done.
+        '''
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''
+        Wait for write to complete and return its value (or raise its
+        exception).
+        '''
+        if not self.wait(timeout):
+            raise RuntimeError('Timed out waiting for write.')
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def add_done_callback(self, callback):
+        '''
+        Call `callback(result)` once the write is done.
+
+        The callback is called from the writer thread (or immediately, if the
+        write is already done).  Use, e.g., `GLib.idle_add` to update the UI.
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _set(self, value=None, exception=None):
+        with self._lock:
+            self.value = value
+            self.exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                traceback.print_exc()
+
+
+class MetadataWriter(object):
+    '''
+    Worker thread performing queued writes in submission order.
+
+    Arguments
+    ---------
+
+     - `max_pending`: Maximum number of queued writes.  When the queue is
+       full, the oldest queued write without a key is dropped (its
+       `WriteResult` is set with a `RuntimeError`) and counted in
+       `dropped_count`.
+    '''
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+        self.max_pending = max_pending
+        # Map each key to the latest `(function, args, kwargs, result)` not yet
+        # started, in submission order.
+        self._pending = OrderedDict()
+        # Queued keys of writes submitted without a key, oldest first.
+        self._droppable = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._closed = False
+        self.written_count = 0
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='metadata-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, key, function, *args, **kwargs):
+        '''
+        Queue call of `function(*args, **kwargs)` on the writer thread.
+
+        Never blocks, so it is safe to call from the Clutter main loop.
+
+        Arguments
+        ---------
+
+         - `key`: Writes with the same (hashable) key that are still queued are
+           replaced by the latest write (and share its `WriteResult`).  If
+           `None`, the write is never coalesced (e.g., appending chunks), and
+           may be dropped if the queue is full.
+         - `function`: Function performing the write.
+
+        Returns `WriteResult`.
+        '''
+        return self._submit(key, function, args, kwargs)
+
+    def _submit(self, key, function, args, kwargs, marker=False):
+        # A `marker` write (see `flush`) is never dropped and never drops
+        # other writes.
+        dropped = None
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Writer is closed.')
+            if key is not None and key in self._pending:
+                result = self._pending[key][-1]
+                self._pending[key] = function, args, kwargs, result
+                self.coalesced_count += 1
+                return result
+            droppable = key is None and not marker
+            if key is None:
+                key = object()
+            if (not marker and len(self._pending) >= self.max_pending and
+                    self._droppable):
+                dropped = self._pending.pop(self._droppable.popleft())[-1]
+                self.dropped_count += 1
+            result = WriteResult()
+            self._pending[key] = function, args, kwargs, result
+            if droppable:
+                self._droppable.append(key)
+            self._ready.notify()
+        if dropped is not None:
+            print 'Metadata writer queue full: dropped oldest write.'
+            dropped._set(exception=RuntimeError('Write dropped (writer queue '
+                                                'full).'))
+        return result
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._ready.wait()
+                if not self._pending:
+                    # Closed and all writes done.
+                    break
+                key, (function, args, kwargs, result) = \
+                    self._pending.popitem(last=False)
+                if self._droppable and self._droppable[0] is key:
+                    self._droppable.popleft()
+            try:
+                value = function(*args, **kwargs)
+            except Exception, exception:
+                print 'Error writing metadata (%s):' % (key, )
+                traceback.print_exc()
+                result._set(exception=exception)
+            else:
+                self.written_count += 1
+                result._set(value=value)
+
+    def flush(self, timeout=None):
+        '''
+        Wait for all writes submitted so far to complete (or be dropped).
+
+        Returns `True` if all writes completed within `timeout` seconds.
+        '''
+        if not self._thread.is_alive():
+            return True
+        return self._submit(None, lambda: None, (), {},
+                            marker=True).wait(timeout)
+
+    def close(self, timeout=None):
+        '''
+        Complete queued writes and stop the worker thread.
+
+        Returns `True` if all writes completed within `timeout` seconds.
+        '''
+        with self._lock:
+            if self._closed:
+                return not self._thread.is_alive()
+        flushed = self.flush(timeout)
+        with self._lock:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join(timeout)
+        return flushed and not self._thread.is_alive()
+
+
+_default_writer = None
+_default_writer_lock = threading.Lock()
+
+
+def get_writer():
+    '''
+    Return shared `MetadataWriter`, flushed when the interpreter exits.
+    '''
+    global _default_writer
+
+    with _default_writer_lock:
+        if _default_writer is None:
+            _default_writer = MetadataWriter()
+            atexit.register(_default_writer.close)
+        return _default_writer